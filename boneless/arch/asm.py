@@ -1,6 +1,10 @@
 import re
+import sys
+import json
+import hashlib
 
 from . import mc
+from .cache import read_entry, write_entry
 
 
 __all__ = ["TranslationError", "assemble", "disassemble"]
@@ -84,36 +88,82 @@ def emit_text(input, *, instr_cls):
     return "\n".join(output)
 
 
-def assemble(input, *, instr_cls):
+class _Lengths:
+    # Lengths of the chunks of the output, kept in a Fenwick tree, so that the address of a chunk
+    # (the sum of the lengths of every chunk before it) can be found, and the length of a chunk
+    # changed, in logarithmic time.
+    def __init__(self, lengths):
+        self.lengths = list(lengths)
+        self._tree   = [0, *lengths]
+        for index in range(1, len(self._tree)):
+            parent = index + (index & -index)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[index]
+
+    def address(self, index):
+        tree, addr = self._tree, 0
+        while index > 0:
+            addr  += tree[index]
+            index -= index & -index
+        return addr
+
+    def update(self, index, length):
+        tree, delta = self._tree, length - self.lengths[index]
+        self.lengths[index] = length
+        index += 1
+        while index < len(tree):
+            tree[index] += delta
+            index += index & -index
+
+
+def assemble(input, *, instr_cls, labels=None, locs=None, stats=None, relocs=None,
+             cache_dir=None, cache_size=64 << 20):
+    if cache_dir is not None and isinstance(input, str) and _isa_digest(instr_cls) is not None:
+        return _assemble_cached(input, instr_cls=instr_cls, labels=labels, locs=locs,
+                                stats=stats, relocs=relocs,
+                                cache_dir=cache_dir, cache_size=cache_size)
     if isinstance(input, str):
         input = parse_text(input, instr_cls=instr_cls)
 
+    # The input is flattened into chunks: data and instructions that can be encoded right away,
+    # relocatable instructions, and callables. Labels are kept as the index of the chunk after
+    # them. Only relocatable instructions and callables can change length, and the addresses
+    # of the chunks are kept in a `_Lengths` tree, so that relaxing one chunk takes logarithmic
+    # rather than linear time.
+    chunks      = []
+    contents    = []
     label_locs  = {}
+    label_at    = {}
+    # During the initial layout, the addresses of the labels defined so far.
     label_addrs = {}
+    # The lengths of the relocatable instructions returned by callables.
     instr_sizes = {}
-    fwd_adjust  = 0
-
-    def resolve(obj_addr, symbol):
-        # If the label isn't defined it could mean one of the two things:
-        #   * We're in the first relaxation pass.
-        #   * It's an external symbol.
-        # In both cases we return `None`, as a request to downstream code to lower to largest
-        # possible encoding.
-        if symbol in label_addrs:
-            result = label_addrs[symbol] - obj_addr
-            if result > 0:
-                # Each time we shrink a chunk, we need to move all labels after this chunk lower,
-                # or else relative forward offsets after this point may increase.
-                result -= fwd_adjust
-        else:
-            result = None
-        return result
+    instr_locs  = {}
 
-    def translate(elem, output, n_pass, *, indexes=(), allow_unresolved=None):
-        length = None
-        elem_addr = len(output)
-        if elem is None and n_pass == 1:
-            # `None` in input is OK during the first pass as a placeholder for a complex address
+    def relocate(elem, output, elem_addr, length, resolve, indexes, allow_unresolved):
+        # Offsets are computed from the address of the next instruction, assuming the current
+        # length; the encoding may then be shorter, which is refined in later passes.
+        try:
+            return elem(lambda sym: resolve(elem_addr + length, sym)).encode(output)
+        except mc.UnresolvedRef as error:
+            length = elem.max_length
+            if allow_unresolved is None:
+                # ... add a placeholder sized for the worst case during relaxation;
+                output.extend([None] * length)
+            elif allow_unresolved:
+                # ... use the longest encoding if we're emitting relocations;
+                rel_length = elem(lambda sym: 0).encode(output, use_longest=True)
+                assert length == rel_length, f"Illegal longest encoding at {indexes}"
+            else:
+                # ... raise an error otherwise.
+                raise TranslationError(f"{{0}} at {{loc}}", error, loc=indexes) from None
+            return length
+
+    def expand(elem, output, base, resolve, indexes, *, initial, allow_unresolved=None):
+        # Translate the value returned by a callable at `base`.
+        elem_addr = base + len(output)
+        if elem is None and initial:
+            # `None` is OK during the initial layout as a placeholder for a complex address
             # computation that relies on a symbol that isn't defined yet; but after that it must
             # be expanded, because we never return closures in the output.
             output.append(None)
@@ -121,88 +171,273 @@ def assemble(input, *, instr_cls):
             output.append(elem)
         elif isinstance(elem, list):
             for index, nested_elem in enumerate(elem):
-                translate(nested_elem, output, n_pass,
-                          indexes=(*indexes, index), allow_unresolved=allow_unresolved)
+                expand(nested_elem, output, base, resolve, (*indexes, index),
+                       initial=initial, allow_unresolved=allow_unresolved)
+        elif isinstance(elem, instr_cls):
+            if allow_unresolved is not None:
+                instr_locs[elem_addr] = indexes
+            try:
+                length = elem.encode(output)
+            except mc.UnresolvedRef:
+                length = relocate(elem, output, elem_addr,
+                                  instr_sizes.get(indexes, elem.max_length), resolve, indexes,
+                                  allow_unresolved)
+                old_length = instr_sizes.get(indexes, length)
+                assert length <= old_length, f"Expansion at {indexes}: {old_length} to {length}"
+                instr_sizes[indexes] = length
+        elif isinstance(elem, mc.Label):
+            raise TranslationError(f"Label {repr(elem.name)} at {{loc}} is returned by "
+                                   f"a callable", loc=indexes)
+        elif hasattr(elem, "__call__"):
+            expand(elem(lambda sym: resolve(elem_addr, sym)), output, base, resolve, indexes,
+                   initial=initial, allow_unresolved=allow_unresolved)
+        else:
+            elem_type_name = f"{type(elem).__module__}.{type(elem).__qualname__}"
+            raise TranslationError(f"Unrecognized value {repr(elem)} of type {elem_type_name} "
+                                   f"at {{loc}}", loc=indexes)
+
+    # Initial layout. Every label is defined as soon as it is reached, so backward references
+    # are resolved right away, and forward references are assumed to need the longest encoding.
+    def resolve_defined(obj_addr, symbol):
+        if symbol in label_addrs:
+            return label_addrs[symbol] - obj_addr
+
+    lengths = []
+    address = 0
+    # The index of the chunk after the last label.
+    label_chunk = None
+    def layout(elem, indexes):
+        nonlocal address, label_chunk
+        if isinstance(elem, int):
+            output = [elem]
+            if chunks and chunks[-1][0] == "data" and label_chunk != len(chunks):
+                # Consecutive data words (that no label points between) are kept in one chunk.
+                contents[-1].append(elem)
+                lengths[-1] += 1
+                address += 1
+                return
+            chunks.append(("data", elem, indexes))
+            contents.append(output)
+        elif isinstance(elem, list):
+            for index, nested_elem in enumerate(elem):
+                layout(nested_elem, (*indexes, index))
+            return
         elif isinstance(elem, mc.Label):
-            if n_pass == 1:
-                if elem.name in label_addrs:
-                    raise TranslationError(f"Label {repr(elem.name)} at {{new}} has the same name "
-                                           f"as the label at {{old}}",
-                                           new=indexes, old=label_locs[elem.name])
-                label_locs[elem.name] = indexes
-            label_addrs[elem.name] = elem_addr
+            if elem.name in label_addrs:
+                raise TranslationError(f"Label {repr(elem.name)} at {{new}} has the same name "
+                                       f"as the label at {{old}}",
+                                       new=indexes, old=label_locs[elem.name])
+            label_locs[elem.name]  = indexes
+            label_addrs[elem.name] = address
+            label_at[elem.name]    = len(chunks)
+            label_chunk = len(chunks)
+            return
         elif isinstance(elem, instr_cls):
+            output = []
             try:
                 # First, try encoding without relocation. This usually succeeds, and is faster.
-                length = elem.encode(output)
+                elem.encode(output)
+                chunks.append(("instr", elem, indexes))
+                contents.append(output)
             except mc.UnresolvedRef:
-                try:
-                    # Compute the expected instruction size; necessary since offsets are computed
-                    # from address of the next instruction.
-                    length = instr_sizes.get(indexes, elem.max_length)
-                    # Second, relocate and try encoding again. This will always succeed if
-                    # the referenced label is defined, and will refine our size estimate.
-                    length = elem(lambda sym: resolve(elem_addr + length, sym)).encode(output)
-                except mc.UnresolvedRef as error:
-                    # If we still can't encode it...
-                    length = elem.max_length
-                    if allow_unresolved is None:
-                        # ... add a placeholder sized for the worst case during initial passes;
-                        for _ in range(length):
-                            output.append(None)
-                    elif allow_unresolved:
-                        # ... use the longest encoding if we're emitting relocations;
-                        rel_length = elem(lambda sym: 0).encode(output, use_longest=True)
-                        assert length == rel_length, f"Illegal longest encoding at {indexes}"
-                    else:
-                        # ... raise an error otherwise.
-                        raise TranslationError(f"{{0}} at {{loc}}", error,
-                                               loc=indexes) from None
+                relocate(elem, output, address, elem.max_length, resolve_defined, indexes, None)
+                chunks.append(("reloc", elem, indexes))
+                contents.append(None)
         elif hasattr(elem, "__call__"):
-            translate(elem(lambda sym: resolve(elem_addr, sym)), output, n_pass,
-                      indexes=indexes, allow_unresolved=allow_unresolved)
-            length = len(output) - elem_addr
+            output = []
+            expand(elem, output, address, resolve_defined, indexes, initial=True)
+            chunks.append(("call", elem, indexes))
+            contents.append(None)
         else:
             elem_type_name = f"{type(elem).__module__}.{type(elem).__qualname__}"
             raise TranslationError(f"Unrecognized value {repr(elem)} of type {elem_type_name} "
                                    f"at {{loc}}", loc=indexes)
-        # The assembler will terminate as long as two conditions are fulfilled:
-        #  1. The size of relocatable chunks never gets higher as the relative offsets shrink, and
-        #  2. The contents of relocatable chunks only depends on offsets.
-        # In other words, each relocatable chunk is a linear function of offsets. We can't easily
-        # check (2), but we can and do check (1) here as a precaution.
-        if length is not None:
-            old_length = instr_sizes.get(indexes, length)
-            assert length <= old_length, f"Expansion at {indexes}: {old_length} to {length}"
-            instr_sizes[indexes] = length
-            # Correct the offset in future forward relocations by accounting for backwards shift
-            # of labels caused by the instruction we may have just shrunk.
-            nonlocal fwd_adjust
-            fwd_adjust += old_length - length
-        return output
+        lengths.append(len(output))
+        address += len(output)
+
+    layout(input, ())
+
+    # Relaxation. The length of a relocatable chunk never gets higher as the relative offsets
+    # shrink, so starting from the longest encodings, every pass shrinks some chunks until none
+    # can be shrunk anymore; this converges to the same encodings no matter the order in which
+    # the chunks are relaxed. A relocatable instruction that reaches the shortest encoding, or
+    # refers to an undefined symbol, can't change anymore and is not relaxed again. Callables
+    # are relaxed in every pass.
+    #
+    # For this to terminate, the contents of relocatable chunks must only depend on offsets; we
+    # can't easily check that, but we can and do check that they never expand as a precaution.
+    tree = _Lengths(lengths)
+    def resolve_current(obj_addr, symbol):
+        if symbol in label_at:
+            return tree.address(label_at[symbol]) - obj_addr
 
-    # Iterate to fixed point. This does more work than strictly necessary (if there are both
-    # forward and backward references, at least three iterations), but produces obviously correct
-    # result: if the (n-1)th and (n)th pass converged, then (n-1)th pass has updated every label
-    # to the same value as in (n)th pass, and (n)th pass has relocated every reference to
-    # the address of the label in either of them.
-    n_pass = 1
-    output = translate(input, [], n_pass)
-    while True:
-        fwd_adjust = 0
-        old_output = output
+    pending = [index for index, (kind, elem, indexes) in enumerate(chunks)
+               if kind == "call" or kind == "reloc" and lengths[index] > 1]
+    n_pass  = n_shrink = 0
+    while pending:
         n_pass += 1
-        output = translate(input, [], n_pass)
-        if output == old_output:
+        shrunk  = False
+        relaxed = []
+        for index in pending:
+            kind, elem, indexes = chunks[index]
+            elem_addr  = tree.address(index)
+            old_length = tree.lengths[index]
+            output = []
+            if kind == "reloc":
+                length = relocate(elem, output, elem_addr, old_length, resolve_current, indexes,
+                                  None)
+            else:
+                expand(elem, output, elem_addr, resolve_current, indexes, initial=False)
+                length = len(output)
+            assert length <= old_length, f"Expansion at {indexes}: {old_length} to {length}"
+            if length < old_length:
+                tree.update(index, length)
+                n_shrink += 1
+                shrunk = True
+            if kind == "call" or length > 1 and None not in output:
+                relaxed.append(index)
+        if not shrunk:
             break
+        pending = relaxed
 
-    # If there are unresolved relocations, ensure they are either reported as an error or emitted
-    # as the longest possible encoding, for future linking.
-    if None in output:
-        fwd_adjust = 0
-        n_pass += 1
-        output = translate(input, [], n_pass, allow_unresolved=False)
+    # Emit the output with the final addresses. If there are unresolved relocations, they are
+    # reported as an error, unless the output is a relocatable object, in which case they are
+    # emitted with the longest encoding, and every relocatable instruction is recorded so that
+    # it can be relaxed again once the object is linked.
+    label_addrs = {name: tree.address(index) for name, index in label_at.items()}
+    def resolve_final(obj_addr, symbol):
+        if symbol in label_addrs:
+            return label_addrs[symbol] - obj_addr
+
+    output = []
+    for index, (kind, elem, indexes) in enumerate(chunks):
+        elem_addr = len(output)
+        if kind == "data":
+            output.extend(contents[index])
+        elif kind == "instr":
+            instr_locs[elem_addr] = indexes
+            output.extend(contents[index])
+        elif kind == "reloc":
+            instr_locs[elem_addr] = indexes
+            relocate(elem, output, elem_addr, tree.lengths[index], resolve_final, indexes,
+                     relocs is not None)
+            if relocs is not None:
+                relocs[elem_addr] = (elem, tree.lengths[index])
+        else:
+            if relocs is not None:
+                raise TranslationError(f"Callable at {{loc}} cannot be emitted into "
+                                       f"a relocatable object", loc=indexes)
+            expanded = []
+            expand(elem, expanded, elem_addr, resolve_final, indexes,
+                   initial=False, allow_unresolved=False)
+            output.extend(expanded)
+        assert len(output) - elem_addr == tree.lengths[index], \
+            f"Expansion at {indexes}: {tree.lengths[index]} to {len(output) - elem_addr}"
+
+    # The addresses of the labels, as well as the locations of the instructions in the input
+    # (for text, the first index is the line), can be returned for tools such as profilers and
+    # debuggers; and the number of relaxation passes and of shrunk chunks, for profiling
+    # the assembler itself.
+    if labels is not None:
+        labels.update(label_addrs)
+    if locs is not None:
+        locs.update(instr_locs)
+    if stats is not None:
+        stats.update(passes=n_pass, shrinks=n_shrink)
+    return output
+
+
+# Text assembled many times over (e.g. by a build that regenerates unchanged sources) can be kept
+# in a cache directory, with the addresses of the labels, the locations of the instructions, and
+# the relocatable instructions. The entries are addressed by a hash of the source together with
+# the definition of the instruction set: the mnemonics and operand formats, the data of every
+# operand class (such as the lookup tables of immediates), and the code of the modules that define
+# the instructions and the operands, and of the assembler itself, which together determine how
+# instructions are encoded. If anything else changes how the source is assembled, `_CACHE_FORMAT`
+# must be incremented.
+_CACHE_FORMAT = 1
+
+_DATA_TYPES = (type(None), bool, int, str, bytes, tuple, list, dict, set, frozenset, range)
+
+_isa_digests = {}
+
+def _isa_digest(instr_cls):
+    # Returns `None` if the code of a module can't be read, in which case nothing is cached.
+    if instr_cls not in _isa_digests:
+        operands = {}
+        for format in instr_cls.formats.values():
+            for base in format.__mro__:
+                if issubclass(base, mc.Operand):
+                    operands[f"{base.__module__}.{base.__qualname__}"] = sorted(
+                        (name, value) for name, value in vars(base).items()
+                        if not name.startswith("__") and isinstance(value, _DATA_TYPES))
+        definition = repr((
+            f"{instr_cls.__module__}.{instr_cls.__qualname__}",
+            sorted((name, f"{format.__module__}.{format.__qualname__}", format.format,
+                    getattr(format, "bits", None))
+                   for name, format in instr_cls.formats.items()),
+            sorted((name, cls.coding, cls.operands, cls.alias, sorted(cls.pc_rel_ops))
+                   for name, cls in instr_cls.mnemonics.items()),
+            sorted(operands.items()),
+        ))
+        digest = hashlib.sha256(definition.encode())
+
+        classes = [*instr_cls.__mro__, *instr_cls.formats.values(),
+                   *instr_cls.mnemonics.values()]
+        modules = {__name__} | {base.__module__ for cls in classes for base in cls.__mro__
+                                if issubclass(base, (mc.Instr, mc.Operand))}
+        try:
+            for module in sorted(modules):
+                with open(sys.modules[module].__file__, "rb") as file:
+                    digest.update(file.read())
+        except (OSError, KeyError, AttributeError, TypeError):
+            digest = None
+        _isa_digests[instr_cls] = None if digest is None else digest.digest()
+    return _isa_digests[instr_cls]
+
+
+def _assemble_cached(input, *, instr_cls, labels, locs, stats, relocs, cache_dir, cache_size):
+    key = hashlib.sha256()
+    key.update(f"{_CACHE_FORMAT} {sys.byteorder} {relocs is not None}\n".encode())
+    key.update(_isa_digest(instr_cls))
+    key.update(input.encode())
+    key = key.hexdigest()
+
+    entry = read_entry(cache_dir, key)
+    if entry is not None:
+        output, metadata = entry
+        if labels is not None or locs is not None or relocs is not None:
+            metadata = json.loads(metadata)
+            if labels is not None:
+                labels.update(metadata["labels"])
+            if locs is not None:
+                locs.update((addr, tuple(indexes)) for addr, indexes in metadata["locs"])
+            if relocs is not None:
+                relocs.update((addr, (instr_cls.from_str(instr), length))
+                              for addr, length, instr in metadata["relocs"])
+        if stats is not None:
+            stats.update(passes=0, shrinks=0)
+        return output
 
+    entry_labels = {}
+    entry_locs   = {}
+    entry_relocs = None if relocs is None else {}
+    output = assemble(input, instr_cls=instr_cls, labels=entry_labels, locs=entry_locs,
+                      stats=stats, relocs=entry_relocs)
+    if all(word in range(0x10000) for word in output):
+        metadata = {
+            "labels": entry_labels,
+            "locs":   [[addr, indexes] for addr, indexes in entry_locs.items()],
+            "relocs": [[addr, length, str(instr)]
+                       for addr, (instr, length) in (entry_relocs or {}).items()],
+        }
+        write_entry(cache_dir, key, output, json.dumps(metadata).encode(), max_size=cache_size)
+    if labels is not None:
+        labels.update(entry_labels)
+    if locs is not None:
+        locs.update(entry_locs)
+    if relocs is not None:
+        relocs.update(entry_relocs)
     return output
 
 
@@ -0,0 +1,312 @@
+import numpy as np
+
+from .instr import Instr
+from . import opcode
+
+
+__all__ = ["BatchExternalMemory", "BatchSimulator"]
+
+
+# Decoding tables
+# ---------------
+#
+# Every instruction word is decoded ahead of time into the index of its instruction class (or -1
+# if the encoding is illegal) and its immediate, extended to 16 bits using the same lookup tables
+# as the operand classes. Register fields are at the same position in every format.
+
+_classes = sorted(set(Instr.decodings.values()), key=lambda cls: cls.__name__)
+_ext_index = _classes.index(opcode.EXTI)
+
+_class_table = np.full(0x10000, -1, dtype=np.int16)
+for _word, _instr_cls in Instr.decodings.items():
+    _class_table[_word] = _classes.index(_instr_cls)
+
+_imm_table = np.zeros(0x10000, dtype=np.int64)
+for _index, _instr_cls in enumerate(_classes):
+    if "imm" in _instr_cls._field_types:
+        _imm_type = _instr_cls._field_types["imm"]
+        _imm_lut  = np.array([_imm_type.value_from_bits(bits) & 0xffff
+                              for bits in range(1 << _imm_type.bits)], dtype=np.int64)
+        _words    = np.nonzero(_class_table == _index)[0]
+        _imm_table[_words] = _imm_lut[_words & ((1 << _imm_type.bits) - 1)]
+del _word, _index, _instr_cls, _imm_type, _imm_lut, _words
+
+
+# Instruction semantics
+# ---------------------
+#
+# Each instruction class is implemented by a function that executes it for a group of instances
+# `i` at once; all other arguments are arrays with one element per instance in the group. `pc` is
+# the address of the next instruction, and `imm` is not yet added to PC for PC-relative forms.
+
+def _load(sim, i, addr):
+    return sim.mem[i, addr & 0xffff].astype(np.int64)
+
+def _store(sim, i, addr, value):
+    sim.mem[i, addr & 0xffff] = value & 0xffff
+
+def _set_zs(sim, i, r):
+    sim.z[i] = r == 0
+    sim.s[i] = r >= 0x8000
+
+def _set_cv(sim, i, a, b, r):
+    sim.c[i] = r > 0xffff
+    r &= 0xffff
+    sim.v[i] = ((a ^ r) & (b ^ r)) >= 0x8000
+    return r
+
+def _semantics(cls):
+    def operands(sim, i, ra, rb, imm):
+        w = sim.w[i]
+        a = _load(sim, i, w | ra)
+        b = _load(sim, i, w | rb) if issubclass(cls, opcode.M_RRR) else imm
+        return w, a, b
+
+    if issubclass(cls, (opcode.C_LOGIC, opcode.C_ARITH)):
+        if issubclass(cls, opcode.C_LOGIC) and not issubclass(cls, opcode.T_CMP):
+            compute = {opcode.T_AND: np.bitwise_and,
+                       opcode.T_OR:  np.bitwise_or,
+                       opcode.T_XOR: np.bitwise_xor}
+            for type_cls, function in compute.items():
+                if issubclass(cls, type_cls):
+                    break
+            def execute(sim, i, pc, rsd, ra, rb, imm):
+                w, a, b = operands(sim, i, ra, rb, imm)
+                r = function(a, b)
+                _store(sim, i, w | rsd, r)
+                _set_zs(sim, i, r)
+        else:
+            subtract = issubclass(cls, (opcode.T_CMP, opcode.T_SUB, opcode.T_SBC))
+            carry    = issubclass(cls, (opcode.T_ADC, opcode.T_SBC))
+            store    = not issubclass(cls, opcode.T_CMP)
+            def execute(sim, i, pc, rsd, ra, rb, imm):
+                w, a, b = operands(sim, i, ra, rb, imm)
+                if subtract:
+                    b = b ^ 0xffff
+                if carry:
+                    r = a + b + sim.c[i]
+                else:
+                    r = a + b + subtract
+                r = _set_cv(sim, i, a, b, r)
+                if store:
+                    _store(sim, i, w | rsd, r)
+                _set_zs(sim, i, r)
+        return execute
+
+    if issubclass(cls, opcode.C_SHIFT):
+        if issubclass(cls, opcode.T_SLL):
+            compute = lambda a, n: (a << n) & 0xffff
+        if issubclass(cls, opcode.T_ROL):
+            compute = lambda a, n: ((a << n) | (a >> (16 - n))) & 0xffff
+        if issubclass(cls, opcode.T_SRL):
+            compute = lambda a, n: a >> n
+        if issubclass(cls, opcode.T_SRA):
+            compute = lambda a, n: (((a ^ 0x8000) - 0x8000) >> n) & 0xffff
+        def execute(sim, i, pc, rsd, ra, rb, imm):
+            w, a, b = operands(sim, i, ra, rb, imm)
+            r = compute(a, b & 0xf)
+            _store(sim, i, w | rsd, r)
+            _set_zs(sim, i, r)
+        return execute
+
+    if cls in (opcode.LD, opcode.LDR, opcode.LDX):
+        def execute(sim, i, pc, rsd, ra, rb, imm):
+            w    = sim.w[i]
+            addr = (_load(sim, i, w | ra) + imm + (pc if cls is opcode.LDR else 0)) & 0xffff
+            if cls is opcode.LDX:
+                _store(sim, i, w | rsd, np.asarray(sim.ext.read(i, addr), dtype=np.int64))
+            else:
+                _store(sim, i, w | rsd, _load(sim, i, addr))
+        return execute
+    if cls in (opcode.ST, opcode.STR, opcode.STX):
+        def execute(sim, i, pc, rsd, ra, rb, imm):
+            w    = sim.w[i]
+            addr = (_load(sim, i, w | ra) + imm + (pc if cls is opcode.STR else 0)) & 0xffff
+            if cls is opcode.STX:
+                sim.ext.write(i, addr, _load(sim, i, w | rsd))
+            else:
+                _store(sim, i, addr, _load(sim, i, w | rsd))
+        return execute
+    if cls is opcode.LDXA:
+        def execute(sim, i, pc, rsd, ra, rb, imm):
+            _store(sim, i, sim.w[i] | rsd, np.asarray(sim.ext.read(i, imm), dtype=np.int64))
+        return execute
+    if cls is opcode.STXA:
+        def execute(sim, i, pc, rsd, ra, rb, imm):
+            sim.ext.write(i, imm, _load(sim, i, sim.w[i] | rsd))
+        return execute
+
+    if cls in (opcode.MOVI, opcode.MOVR):
+        def execute(sim, i, pc, rsd, ra, rb, imm):
+            _store(sim, i, sim.w[i] | rsd, imm + (pc if cls is opcode.MOVR else 0))
+        return execute
+
+    if cls is opcode.STW:
+        def execute(sim, i, pc, rsd, ra, rb, imm):
+            sim.w[i] = _load(sim, i, sim.w[i] | rb) & 0xfff8
+        return execute
+    if cls in (opcode.XCHW, opcode.ADJW, opcode.LDW):
+        def execute(sim, i, pc, rsd, ra, rb, imm):
+            w = sim.w[i]
+            if cls is opcode.XCHW:
+                sim.w[i] = _load(sim, i, w | rb) & 0xfff8
+            else:
+                sim.w[i] = (w + imm) & 0xfff8
+            if cls is not opcode.ADJW:
+                _store(sim, i, sim.w[i] | rsd, w)
+        return execute
+
+    if cls is opcode.JR:
+        def execute(sim, i, pc, rsd, ra, rb, imm):
+            sim.pc[i] = (_load(sim, i, sim.w[i] | rsd) + imm) & 0xffff
+        return execute
+    if cls is opcode.JRAL:
+        def execute(sim, i, pc, rsd, ra, rb, imm):
+            target = _load(sim, i, sim.w[i] | rb)
+            _store(sim, i, sim.w[i] | rsd, pc)
+            sim.pc[i] = target
+        return execute
+    if cls is opcode.JVT:
+        def execute(sim, i, pc, rsd, ra, rb, imm):
+            base = _load(sim, i, sim.w[i] | rsd)
+            sim.pc[i] = (base + _load(sim, i, base + imm)) & 0xffff
+        return execute
+    if cls is opcode.JST:
+        def execute(sim, i, pc, rsd, ra, rb, imm):
+            offset = (imm + pc) & 0xffff
+            sim.pc[i] = (_load(sim, i, _load(sim, i, sim.w[i] | rsd) + offset) + offset) & 0xffff
+        return execute
+    if cls is opcode.JAL:
+        def execute(sim, i, pc, rsd, ra, rb, imm):
+            _store(sim, i, sim.w[i] | rsd, pc)
+            sim.pc[i] = (pc + imm) & 0xffff
+        return execute
+
+    if issubclass(cls, opcode.C_JCOND):
+        conditions = {
+            opcode.T_Z:     lambda sim, i: sim.z[i],
+            opcode.T_S:     lambda sim, i: sim.s[i],
+            opcode.T_C:     lambda sim, i: sim.c[i],
+            opcode.T_V:     lambda sim, i: sim.v[i],
+            opcode.T_nCoZ:  lambda sim, i: ~sim.c[i] | sim.z[i],
+            opcode.T_SxV:   lambda sim, i: sim.s[i] ^ sim.v[i],
+            opcode.T_SxVoZ: lambda sim, i: (sim.s[i] ^ sim.v[i]) | sim.z[i],
+            opcode.T_A:     lambda sim, i: np.ones(len(i), dtype=bool),
+        }
+        for cond_cls, condition in conditions.items():
+            if issubclass(cls, cond_cls):
+                break
+        flag = issubclass(cls, opcode.M_FL1)
+        def execute(sim, i, pc, rsd, ra, rb, imm):
+            taken = condition(sim, i) == flag
+            sim.pc[i[taken]] = (pc[taken] + imm[taken]) & 0xffff
+        return execute
+
+    if cls is opcode.EXTI:
+        def execute(sim, i, pc, rsd, ra, rb, imm):
+            pass
+        return execute
+
+    raise NotImplementedError(f"No semantics for instruction {cls.__name__}")
+
+_executors = [_semantics(cls) for cls in _classes]
+
+
+class BatchExternalMemory:
+    """External bus backed by 64K words of memory for each instance."""
+    def __init__(self, count, data=()):
+        self.data = np.zeros((count, 0x10000), dtype=np.uint16)
+        self.data[:, :len(data)] = data
+
+    def read(self, i, addr):
+        return self.data[i, addr]
+
+    def write(self, i, addr, data):
+        self.data[i, addr] = data
+
+
+class BatchSimulator:
+    """Instruction set simulator for many instances of the same core running in lockstep.
+
+    The machine state of ``count`` instances is kept in NumPy arrays whose first dimension is
+    the instance index: ``mem`` (64K words each), ``pc``, ``w``, and the flags ``z``, ``s``, ``c``,
+    and ``v``. Every step executes one instruction in each of the running instances; instances
+    whose PC points to instructions of the same class are executed together.
+
+    Accesses to the external bus are forwarded to the ``ext`` object, which must provide
+    ``read(i, addr)`` and ``write(i, addr, data)`` methods, where ``i`` is an array of instance
+    indexes and ``addr`` and ``data`` are arrays of the same size.
+
+    Instances stop running when they encounter an illegal instruction (which also sets
+    the corresponding element of ``illegal``), or when :meth:`run` reaches an address it was
+    requested to stop at.
+    """
+    def __init__(self, count, image=(), *, pc=0, w=0xfff8, ext=None):
+        self.count = count
+        self.mem   = np.zeros((count, 0x10000), dtype=np.uint16)
+        self.mem[:, :len(image)] = image
+        self.ext   = BatchExternalMemory(count) if ext is None else ext
+        self.pc    = np.full(count, pc, dtype=np.int64)
+        self.w     = np.full(count, w & 0xfff8, dtype=np.int64)
+        self.z     = np.zeros(count, dtype=bool)
+        self.s     = np.zeros(count, dtype=bool)
+        self.c     = np.zeros(count, dtype=bool)
+        self.v     = np.zeros(count, dtype=bool)
+        self.instructions = np.zeros(count, dtype=np.int64)
+        self.halted  = np.zeros(count, dtype=bool)
+        self.illegal = np.zeros(count, dtype=bool)
+
+    @property
+    def regs(self):
+        """Contents of the registers R0 to R7 in the current window of each instance."""
+        return self.mem[np.arange(self.count)[:, None], self.w[:, None] + np.arange(8)]
+
+    def step(self, i=None):
+        """Execute one instruction in each of the instances ``i`` (by default, every instance
+        that is not halted)."""
+        if i is None:
+            i = np.nonzero(~self.halted)[0]
+        pc    = self.pc[i]
+        word  = self.mem[i, pc].astype(np.int64)
+        next_word  = self.mem[i, (pc + 1) & 0xffff].astype(np.int64)
+        instr_cls  = _class_table[word]
+        next_cls   = _class_table[next_word]
+        # An EXTI prefix followed by a non-EXTI instruction is executed together with it.
+        fused = (instr_cls == _ext_index) & (next_cls >= 0) & (next_cls != _ext_index)
+        word  = np.where(fused, next_word, word)
+        imm   = np.where(fused, ((self.mem[i, pc] & 0x1fff) << 3 | next_word & 0x7) & 0xffff,
+                         _imm_table[word])
+        instr_cls = np.where(fused, next_cls, instr_cls)
+
+        illegal = instr_cls < 0
+        if illegal.any():
+            self.illegal[i[illegal]] = True
+            self.halted [i[illegal]] = True
+            legal = ~illegal
+            i, pc, word, imm, instr_cls, fused = \
+                i[legal], pc[legal], word[legal], imm[legal], instr_cls[legal], fused[legal]
+
+        pc  = (pc + 1 + fused) & 0xffff
+        rsd = (word >> 8) & 0x7
+        ra  = (word >> 5) & 0x7
+        rb  = word & 0x7
+        self.pc[i] = pc
+        self.instructions[i] += 1
+        for index in np.unique(instr_cls):
+            group = instr_cls == index
+            _executors[index](self, i[group], pc[group], rsd[group], ra[group], rb[group],
+                              imm[group])
+        return i
+
+    def run(self, limit=None, *, until=()):
+        """Execute steps until ``limit`` steps have been executed, or until every instance is
+        halted. Instances that reach one of the addresses in ``until`` are halted. Returns
+        the number of executed steps."""
+        until = np.array(sorted(until), dtype=np.int64)
+        count = 0
+        while (limit is None or count < limit) and not self.halted.all():
+            i = self.step()
+            if len(until):
+                self.halted[i[np.isin(self.pc[i], until)]] = True
+            count += 1
+        return count
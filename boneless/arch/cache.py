@@ -0,0 +1,136 @@
+import os
+import sys
+import mmap
+import array
+
+
+__all__ = ["cache_dir", "enable_cache", "read_cache", "write_cache", "read_entry", "write_entry"]
+
+
+_enabled = False
+
+
+def cache_dir():
+    """Return the directory where data derived from the sources is kept between runs.
+
+    This is ``$BONELESS_CACHE_DIR`` if it is set, and ``boneless`` in the user cache directory
+    (``$XDG_CACHE_HOME`` or ``~/.cache``) otherwise. If ``$BONELESS_CACHE_DIR`` is set to
+    an empty string, nothing is cached, and ``None`` is returned.
+
+    The cache is only written if ``$BONELESS_CACHE_DIR`` is set or :func:`enable_cache` was
+    called, so that merely importing the package does not create any files.
+    """
+    path = os.environ.get("BONELESS_CACHE_DIR")
+    if path is None:
+        path = os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                            os.path.join(os.path.expanduser("~"), ".cache"), "boneless")
+    return path or None
+
+
+def enable_cache():
+    """Allow the cache to be written even if ``$BONELESS_CACHE_DIR`` is not set. The command
+    line tools call this, since they are run many times by builds."""
+    global _enabled
+    _enabled = True
+
+
+def _cache_path(name):
+    path = cache_dir()
+    if path is None:
+        return None
+    # Cached code objects are only valid for the interpreter that created them.
+    return os.path.join(path, f"{name}.{sys.implementation.cache_tag}")
+
+
+def read_cache(name):
+    """Return the contents of the cache file ``name``, or ``None`` if there is no such file."""
+    path = _cache_path(name)
+    if path is None:
+        return None
+    try:
+        with open(path, "rb") as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+def write_cache(name, data):
+    """Replace the contents of the cache file ``name`` with ``data``.
+
+    The file is replaced atomically, so that processes running concurrently never read a partially
+    written file. Errors are ignored, since the cache is only used to speed things up.
+    """
+    if not _enabled and "BONELESS_CACHE_DIR" not in os.environ:
+        return
+    path = _cache_path(name)
+    if path is None:
+        return
+    try:
+        _replace(path, data)
+    except OSError:
+        pass
+
+
+def _replace(path, data):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+# Entries of a cache of words with metadata, such as machine code assembled from a source, kept
+# in a directory given by the user. Each entry is a file named after its key, which contains
+# the number of words, the words in native byte order (so that they can be used right from
+# a memory mapping of the file), and arbitrary metadata. Entries are evicted in least recently
+# used order, where an entry is used when it is read or written, to keep the total size of
+# the entries under a limit.
+
+_ENTRY_SUFFIX = ".entry"
+
+
+def read_entry(directory, key):
+    """Return the words and metadata of the entry ``key`` of the cache in ``directory``, or
+    ``None`` if there is no such entry."""
+    path = os.path.join(directory, key + _ENTRY_SUFFIX)
+    try:
+        with open(path, "rb") as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            count = int.from_bytes(data[:4], "little")
+            if len(data) < 4 + count * 2:
+                return None
+            with memoryview(data) as view, view[4:4 + count * 2].cast("H") as words_view:
+                words = words_view.tolist()
+            metadata = data[4 + count * 2:]
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return words, metadata
+
+
+def write_entry(directory, key, words, metadata, *, max_size):
+    """Store ``words`` (each of which must fit in 16 bits) and ``metadata`` (bytes) as the entry
+    ``key`` of the cache in ``directory``, and evict the least recently used entries until
+    the total size of the entries is at most ``max_size`` bytes. Errors are ignored."""
+    data = len(words).to_bytes(4, "little") + array.array("H", words).tobytes() + metadata
+    try:
+        _replace(os.path.join(directory, key + _ENTRY_SUFFIX), data)
+        entries = []
+        with os.scandir(directory) as iterator:
+            for entry in iterator:
+                if entry.name.endswith(_ENTRY_SUFFIX):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= max_size:
+                break
+            os.unlink(path)
+            total_size -= size
+    except OSError:
+        pass
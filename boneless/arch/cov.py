@@ -0,0 +1,216 @@
+import bisect
+
+from .instr import Instr
+from . import opcode
+
+
+__all__ = ["Coverage", "select"]
+
+
+_SIZE = 0x10000 // 8
+
+
+def _get(bitmap, addr):
+    return bitmap[addr >> 3] >> (addr & 7) & 1
+
+def _set(bitmap, addr):
+    bitmap[addr >> 3] |= 1 << (addr & 7)
+
+
+def _is_branch(instr_cls):
+    return (instr_cls is not None and issubclass(instr_cls, opcode.C_JCOND) and
+            not issubclass(instr_cls, opcode.T_A))
+
+
+def _decode(image, addr):
+    # Class of the instruction at `addr` in `image`, with an EXTI prefix fused like in
+    # the simulator.
+    word = image[addr] if addr < len(image) else 0
+    if word & Instr._ext_mask == Instr._ext_code and addr + 1 < len(image):
+        word = image[addr + 1]
+    return Instr.decodings.get(word)
+
+
+class Coverage:
+    """Instruction and branch coverage.
+
+    Executes code in the simulator ``sim``, and records which addresses were executed, and for
+    every conditional branch (every ``C_JCOND`` instruction other than ``J`` and ``NOP``), whether
+    it was taken and whether it was not taken. Each of these is kept in a bitmap with one bit per
+    address (bit ``addr % 8`` of byte ``addr // 8``) in ``executed``, ``taken``, and
+    ``not_taken``.
+
+    Only the instructions that add coverage are executed one by one, and interpreted rather than
+    translated; the simulator runs at full speed everywhere else, so code that is already covered
+    (by this or by a merged coverage) is executed without slowing down. Coverage from several runs
+    or processes is merged with ``|``, and can be saved and loaded with :meth:`to_bytes` and
+    :meth:`from_bytes`.
+    """
+    def __init__(self, sim=None):
+        self.sim       = sim
+        self.executed  = bytearray(_SIZE)
+        self.taken     = bytearray(_SIZE)
+        self.not_taken = bytearray(_SIZE)
+        # Addresses where execution must stop to record coverage, and the same set (together
+        # with the addresses where `run` must stop) as passed to the simulator.
+        self._stops  = None
+        self._frozen = None
+        self._until  = None
+
+    def _uncovered(self):
+        mem   = self.sim.mem
+        stops = set()
+        for addr in range(0x10000):
+            if not _get(self.executed, addr):
+                stops.add(addr)
+            elif not (_get(self.taken, addr) and _get(self.not_taken, addr)) and \
+                    _is_branch(_decode(mem, addr)):
+                stops.add(addr)
+        return stops
+
+    def run(self, limit=None, *, until=()):
+        """Execute instructions like :meth:`Simulator.run`, and record their coverage. Returns
+        the number of executed instructions."""
+        sim   = self.sim
+        until = frozenset(until)
+        if self._stops is None:
+            self._stops = self._uncovered()
+        stops = self._stops
+        count = 0
+        while limit is None or count < limit:
+            pc = sim.pc
+            if pc in stops:
+                instr_cls, length, *_ = sim.decode(pc)
+                # An instruction that raises an exception (e.g. through a device on the external
+                # bus) is still executed.
+                _set(self.executed, pc)
+                # Executing a single instruction never translates a block, which would take
+                # much longer than interpreting it.
+                count += sim.run(1)
+                if _is_branch(instr_cls):
+                    if sim.pc == (pc + length) & 0xffff:
+                        _set(self.not_taken, pc)
+                    else:
+                        _set(self.taken, pc)
+                if not _is_branch(instr_cls) or \
+                        (_get(self.taken, pc) and _get(self.not_taken, pc)):
+                    stops.discard(pc)
+                    self._frozen = None
+            else:
+                if self._frozen is None or self._until != until:
+                    self._frozen = frozenset(stops | until)
+                    self._until  = until
+                count += sim.run(None if limit is None else limit - count, until=self._frozen)
+            if sim.pc in until:
+                break
+        return count
+
+    def __ior__(self, other):
+        for name in ("executed", "taken", "not_taken"):
+            bitmap = getattr(self, name)
+            bitmap[:] = (int.from_bytes(bitmap, "little") |
+                         int.from_bytes(getattr(other, name), "little")).to_bytes(_SIZE, "little")
+        self._stops = self._frozen = None
+        return self
+
+    def __or__(self, other):
+        result = Coverage()
+        result |= self
+        result |= other
+        return result
+
+    def __eq__(self, other):
+        return isinstance(other, Coverage) and self.to_bytes() == other.to_bytes()
+
+    def to_bytes(self):
+        """Return the bitmaps ``executed``, ``taken``, and ``not_taken``, concatenated."""
+        return bytes(self.executed + self.taken + self.not_taken)
+
+    @classmethod
+    def from_bytes(cls, data, sim=None):
+        """Create coverage for ``sim`` from bitmaps returned by :meth:`to_bytes`."""
+        if len(data) != 3 * _SIZE:
+            raise ValueError(f"Coverage data must be {3 * _SIZE} bytes long, not {len(data)}")
+        coverage = cls(sim)
+        coverage.executed[:]  = data[:_SIZE]
+        coverage.taken[:]     = data[_SIZE:2 * _SIZE]
+        coverage.not_taken[:] = data[2 * _SIZE:]
+        return coverage
+
+    def _status(self, image, addr):
+        # Coverage of one instruction: executed or not, and for branches, the number of
+        # directions taken out of two.
+        executed = _get(self.executed, addr)
+        if not _is_branch(_decode(image, addr)):
+            return executed, None
+        return executed, _get(self.taken, addr) + _get(self.not_taken, addr)
+
+    def table(self, image, locs, labels=None):
+        """Return a table of the instructions executed and the branch directions taken per label,
+        where every address belongs to the closest label before it. The instructions are
+        the addresses in ``locs``, and the labels are taken from ``labels``, as filled in by
+        :meth:`Instr.assemble` for ``image``."""
+        labels  = {} if labels is None else labels
+        by_addr = sorted((addr, name) for name, addr in labels.items())
+        addrs   = [addr for addr, name in by_addr]
+        rows    = {}
+        for addr in sorted(locs):
+            index = bisect.bisect_right(addrs, addr) - 1
+            name  = by_addr[index][1] if index >= 0 else "?"
+            row   = rows.setdefault(name, [0, 0, 0, 0])
+            executed, directions = self._status(image, addr)
+            row[0] += executed
+            row[1] += 1
+            if directions is not None:
+                row[2] += directions
+                row[3] += 2
+        total = [sum(column) for column in zip(*rows.values())] or [0, 0, 0, 0]
+        rows["total"] = total
+
+        def percent(covered, count):
+            return f"{100 * covered / count:>6.2f}" if count else f"{'-':>6}"
+
+        name_width = max(max(len(name) for name in rows), len("label"))
+        lines = [f"{'label':<{name_width}} {'instrs':>13} {'%':>6} {'branches':>13} {'%':>6}\n"]
+        for name, (executed, instrs, directions, branches) in rows.items():
+            lines.append(f"{name:<{name_width}} {f'{executed}/{instrs}':>13} "
+                         f"{percent(executed, instrs)} "
+                         f"{f'{directions}/{branches}':>13} {percent(directions, branches)}\n")
+        return "".join(lines)
+
+    def annotate(self, source, image, locs):
+        """Return ``source``, the assembly text that ``image`` was assembled from, with a column
+        prepended to every line that is ``-`` if its instruction was not executed, ``+`` if it
+        was executed (and for a branch, both taken and not taken), ``T`` or ``N`` if it is
+        a branch that was only taken or only not taken, and blank if it has no instruction.
+        ``locs`` are the locations of the instructions as filled in by :meth:`Instr.assemble`."""
+        marks = {}
+        for addr, loc in locs.items():
+            executed, directions = self._status(image, addr)
+            if not executed:
+                mark = "-"
+            elif directions == 1:
+                mark = "T" if _get(self.taken, addr) else "N"
+            else:
+                mark = "+"
+            marks[loc[0]] = mark
+        return "".join(f"{marks.get(index, ' ')} {line}\n"
+                       for index, line in enumerate(str(source).splitlines()))
+
+
+def select(coverages):
+    """Return the indexes of a subset of ``coverages`` whose union covers everything that all of
+    them together cover, picking the one that adds the most coverage first."""
+    bits = [int.from_bytes(coverage.to_bytes(), "little") for coverage in coverages]
+    covered  = 0
+    selected = []
+    while True:
+        best, gain = None, 0
+        for index, value in enumerate(bits):
+            added = bin(value & ~covered).count("1")
+            if added > gain:
+                best, gain = index, added
+        if best is None:
+            return selected
+        selected.append(best)
+        covered |= bits[best]
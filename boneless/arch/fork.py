@@ -0,0 +1,77 @@
+import os
+import pickle
+import traceback
+
+
+__all__ = ["ForkError", "ForkServer"]
+
+
+class ForkError(Exception):
+    pass
+
+
+class ForkServer:
+    """Runs functions in processes forked from a simulator.
+
+    The state of ``sim`` (and everything else in this process) is shared with every child
+    process copy-on-write, so each of them starts from the same state without executing the code
+    that brought ``sim`` there. At most ``jobs`` child processes (by default, as many as there
+    are CPUs) run at once.
+
+    Requires :func:`os.fork`, which is not available on Windows.
+    """
+    def __init__(self, sim, *, jobs=None):
+        if not hasattr(os, "fork"):
+            raise NotImplementedError("Forking is not supported on this platform")
+        self.sim  = sim
+        self.jobs = os.cpu_count() if jobs is None else jobs
+
+    def _spawn(self, function, item):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            status = 0
+            try:
+                try:
+                    result = ("ok", function(self.sim, item))
+                except Exception:
+                    result = ("error", traceback.format_exc())
+                with os.fdopen(write_fd, "wb") as pipe:
+                    pickle.dump(result, pipe)
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        os.close(write_fd)
+        return pid, read_fd
+
+    def _collect(self, pid, read_fd):
+        with os.fdopen(read_fd, "rb") as pipe:
+            data = pipe.read()
+        _, status = os.waitpid(pid, 0)
+        if not data or status != 0:
+            raise ForkError(f"Child process {pid} exited with status {status}")
+        kind, result = pickle.loads(data)
+        if kind == "error":
+            raise ForkError(f"Child process {pid} raised an exception:\n{result}")
+        return result
+
+    def map(self, function, items):
+        """Call ``function(sim, item)`` for every item of ``items`` in a child process, and
+        yield the results in order. Results must be picklable.
+
+        Raises :class:`ForkError` if the function raises an exception in a child process.
+        """
+        running = []
+        try:
+            for item in items:
+                if len(running) == self.jobs:
+                    yield self._collect(*running.pop(0))
+                running.append(self._spawn(function, item))
+            while running:
+                yield self._collect(*running.pop(0))
+        finally:
+            for pid, read_fd in running:
+                os.close(read_fd)
+                os.waitpid(pid, 0)
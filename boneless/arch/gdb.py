@@ -0,0 +1,373 @@
+import select
+import socket
+
+from .sim import SimulationError
+
+
+__all__ = ["GDBStub"]
+
+
+# Register and memory layout
+# --------------------------
+#
+# GDB addresses memory in bytes, and Boneless in 16-bit words. Every word is presented to GDB as
+# two bytes in little-endian order, so the word at address `n` is at byte address `2 * n`. PC and
+# W are presented as byte addresses as well (and are 32 bits wide to fit them), so that e.g.
+# `x/8hx $w` shows the register window. Breakpoint and watchpoint addresses are byte addresses.
+
+_TARGET_XML = """\
+<?xml version="1.0"?>
+<!DOCTYPE target SYSTEM "gdb-target.dtd">
+<target version="1.0">
+  <feature name="org.boneless.core">
+    <reg name="r0" bitsize="16" type="uint16" regnum="0"/>
+    <reg name="r1" bitsize="16" type="uint16"/>
+    <reg name="r2" bitsize="16" type="uint16"/>
+    <reg name="r3" bitsize="16" type="uint16"/>
+    <reg name="r4" bitsize="16" type="uint16"/>
+    <reg name="r5" bitsize="16" type="uint16"/>
+    <reg name="r6" bitsize="16" type="uint16"/>
+    <reg name="r7" bitsize="16" type="uint16"/>
+    <reg name="pc" bitsize="32" type="code_ptr"/>
+    <reg name="w" bitsize="32" type="data_ptr"/>
+    <reg name="flags" bitsize="16" type="uint16"/>
+  </feature>
+</target>
+"""
+
+# Width in bytes of every register, in the order of `_TARGET_XML`.
+_REGS = (2,) * 8 + (4, 4, 2)
+
+_SIGINT  = 2
+_SIGILL  = 4
+_SIGTRAP = 5
+
+
+def _checksum(data):
+    return sum(data) & 0xff
+
+def _escape(data):
+    for char in b"}#$*":
+        data = data.replace(bytes([char]), bytes([0x7d, char ^ 0x20]))
+    return data
+
+def _to_hex(value, width):
+    return value.to_bytes(width, "little").hex()
+
+def _from_hex(data):
+    return int.from_bytes(bytes.fromhex(data), "little")
+
+
+class _Watchpoint(Exception):
+    pass
+
+
+class GDBStub:
+    """GDB remote serial protocol stub.
+
+    Exposes the simulator ``sim`` to GDB (or any other client of the remote serial protocol),
+    with register and memory access, single-stepping, breakpoints, and write watchpoints. Software
+    and hardware breakpoints are the same, and do not modify memory. When continuing, the
+    simulator runs at full speed in slices of ``quantum`` instructions, between which the client
+    is checked for an interrupt request.
+
+    Breakpoints are passed to :meth:`Simulator.run` as its ``until`` argument, and watchpoints
+    are added to the bitmap of words that stores are already checked against for invalidating
+    predecoded instructions, so neither slows down execution. A watchpoint hit is reported after
+    the instruction that triggered it; a watchpoint on a register updated by a counting loop is
+    only reported once the loop has been fast-forwarded.
+
+    If ``history`` is a :class:`History` of ``sim``, instructions are executed through it, and
+    reverse stepping and continuing are supported as well. Registers and memory changed by
+    the client are not recorded in the history, and are lost when moving backwards past them.
+    """
+    def __init__(self, sim, *, quantum=100000, history=None):
+        self.sim     = sim
+        self.quantum = quantum
+        self.history = history
+        self.breakpoints = set()
+        self.watchpoints = bytearray(0x10000)
+
+        self._conn   = None
+        self._buffer = b""
+        self._ack    = True
+
+    # Execution
+
+    def _store(self, addr, data):
+        sim = self.sim
+        sim.mem[addr] = data
+        if sim._watch[addr]:
+            sim._invalidate(addr)
+
+    def _stop_reason(self, signal, watch=None):
+        if watch is None:
+            return f"S{signal:02x}"
+        return f"T{signal:02x}watch:{watch * 2:x};"
+
+    def step(self):
+        """Execute one instruction, and return a stop reply."""
+        # A single instruction is interpreted, never translated, so stepping stays fast.
+        try:
+            (self.history or self.sim).step()
+        except SimulationError:
+            return self._stop_reason(_SIGILL)
+        return self._stop_reason(_SIGTRAP)
+
+    def resume(self, interrupted=lambda: False):
+        """Execute instructions until a breakpoint or a watchpoint is hit, or ``interrupted()``
+        returns true, and return a stop reply."""
+        sim = self.sim
+        if 1 not in self.watchpoints:
+            return self._resume(interrupted)
+
+        # A store to a watched word calls `_invalidate`, which discards every predecoded
+        # instruction and translated block, so that the next instruction is decoded anew and
+        # stops the simulator before it is executed.
+        invalidate, translate, predecode = sim._invalidate, sim._translate, sim._predecode
+        watch, watchpoints = sim._watch, self.watchpoints
+        hits = []
+        def watch_store(addr):
+            invalidate(addr)
+            if watchpoints[addr] and not hits:
+                hits.append(addr)
+                sim.flush()
+            watch[addr] |= watchpoints[addr]
+        def check_translate(pc):
+            if hits:
+                raise _Watchpoint
+            return translate(pc)
+        def check_predecode(pc):
+            if hits:
+                raise _Watchpoint
+            return predecode(pc)
+        addr = watchpoints.find(1)
+        while addr != -1:
+            watch[addr] = 1
+            addr = watchpoints.find(1, addr + 1)
+        sim._invalidate, sim._translate, sim._predecode = \
+            watch_store, check_translate, check_predecode
+        try:
+            reply = self._resume(lambda: hits or interrupted())
+        except _Watchpoint:
+            reply = None
+        finally:
+            del sim._invalidate, sim._translate, sim._predecode
+        if hits:
+            return self._stop_reason(_SIGTRAP, watch=hits[0])
+        return reply
+
+    def _resume(self, interrupted):
+        sim = self.sim
+        while True:
+            try:
+                (self.history or sim).run(self.quantum, until=self.breakpoints)
+            except SimulationError:
+                return self._stop_reason(_SIGILL)
+            if sim.pc in self.breakpoints:
+                return self._stop_reason(_SIGTRAP)
+            if interrupted():
+                return self._stop_reason(_SIGINT)
+
+    # Packets
+
+    def _read_regs(self):
+        sim = self.sim
+        flags = sim.z | sim.s << 1 | sim.c << 2 | sim.v << 3
+        values = [*sim.regs, sim.pc * 2, sim.w * 2, flags]
+        return "".join(_to_hex(value, width) for value, width in zip(values, _REGS))
+
+    def _write_reg(self, index, value):
+        sim = self.sim
+        if index < 8:
+            self._store(sim.w + index, value & 0xffff)
+        elif index == 8:
+            sim.pc = (value >> 1) & 0xffff
+        elif index == 9:
+            sim.w = (value >> 1) & 0xfff8
+        elif index == 10:
+            sim.z, sim.s, sim.c, sim.v = (bool(value & (1 << bit)) for bit in range(4))
+        else:
+            raise IndexError(index)
+
+    def _read_mem(self, addr, length):
+        mem  = self.sim.mem
+        data = bytearray()
+        for byte_addr in range(addr, addr + length):
+            data.append(mem[(byte_addr >> 1) & 0xffff] >> 8 * (byte_addr & 1) & 0xff)
+        return data.hex()
+
+    def _write_mem(self, addr, data):
+        mem = self.sim.mem
+        for offset, byte in enumerate(data):
+            byte_addr = addr + offset
+            word_addr = (byte_addr >> 1) & 0xffff
+            shift = 8 * (byte_addr & 1)
+            self._store(word_addr, mem[word_addr] & ~(0xff << shift) | byte << shift)
+
+    def _point(self, kind, addr, insert):
+        addr = (addr >> 1) & 0xffff
+        if kind in ("0", "1"):
+            if insert:
+                self.breakpoints.add(addr)
+            else:
+                self.breakpoints.discard(addr)
+        elif kind == "2":
+            self.watchpoints[addr] = insert
+        else:
+            return ""
+        return "OK"
+
+    def handle(self, packet, interrupted=lambda: False):
+        """Handle a packet (without framing) from the client, and return the reply packet, or
+        ``None`` if the session is over. Continuing checks ``interrupted()`` for an interrupt
+        request from the client."""
+        command, args = packet[:1], packet[1:]
+        try:
+            if packet == "?":
+                return self._stop_reason(_SIGTRAP)
+            elif command == "g":
+                return self._read_regs()
+            elif command == "G":
+                offset = 0
+                for index, width in enumerate(_REGS):
+                    self._write_reg(index, _from_hex(args[offset:offset + width * 2]))
+                    offset += width * 2
+                return "OK"
+            elif command == "p":
+                index = int(args, 16)
+                if index >= len(_REGS):
+                    return "E01"
+                return self._read_regs()[sum(_REGS[:index]) * 2:sum(_REGS[:index + 1]) * 2]
+            elif command == "P":
+                index, value = args.split("=")
+                self._write_reg(int(index, 16), _from_hex(value))
+                return "OK"
+            elif command == "m":
+                addr, length = args.split(",")
+                return self._read_mem(int(addr, 16), int(length, 16))
+            elif command == "M":
+                location, data = args.split(":")
+                addr, _ = location.split(",")
+                self._write_mem(int(addr, 16), bytes.fromhex(data))
+                return "OK"
+            elif command in ("s", "c"):
+                if args:
+                    self.sim.pc = (int(args, 16) >> 1) & 0xffff
+                if command == "s":
+                    return self.step()
+                return self.resume(interrupted)
+            elif packet in ("bs", "bc") and self.history is not None:
+                if packet == "bs":
+                    found = self.history.reverse_step() == 1
+                else:
+                    found = self.history.reverse_continue(self.breakpoints)
+                if not found:
+                    return f"T{_SIGTRAP:02x}replaylog:begin;"
+                return self._stop_reason(_SIGTRAP)
+            elif command in ("Z", "z"):
+                kind, addr, _ = args.split(",")
+                return self._point(kind, int(addr, 16), insert=command == "Z")
+            elif command in ("k", "D"):
+                return None
+            elif command == "H":
+                return "OK"
+            elif packet.startswith("qSupported"):
+                features = "PacketSize=4000;qXfer:features:read+;QStartNoAckMode+"
+                if self.history is not None:
+                    features += ";ReverseStep+;ReverseContinue+"
+                return features
+            elif packet == "QStartNoAckMode":
+                self._ack = False
+                return "OK"
+            elif packet.startswith("qXfer:features:read:target.xml:"):
+                offset, length = (int(arg, 16) for arg in packet.split(":")[-1].split(","))
+                chunk = _TARGET_XML[offset:offset + length]
+                return ("l" if offset + length >= len(_TARGET_XML) else "m") + chunk
+            elif packet == "qAttached":
+                return "1"
+            elif packet == "qC":
+                return "QC1"
+            elif packet == "qfThreadInfo":
+                return "m1"
+            elif packet == "qsThreadInfo":
+                return "l"
+            else:
+                return ""
+        except (ValueError, IndexError):
+            return "E01"
+
+    # Connection
+
+    def _recv(self):
+        data = self._conn.recv(4096)
+        if not data:
+            raise EOFError
+        self._buffer += data
+
+    def _read_packet(self):
+        while True:
+            # Acknowledgements are not checked, since the transport is reliable; an interrupt
+            # request received while stopped is answered with a stop reply.
+            while self._buffer[:1] in (b"+", b"-", b"\x03"):
+                if self._buffer[:1] == b"\x03":
+                    self._buffer = self._buffer[1:]
+                    return "?"
+                self._buffer = self._buffer[1:]
+            end = self._buffer.find(b"#")
+            if self._buffer[:1] == b"$" and end != -1 and len(self._buffer) >= end + 3:
+                data, checksum = self._buffer[1:end], self._buffer[end + 1:end + 3]
+                self._buffer = self._buffer[end + 3:]
+                if self._ack:
+                    if int(checksum, 16) != _checksum(data):
+                        self._conn.sendall(b"-")
+                        continue
+                    self._conn.sendall(b"+")
+                return data.decode("latin-1")
+            if self._buffer and self._buffer[:1] != b"$":
+                # Discard noise between packets.
+                self._buffer = self._buffer[1:]
+                continue
+            self._recv()
+
+    def _write_packet(self, reply):
+        data = _escape(reply.encode("latin-1"))
+        self._conn.sendall(b"$" + data + b"#" + f"{_checksum(data):02x}".encode())
+
+    def _interrupted(self):
+        if b"\x03" in self._buffer:
+            self._buffer = self._buffer.replace(b"\x03", b"", 1)
+            return True
+        readable, _, _ = select.select([self._conn], [], [], 0)
+        if readable:
+            self._recv()
+            return self._interrupted()
+        return False
+
+    def serve(self, conn):
+        """Serve one client connected through the socket ``conn``, until it detaches, kills
+        the target, or disconnects."""
+        self._conn   = conn
+        self._buffer = b""
+        self._ack    = True
+        try:
+            while True:
+                packet = self._read_packet()
+                reply  = self.handle(packet, self._interrupted)
+                if reply is None:
+                    if packet[:1] == "D":
+                        self._write_packet("OK")
+                    break
+                self._write_packet(reply)
+        except (EOFError, ConnectionError):
+            pass
+        finally:
+            self._conn = None
+
+    def listen(self, host="127.0.0.1", port=1234):
+        """Accept one client on the TCP ``port`` at ``host``, and serve it."""
+        with socket.create_server((host, port)) as server:
+            conn, _ = server.accept()
+            with conn:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.serve(conn)
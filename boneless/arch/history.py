@@ -0,0 +1,213 @@
+import array
+import bisect
+import time
+from collections import namedtuple
+
+
+__all__ = ["History"]
+
+
+_Checkpoint = namedtuple("_Checkpoint", ("position", "blob", "cursor"))
+
+
+class _ReplayBus:
+    # Forwards accesses to the external bus of a simulator and logs the data read and the wait
+    # states of every access, or, when re-executing instructions that were already executed,
+    # replays them from the log without accessing the external bus. It provides no `next_event`,
+    # because polling loops would be fast-forwarded differently depending on `limit`, and make
+    # a different number of accesses; and no `snapshot`, because the devices are never rewound.
+    def __init__(self, history):
+        self.history = history
+
+    def read(self, addr):
+        history = self.history
+        sim   = history.sim
+        index = history._cursor - history._base
+        if index < len(history._data):
+            data = history._data[index]
+            sim.cycles += history._spent[index]
+        else:
+            cycles = sim.cycles
+            data   = history._ext.read(addr)
+            history._data.append(data)
+            history._spent.append(sim.cycles - cycles)
+        history._cursor += 1
+        return data
+
+    def write(self, addr, data):
+        history = self.history
+        sim   = history.sim
+        index = history._cursor - history._base
+        if index < len(history._data):
+            sim.cycles += history._spent[index]
+        else:
+            cycles = sim.cycles
+            history._ext.write(addr, data)
+            history._data.append(0)
+            history._spent.append(sim.cycles - cycles)
+        history._cursor += 1
+
+
+class History:
+    """Execution history with reverse execution.
+
+    Executes code in the simulator ``sim`` like :meth:`Simulator.run`, taking periodic snapshots
+    (checkpoints) and logging every external bus access, so that the simulator can be moved
+    to any earlier point in the execution by restoring a checkpoint and deterministically
+    replaying the instructions after it, with the data read from the external bus taken from
+    the log. Devices on the external bus are never accessed when instructions are replayed.
+
+    Points in the execution are identified by ``sim.instructions``. The interval between
+    checkpoints is adjusted to the measured speed of the simulator so that moving to any point
+    (and therefore :meth:`reverse_step`) takes no more than approximately ``latency`` seconds.
+    Once the checkpoints and the log take more than ``memory`` bytes, the oldest checkpoints are
+    discarded, and the points before the oldest remaining one can no longer be reached.
+
+    Polling loops are not fast-forwarded while the history is recorded, and external bus
+    accesses that return awaitables are not supported.
+    """
+    def __init__(self, sim, *, latency=0.1, memory=256 << 20):
+        self.sim     = sim
+        self.latency = latency
+        self.memory  = memory
+        # Instructions per checkpoint; adjusted as the speed of the simulator is measured.
+        self.interval = 10000
+
+        self._ext    = sim.ext
+        self._bus    = _ReplayBus(self)
+        # The log of external bus accesses. Entry `index` of the log is at `_base + index`,
+        # the entry used by the next access is at `_cursor`.
+        self._data   = array.array("H")
+        self._spent  = array.array("L")
+        self._base   = 0
+        self._cursor = 0
+        self._checkpoints = []
+        self._end    = sim.instructions
+        self._rate   = None
+        self._checkpoint()
+
+    @property
+    def start(self):
+        """Earliest point in the execution that can be moved to."""
+        return self._checkpoints[0].position
+
+    @property
+    def end(self):
+        """Latest point in the execution that has been reached."""
+        return self._end
+
+    def _run(self, limit, until):
+        sim = self.sim
+        sim.ext = self._bus
+        try:
+            return sim.run(limit, until=until)
+        finally:
+            sim.ext = self._ext
+            self._end = max(self._end, sim.instructions)
+
+    def _checkpoint(self):
+        sim = self.sim
+        sim.ext = self._bus
+        try:
+            blob = sim.snapshot()
+        finally:
+            sim.ext = self._ext
+        self._checkpoints.append(_Checkpoint(sim.instructions, blob, self._cursor))
+
+        # Discard the oldest checkpoints, and the part of the log before the new oldest one,
+        # until the rest fits into the memory limit.
+        size = sum(len(checkpoint.blob) for checkpoint in self._checkpoints) + \
+               len(self._data) * (self._data.itemsize + self._spent.itemsize)
+        while size > self.memory and len(self._checkpoints) > 1:
+            discarded = self._checkpoints.pop(0)
+            count = self._checkpoints[0].cursor - self._base
+            size -= len(discarded.blob) + count * (self._data.itemsize + self._spent.itemsize)
+            del self._data[:count]
+            del self._spent[:count]
+            self._base += count
+
+    def _measure(self, executed, elapsed):
+        if executed < 1000 or elapsed <= 0:
+            return
+        rate = executed / elapsed
+        self._rate = rate if self._rate is None else (self._rate + rate) / 2
+        self.interval = max(1000, int(self._rate * self.latency))
+
+    def run(self, limit=None, *, until=()):
+        """Execute instructions like :meth:`Simulator.run`. Instructions before :attr:`end`
+        are replayed, and the rest are recorded. Returns the number of executed instructions."""
+        sim   = self.sim
+        until = frozenset(until)
+        count = 0
+        while limit is None or count < limit:
+            position = sim.instructions
+            if position < self._end:
+                budget = self._end - position
+            else:
+                budget = self._checkpoints[-1].position + self.interval - position
+            if limit is not None:
+                budget = min(budget, limit - count)
+            started  = time.perf_counter()
+            executed = self._run(max(budget, 1), until)
+            self._measure(executed, time.perf_counter() - started)
+            count += executed
+            if sim.instructions == self._end and \
+                    sim.instructions >= self._checkpoints[-1].position + self.interval:
+                self._checkpoint()
+            if sim.pc in until:
+                break
+        return count
+
+    def step(self):
+        """Execute one instruction."""
+        return self.run(1)
+
+    def goto(self, position):
+        """Move to the point in the execution after ``position`` instructions were executed,
+        replaying instructions from the nearest checkpoint before it, or executing them if
+        ``position`` is after :attr:`end`."""
+        sim = self.sim
+        if position < self.start:
+            raise ValueError(f"Position {position} is before the earliest checkpoint at "
+                             f"{self.start}")
+        positions = [checkpoint.position for checkpoint in self._checkpoints]
+        checkpoint = self._checkpoints[bisect.bisect_right(positions, position) - 1]
+        if not checkpoint.position <= sim.instructions <= position:
+            sim.restore(checkpoint.blob)
+            self._cursor = checkpoint.cursor
+        while sim.instructions < position:
+            self.run(position - sim.instructions)
+
+    def reverse_step(self, count=1):
+        """Move ``count`` instructions back, or to :attr:`start`. Returns the number of
+        instructions moved back."""
+        target = max(self.sim.instructions - count, self.start)
+        moved  = self.sim.instructions - target
+        self.goto(target)
+        return moved
+
+    def reverse_continue(self, until):
+        """Move back to the latest earlier point where the program counter was one of
+        the addresses in ``until``, or to :attr:`start` if there is none. Returns ``True``
+        if such a point was found."""
+        sim   = self.sim
+        until = frozenset(until)
+        end   = sim.instructions
+        for checkpoint in reversed(self._checkpoints):
+            if checkpoint.position >= end:
+                continue
+            # Replay the instructions between the checkpoint and the end of the search, and find
+            # the last point where execution would stop.
+            sim.restore(checkpoint.blob)
+            self._cursor = checkpoint.cursor
+            found = checkpoint.position if sim.pc in until else None
+            while sim.instructions < end:
+                self._run(end - sim.instructions, until)
+                if sim.instructions < end and sim.pc in until:
+                    found = sim.instructions
+            if found is not None:
+                self.goto(found)
+                return True
+            end = checkpoint.position
+        self.goto(self.start)
+        return False
@@ -1,9 +1,15 @@
 import abc
 import re
+import types
+import atexit
+import marshal
 import textwrap
+import functools
 from parse import parse
 from string import Formatter
 
+from .cache import read_cache, write_cache
+
 
 __all__ = ["UnresolvedRef", "Label", "Operand", "Instr"]
 
@@ -25,11 +31,70 @@ class Label:
         return isinstance(other, Label) and self.name == other.name
 
 
+# The same numbers as the `d` type of `parse`: decimal, or binary, octal, or hexadecimal with
+# a prefix, with an optional sign (where a space stands for `+`).
+_INT_PATTERN = r"[-+ ]?[0-9]+|[-+ ]?0[xX][0-9a-fA-F]+|[-+ ]?0[bB][01]+|[-+ ]?0[oO][0-7]+"
+
+def _int_from_str(input):
+    sign, digits = (-1 if input[0] == "-" else 1), input.lstrip("-+ ")
+    if len(digits) > 2 and digits[0] == "0" and digits[1] in "bBoOxX":
+        return sign * int(digits, 0)
+    return sign * int(digits, 10)
+
+
+# Compiling the code generated for instruction classes takes most of the time it takes to define
+# an instruction set, so the compiled code is kept on disk between runs, separately for every
+# module that defines instructions. It is looked up by its source, which changes whenever
+# the definition of an instruction (or the generator) does, and only the code that was used in
+# the last run is kept. Unless writing the cache was opted into (see `cache.write_cache`), the code
+# is only kept in memory.
+_code_caches = {}
+
+def _compile_cached(module, source):
+    if module not in _code_caches:
+        try:
+            loaded = marshal.loads(read_cache(f"instr-{module}") or marshal.dumps({}))
+            if not isinstance(loaded, dict):
+                loaded = {}
+        except (EOFError, ValueError, TypeError):
+            loaded = {}
+        _code_caches[module] = (loaded, {})
+        atexit.register(_save_code_cache, module)
+    loaded, used = _code_caches[module]
+    code = loaded.get(source)
+    if not isinstance(code, types.CodeType):
+        code = compile(source, "<string>", "exec")
+    used[source] = code
+    return code
+
+def _save_code_cache(module):
+    loaded, used = _code_caches[module]
+    if used.keys() != loaded.keys():
+        write_cache(f"instr-{module}", marshal.dumps(used))
+
+
 class OperandMeta(abc.ABCMeta):
     def __new__(metacls, name, bases, namespace):
         if "__slots__" not in namespace:
             namespace["__slots__"] = []
 
+        # Compile the format into a regular expression that matches it the same way as `parse`
+        # does (ignoring case), if it only has integer fields; `parse` is slow to call for every
+        # operand of every instruction.
+        format = namespace.get("format")
+        if isinstance(format, str):
+            pattern = ""
+            for literal, field, spec, _ in Formatter().parse(format):
+                pattern += re.escape(literal)
+                if field is None:
+                    continue
+                if field != "" or spec != "d":
+                    pattern = None
+                    break
+                pattern += f"({_INT_PATTERN})"
+            namespace["_format_re"] = None if pattern is None else \
+                re.compile(f"^{pattern}$", re.I | re.S)
+
         return super().__new__(metacls, name, bases, namespace)
 
 
@@ -39,6 +104,8 @@ class Operand(metaclass=OperandMeta):
     format  = abc.abstractproperty()
     prepare = abc.abstractproperty()
 
+    _format_re = None
+
     def __init__(self, value, *, explicit=True):
         if isinstance(value, type(self)):
             self.value = value.value
@@ -50,7 +117,13 @@ class Operand(metaclass=OperandMeta):
 
     @classmethod
     def from_str(cls, input):
-        parsed = parse(cls.format, input)
+        if cls._format_re is not None:
+            match = cls._format_re.match(input)
+            if match is not None:
+                return cls(*map(_int_from_str, match.groups()))
+            parsed = None
+        else:
+            parsed = parse(cls.format, input)
         if parsed is None:
             raise ValueError(f"Illegal operand {repr(input)}; expected {repr(cls.format)}")
         return cls(*parsed.fixed, **parsed.named)
@@ -123,11 +196,17 @@ class InstrMeta(abc.ABCMeta):
                                          for (_, field, format, _) in field_formats}
             namespace["_field_format"] = "".join("{}{{{}}}".format(literal, field)
                                                  for (literal, field, _, _) in field_formats)
+            # Operands are matched the same way as `parse` matches the format (every field is
+            # non-greedy, and case is ignored), and converted with the `from_str` method of
+            # their types.
+            operand_fields = [field for (_, field, _, _) in field_formats if field is not None]
+            namespace["_operands_re"] = re.compile("^{}$".format("".join(
+                re.escape(literal) + ("(.+?)" if field is not None else "")
+                for (literal, field, _, _) in field_formats)), re.I | re.S)
 
             code = ""
 
             instr_code   = int(re.sub(r"[^01]", "0", coding), 2)
-            instr_mask   = int(re.sub(r"[^01]", "0", coding.replace("0", "1")), 2)
             operand_mask = int(re.sub(r"[^01]", "1", coding.replace("1", "0")), 2)
 
             fields = {}
@@ -168,6 +247,15 @@ class InstrMeta(abc.ABCMeta):
                     ", ".join(f"{field}=self._{field}"
                               for field in fields)})}}"
 
+            @classmethod
+            def _parse_operands(cls, input):
+                match = cls._operands_re.match(input)
+                if match is None:
+                    return None
+                return {{{", ".join(f"{repr(field)}: cls._field_types[{repr(field)}]"
+                                    f".from_str(match[{index + 1}])"
+                                    for index, field in enumerate(operand_fields))}}}
+
             @classmethod
             def _from_int(cls, input):
                 return cls({", ".join(f"{field}=cls._field_types[{repr(field)}]"
@@ -201,29 +289,28 @@ class InstrMeta(abc.ABCMeta):
             #     and `getattr()` is definitely possible, but way too slow on CPython.
             #  3. It would also be harder to read and understand. (Not that this approach is very
             #     easy to understand either, but it is -easier-. Relatively speaking.)
-            exec(code, globals(), namespace)
+            exec(_compile_cached(namespace["__module__"], code), globals(), namespace)
 
             # Create the instruction class and register mnemonics as well as opcodes in global
             # lookup tables, to speed up assembly/disassembly.
             cls = super().__new__(metacls, instr_name, bases, namespace)
             instr_base.mnemonics[instr_name.upper()] = cls
             if not alias:
-                operand_code = 0
-                while True:
-                    instr_opcode = instr_code | operand_code
-                    if instr_opcode in instr_base.decodings:
-                        raise ValueError(
-                            "Encoding {:0{}b} of instruction {} conflicts with instruction {}"
-                            .format(instr_opcode, len(coding), instr_name,
-                                    instr_base.decodings[instr_opcode].__name__))
-                    instr_base.decodings[instr_code | operand_code] = cls
-                    if operand_code == operand_mask:
-                        break
-                    # The following line cleverly uses carries to make a counter only from the bits
-                    # that are set in `operand_mask`. To understand it, consider that `instr_mask`
-                    # is the inverse of `operand_mask`, and adding 1 to a 011...1 chunk changes it
-                    # into a 100...0 chunk.
-                    operand_code = ((operand_code | instr_mask) + 1) & operand_mask
+                # Enumerate the opcodes in ascending order by doubling the list for every bit that
+                # is set in `operand_mask`, starting from the least significant one. This way,
+                # the lookup table is filled by builtins rather than one opcode at a time.
+                instr_opcodes = [instr_code]
+                for bit in range(len(coding)):
+                    if operand_mask & (1 << bit):
+                        instr_opcodes += [opcode | (1 << bit) for opcode in instr_opcodes]
+                if not instr_base.decodings.keys().isdisjoint(instr_opcodes):
+                    instr_opcode = next(opcode for opcode in instr_opcodes
+                                        if opcode in instr_base.decodings)
+                    raise ValueError(
+                        "Encoding {:0{}b} of instruction {} conflicts with instruction {}"
+                        .format(instr_opcode, len(coding), instr_name,
+                                instr_base.decodings[instr_opcode].__name__))
+                instr_base.decodings.update(dict.fromkeys(instr_opcodes, cls))
             return cls
 
         else:
@@ -237,7 +324,6 @@ class Instr(metaclass=InstrMeta):
     # ISA-wide properties
     abbrevs    = None
     formats    = None
-    _parsers   = None
     mnemonics  = None
     decodings  = None
     # Per-instruction properties
@@ -249,6 +335,16 @@ class Instr(metaclass=InstrMeta):
     @classmethod
     def from_str(cls, input):
         """Unpack an instruction from text code."""
+        instr_cls, operands = cls._parse(input)
+        return instr_cls(**operands)
+
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def _parse(cls, input):
+        # Generated code often repeats the same lines, so the instruction class and operands
+        # of the most recently parsed ones are kept. A new instruction is created from them
+        # every time, since instructions are mutable.
+        #
         # First, canonicalize the whitespace.
         input = re.sub(r"\s*(,)\s*|\s+", r"\1 ", input)
         parts = input.split(maxsplit=1)
@@ -260,11 +356,8 @@ class Instr(metaclass=InstrMeta):
         instr_cls = cls.mnemonics.get(mnemonic.upper())
         if instr_cls is None:
             raise ValueError(f"Unknown mnemonic '{mnemonic}'")
-        if cls._parsers is None:
-            cls._parsers = {format: operand_cls.from_str
-                            for format, operand_cls in cls.formats.items()}
         try:
-            parsed = parse(instr_cls.operands, operands, cls._parsers)
+            parsed = instr_cls._parse_operands(operands)
             error  = None
         except ValueError as e:
             parsed = None
@@ -273,7 +366,7 @@ class Instr(metaclass=InstrMeta):
             raise ValueError(f"Illegal operands {repr(operands)} for instruction "
                              f"{instr_cls.__name__}; "
                              f"expected {repr(instr_cls.operands)}") from error
-        return instr_cls(*parsed.fixed, **parsed.named)
+        return instr_cls, parsed
 
     @classmethod
     def from_int(cls, input):
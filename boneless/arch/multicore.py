@@ -0,0 +1,168 @@
+import io
+import array
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+
+from .sim import SimulationError, Device, ExternalMemory, ExternalBus, Simulator
+from .semihost import SemihostExit, Semihost
+from .runner import load_image, _summary
+
+
+__all__ = ["SharedSegment", "run_multicore"]
+
+
+class SharedSegment(Device):
+    """External bus device backed by memory shared between several cores.
+
+    ``data`` is a mutable sequence of words, e.g. a list if all of the cores are simulated in
+    one process, or a ``memoryview`` of a :class:`multiprocessing.shared_memory.SharedMemory`
+    block with the format ``"H"`` otherwise. If ``volatile`` is true, the cores are running
+    concurrently and may write to the segment at any cycle, so polling loops reading from it are
+    never fast-forwarded.
+    """
+    def __init__(self, data, *, volatile=False):
+        self.data     = data
+        self.volatile = volatile
+
+    def read(self, offset):
+        return self.data[offset]
+
+    def write(self, offset, data):
+        self.data[offset] = data
+
+    def next_event(self, cycles):
+        return cycles + 1 if self.volatile else None
+
+
+class _Core:
+    # One core of a multi-core system, with private main memory, private external memory below
+    # the shared segment at `base`, and a semihosting port at 0xfff8 whose output is buffered.
+    def __init__(self, index, image, segment, base, *, root=None):
+        bus = ExternalBus()
+        self.sim = Simulator(image, ext=bus)
+        bus.sim  = self.sim
+        self.sim.mem[self.sim.w] = index
+        self.memory = ExternalMemory()
+        if base > 0:
+            bus.add(self.memory, 0, base)
+        bus.add(segment, base, len(segment.data))
+        self.output   = io.BytesIO()
+        self.semihost = bus.add(Semihost(self.sim, stdin=io.BytesIO(), stdout=self.output,
+                                         stderr=self.output, root=root),
+                                0xfff8, Semihost.size)
+        self.result   = None
+
+    def step(self, quantum, limit):
+        # Execute up to `quantum` instructions (or all of them, if `None`), and return whether
+        # the core is still running.
+        sim = self.sim
+        if limit is not None:
+            if sim.cycles >= limit:
+                self.result = {"status": None}
+                return False
+            budget  = max((limit - sim.cycles) // 20, 1)
+            quantum = budget if quantum is None else min(quantum, budget)
+        try:
+            sim.run(quantum)
+        except SemihostExit as exit:
+            self.result = {"status": exit.status}
+        except SimulationError as error:
+            self.result = {"status": None, "error": str(error)}
+        else:
+            return True
+        return False
+
+    def finish(self):
+        self.semihost.close()
+        result = dict(self.result or {"status": None})
+        result.update(_summary(self.sim, self.memory.data))
+        result["output"] = self.output.getvalue().decode("utf-8", "replace")
+        return result
+
+
+def _run_process(conn, index, image, block, base, size, limit, root):
+    data = block.buf.cast("H")[:size]
+    try:
+        core = _Core(index, image, SharedSegment(data, volatile=True), base, root=root)
+        while core.step(None, limit):
+            pass
+        result = core.finish()
+    except Exception:
+        result = {"status": None, "error": traceback.format_exc()}
+    finally:
+        data.release()
+    conn.send(result)
+    conn.close()
+
+
+def run_multicore(images, *, base=0x8000, size=0x1000, shared=(), mode="round-robin",
+                  quantum=1000, limit=None, root=None):
+    """Execute a multi-core system with one core per image in ``images`` (sequences of words,
+    or paths of image files), whose cores share a segment of ``size`` words of memory mapped at
+    external address ``base`` and initialized with ``shared``.
+
+    Every core has its own main memory, its own external memory below ``base``, and its own
+    semihosting port (as in :func:`run_image`, with the directory ``root``) at external address
+    ``0xfff8``. At reset, ``R0`` holds the index of the core, so several cores can execute
+    the same image. Each core runs until its firmware exits, it executes an illegal
+    instruction, or ``limit`` cycles have passed.
+
+    If ``mode`` is ``"round-robin"``, the cores take turns executing ``quantum`` instructions,
+    which makes the execution deterministic; as only one core runs at a time, they are all
+    simulated in this process. If ``mode`` is ``"free-running"``, every core is simulated in its
+    own process, and the segment is kept in a :class:`multiprocessing.shared_memory.SharedMemory`
+    block; the cores are not synchronized with each other in any way, so the order of their
+    accesses to the segment depends on the host.
+
+    Returns ``(results, shared)``, where ``results`` has a result for every core as in
+    :func:`run_job`, and ``shared`` is the final contents of the segment.
+    """
+    if mode not in ("round-robin", "free-running"):
+        raise ValueError(f"Mode must be 'round-robin' or 'free-running', not {mode!r}")
+    if base < 0 or size <= 0 or base + size > 0xfff8:
+        raise ValueError(f"Shared segment {base:#06x}+{size:#x} is invalid")
+    images = [load_image(image) if isinstance(image, str) else image for image in images]
+    shared = list(shared[:size]) + [0] * (size - len(shared[:size]))
+
+    if mode == "round-robin":
+        segment = SharedSegment(shared)
+        cores   = [_Core(index, image, segment, base, root=root)
+                   for index, image in enumerate(images)]
+        running = list(cores)
+        while running:
+            running = [core for core in running if core.step(quantum, limit)]
+        return [core.finish() for core in cores], shared
+
+    block = shared_memory.SharedMemory(create=True, size=size * 2)
+    data  = block.buf.cast("H")[:size]
+    try:
+        data[:] = array.array("H", shared)
+        methods   = multiprocessing.get_all_start_methods()
+        context   = multiprocessing.get_context("fork" if "fork" in methods else None)
+        processes = []
+        for index, image in enumerate(images):
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_run_process,
+                                      args=(sender, index, image, block, base, size, limit, root))
+            process.start()
+            sender.close()
+            processes.append((process, receiver))
+        results = []
+        for process, receiver in processes:
+            try:
+                results.append(receiver.recv())
+            except EOFError:
+                results.append(None)
+            receiver.close()
+            process.join()
+        for index, ((process, _), result) in enumerate(zip(processes, results)):
+            if result is None:
+                raise SimulationError(f"Process of core {index} exited with code "
+                                      f"{process.exitcode}")
+        shared = list(data)
+    finally:
+        data.release()
+        block.close()
+        block.unlink()
+    return results, shared
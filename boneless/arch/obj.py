@@ -0,0 +1,195 @@
+import json
+import bisect
+
+from .asm import TranslationError, assemble, _Lengths
+
+
+__all__ = ["Object", "link"]
+
+
+class Object:
+    """Relocatable object.
+
+    ``words`` is the machine code of one module, assembled as if it were loaded at address 0.
+    ``symbols`` are the addresses of its labels, by name. ``relocs`` are its relocatable
+    instructions (those that refer to a label) as ``(instr, length)`` pairs, by address.
+    Instructions that refer to labels defined in the module are encoded with the offsets within
+    the module; those that refer to labels defined elsewhere are encoded with the longest
+    encoding and an offset of 0.
+
+    Every relocatable instruction, and not only those referring to other modules, is kept, so
+    that all of them can be relaxed again with the final addresses when objects are linked.
+    """
+    def __init__(self, words, symbols=None, relocs=None):
+        self.words   = list(words)
+        self.symbols = dict(symbols or {})
+        self.relocs  = dict(relocs or {})
+
+    @classmethod
+    def assemble(cls, input, *, instr_cls, locs=None, cache_dir=None):
+        """Assemble ``input`` (as in :func:`assemble`) into an object. References to undefined
+        labels are allowed, but callables are not, since their results can't be relocated."""
+        symbols = {}
+        relocs  = {}
+        words   = assemble(input, instr_cls=instr_cls, labels=symbols, locs=locs, relocs=relocs,
+                           cache_dir=cache_dir)
+        return cls(words, symbols, relocs)
+
+    def to_json(self):
+        """Serialize the object as JSON text, with relocatable instructions as assembly text."""
+        return json.dumps({
+            "words":   self.words,
+            "symbols": self.symbols,
+            "relocs":  [[addr, length, str(instr)]
+                        for addr, (instr, length) in sorted(self.relocs.items())],
+        })
+
+    @classmethod
+    def from_json(cls, text, *, instr_cls):
+        """Deserialize an object from JSON text returned by :meth:`to_json`."""
+        try:
+            data    = json.loads(text)
+            words   = [int(word) & 0xffff for word in data["words"]]
+            symbols = {str(name): int(addr) for name, addr in data["symbols"].items()}
+            relocs  = {int(addr): (instr_cls.from_str(instr), int(length))
+                       for addr, length, instr in data["relocs"]}
+            for name, addr in symbols.items():
+                if addr not in range(len(words) + 1):
+                    raise ValueError(f"label {name!r} is out of range")
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            raise ValueError(f"Invalid object: {error}") from None
+        return cls(words, symbols, relocs)
+
+
+def _symbols(instr):
+    return [operand.value for operand in (getattr(instr, field) for field in instr._field_types)
+            if isinstance(operand.value, str)]
+
+
+def link(objects, *, names=None, labels=None, stats=None):
+    """Link ``objects`` into an image, placing them one after another starting at address 0.
+
+    Every label is visible in every object, and must be defined in exactly one of them; ``names``
+    (e.g. file names) identify the objects in error messages. The relocatable instructions are
+    relaxed across all objects at once, so the image is the same as if the sources of all objects
+    were assembled together. ``labels`` and ``stats`` are filled in as by :func:`assemble`.
+    """
+    objects = list(objects)
+    if names is None:
+        names = [f"object {index}" for index in range(len(objects))]
+
+    defined = {}
+    for name, obj in zip(names, objects):
+        for symbol in obj.symbols:
+            if symbol in defined:
+                raise TranslationError("Label {0!r} in {1} is also defined in {2}",
+                                       symbol, name, defined[symbol])
+            defined[symbol] = name
+
+    # The objects are split into chunks: runs of words that can't change, and relocatable
+    # instructions, as in `assemble`. Labels are kept as the index of the chunk after them.
+    chunks   = [] # (object, address in object, relocatable instruction or None)
+    lengths  = []
+    label_at = {}
+    # The labels the relocatable instructions refer to, the offsets they were last encoded with
+    # (in the object, or during relaxation) together with the encoding, and the indexes of those
+    # referring to labels in other objects.
+    symbols  = {}
+    encoded  = {}
+    external = []
+    for name, obj in zip(names, objects):
+        bounds = {0, len(obj.words)}
+        bounds.update(addr for addr in obj.symbols.values() if addr in range(len(obj.words)))
+        for addr, (instr, length) in obj.relocs.items():
+            bounds.update((addr, addr + length))
+        bounds = sorted(bounds)
+        chunk_at = {}
+        for addr, next_addr in zip(bounds, bounds[1:]):
+            chunk_at[addr] = len(chunks)
+            if addr in obj.relocs:
+                instr, length = obj.relocs[addr]
+                symbols[len(chunks)] = instr_symbols = _symbols(instr)
+                for symbol in instr_symbols:
+                    if symbol not in defined:
+                        raise TranslationError("Undefined label {0!r} referenced in {1} "
+                                               "at {2:#06x}", symbol, name, addr)
+                if all(symbol in obj.symbols for symbol in instr_symbols):
+                    encoded[len(chunks)] = ([obj.symbols[symbol] - (addr + length)
+                                             for symbol in instr_symbols],
+                                            obj.words[addr:addr + length])
+                else:
+                    external.append(len(chunks))
+                chunks.append((obj, addr, instr))
+            else:
+                chunks.append((obj, addr, None))
+            lengths.append(next_addr - addr)
+        chunk_at[len(obj.words)] = len(chunks)
+        for symbol, addr in obj.symbols.items():
+            label_at[symbol] = chunk_at[addr]
+
+    # Relaxation. The lengths the relocatable instructions have in their objects are at least
+    # as long as the final ones, since labels in other objects can only be closer than assumed,
+    # and they are a fixed point of relaxation within each object. So, relaxation can start from
+    # them rather than from the longest encodings, and converges to the same encodings as
+    # `assemble`. Only the instructions referring to other objects can shrink at first, and
+    # later, only those that span a chunk that was shrunk in the previous pass.
+    tree = _Lengths(lengths)
+    def encode(index, label_addrs, end):
+        offsets = [label_addrs(symbol) - end for symbol in symbols[index]]
+        if index in encoded and encoded[index][0] == offsets:
+            return encoded[index][1]
+        output  = []
+        resolve = dict(zip(symbols[index], offsets))
+        chunks[index][2](resolve.__getitem__).encode(output)
+        encoded[index] = (offsets, output)
+        return output
+
+    spans = {}
+    for index, instr_symbols in symbols.items():
+        targets = [label_at[symbol] for symbol in instr_symbols]
+        spans[index] = (min(index, *targets), max(index, *targets))
+
+    pending = [index for index in external if tree.lengths[index] > 1]
+    n_pass  = n_shrink = 0
+    while pending:
+        n_pass += 1
+        shrunk  = []
+        for index in pending:
+            old_length = tree.lengths[index]
+            length = len(encode(index, lambda symbol: tree.address(label_at[symbol]),
+                                tree.address(index) + old_length))
+            assert length <= old_length, \
+                f"Expansion at {chunks[index][1]:#06x}: {old_length} to {length}"
+            if length < old_length:
+                tree.update(index, length)
+                shrunk.append(index)
+                n_shrink += 1
+        if not shrunk:
+            break
+        shrunk.sort()
+        pending = []
+        for index, (first, last) in spans.items():
+            if tree.lengths[index] > 1:
+                position = bisect.bisect_left(shrunk, first)
+                if position < len(shrunk) and shrunk[position] <= last:
+                    pending.append(index)
+
+    # Emit the output with the final addresses. Most instructions are encoded with the same
+    # offsets as the last time, in which case the encoding is reused.
+    label_addrs = {name: tree.address(index) for name, index in label_at.items()}
+    output = []
+    for index, (obj, addr, instr) in enumerate(chunks):
+        length = tree.lengths[index]
+        end    = len(output) + length
+        if instr is None:
+            output.extend(obj.words[addr:addr + length])
+        else:
+            output.extend(encode(index, label_addrs.__getitem__, end))
+        assert len(output) == end, \
+            f"Expansion at {addr:#06x}: {length} to {len(output) - end + length}"
+
+    if labels is not None:
+        labels.update(label_addrs)
+    if stats is not None:
+        stats.update(passes=n_pass, shrinks=n_shrink)
+    return output
@@ -0,0 +1,187 @@
+import bisect
+
+from .instr import Instr
+from . import opcode
+
+
+__all__ = ["Profiler"]
+
+
+_CALLS = (opcode.JAL, opcode.JRAL)
+_JUMPS = (opcode.JR, opcode.JVT, opcode.JST)
+
+
+class _Frame:
+    __slots__ = ("name", "ret", "w")
+
+    def __init__(self, name, ret, w):
+        self.name = name
+        self.ret  = ret
+        self.w    = w
+
+
+class Profiler:
+    """Instruction-level profiler.
+
+    Executes code in the simulator ``sim``, and counts the executions and cycles spent per
+    address. Function names, as well as the rows of :meth:`table`, are taken from ``labels``,
+    a mapping of label names to addresses as filled in by :meth:`Instr.assemble`.
+
+    The call stack is reconstructed from the linkage: ``JAL`` and ``JRAL`` push a frame with
+    the address of the next instruction, and an indirect jump (``JR``, ``JVT``, or ``JST``) to
+    the return address of a frame pops it together with every frame above it. If several frames
+    have the same return address (as with recursion), the frame whose window is the same as
+    the current one is preferred, so that a window restored with ``STW``, ``ADJW``, or ``XCHW``
+    before returning unwinds to the right frame.
+
+    If ``interval`` is ``None``, every instruction is executed and accounted for individually.
+    Otherwise, the simulator runs at full speed between calls and returns, the cycles spent in
+    every function are still exact, but the addresses are sampled once every ``interval``
+    executed instructions, and the counts and cycles per address are estimates. Calls and
+    returns are found by decoding the memory once per :meth:`run`; code written to memory
+    afterwards is only profiled correctly if ``interval`` is ``None``.
+    """
+    def __init__(self, sim, labels=None, *, interval=None):
+        labels = {} if labels is None else labels
+
+        self.sim      = sim
+        self.interval = interval
+        self.counts   = {}
+        self.cycles   = {}
+        self.stacks   = {}
+
+        self._labels  = sorted((addr, name) for name, addr in labels.items())
+        self._names   = {}
+        for addr, name in reversed(self._labels):
+            self._names[addr] = name
+        self._stack   = [_Frame(self._name(sim.pc), None, None)]
+        self._path    = (self._stack[0].name,)
+        self._kinds   = {}
+        # Instructions executed and cycles spent since the last sample.
+        self._pending = 0
+        self._spent   = 0
+
+    def _name(self, addr):
+        return self._names.get(addr, f"{addr:04x}")
+
+    def _kind(self, pc):
+        mem  = self.sim.mem
+        word = mem[pc]
+        key  = word
+        if word & Instr._ext_mask == Instr._ext_code:
+            key = (word, mem[(pc + 1) & 0xffff])
+            word = key[1]
+        kind = self._kinds.get(key)
+        if kind is None:
+            instr_cls = Instr.decodings.get(word)
+            if instr_cls in _CALLS:
+                kind = "call"
+            elif instr_cls in _JUMPS:
+                kind = "jump"
+            else:
+                kind = ""
+            self._kinds[key] = kind
+        return kind
+
+    def _charge(self, cycles):
+        self.stacks[self._path] = self.stacks.get(self._path, 0) + cycles
+
+    def _step(self):
+        # Execute one instruction, keeping track of the call stack. A single instruction is
+        # interpreted by the simulator rather than translated, so this costs about as much as
+        # running the simulator without translation.
+        sim    = self.sim
+        pc     = sim.pc
+        kind   = self._kind(pc)
+        cycles = sim.cycles
+        sim.run(1)
+        spent  = sim.cycles - cycles
+        self._charge(spent)
+        if kind == "call":
+            length = 2 if sim.mem[pc] & Instr._ext_mask == Instr._ext_code else 1
+            self._stack.append(_Frame(self._name(sim.pc), (pc + length) & 0xffff, sim.w))
+            self._path = self._path + (self._stack[-1].name,)
+        elif kind == "jump":
+            found = None
+            for index in range(len(self._stack) - 1, 0, -1):
+                frame = self._stack[index]
+                if frame.ret == sim.pc:
+                    if found is None or frame.w == sim.w:
+                        found = index
+                    if frame.w == sim.w:
+                        break
+            if found is not None:
+                del self._stack[found:]
+                self._path = self._path[:found]
+        return pc, spent
+
+    def _stops(self):
+        return frozenset(pc for pc in range(0x10000) if self._kind(pc))
+
+    def run(self, limit=None, *, until=()):
+        """Execute instructions like :meth:`Simulator.run`, and profile them. Returns the number
+        of executed instructions."""
+        sim   = self.sim
+        until = frozenset(until)
+        count = 0
+        if self.interval is None:
+            counts, cycles = self.counts, self.cycles
+            while limit is None or count < limit:
+                pc, spent = self._step()
+                counts[pc] = counts.get(pc, 0) + 1
+                cycles[pc] = cycles.get(pc, 0) + spent
+                count += 1
+                if sim.pc in until:
+                    break
+            return count
+
+        stops = self._stops() | until
+        while limit is None or count < limit:
+            if self._kind(sim.pc):
+                _, spent = self._step()
+                executed = 1
+            else:
+                budget = self.interval - self._pending
+                if limit is not None:
+                    budget = min(budget, limit - count)
+                start    = sim.cycles
+                executed = sim.run(budget, until=stops)
+                spent    = sim.cycles - start
+                self._charge(spent)
+            count         += executed
+            self._pending += executed
+            self._spent   += spent
+            if self._pending >= self.interval:
+                self.counts[sim.pc] = self.counts.get(sim.pc, 0) + 1
+                self.cycles[sim.pc] = self.cycles.get(sim.pc, 0) + self._spent
+                self._pending = self._spent = 0
+            if sim.pc in until:
+                break
+        return count
+
+    def collapsed(self):
+        """Return the cycles spent in every call stack, in the collapsed stack format used by
+        flame graph tools: one line per stack, with the frames separated by ``;``, followed by
+        a space and the number of cycles."""
+        return "".join(f"{';'.join(path)} {cycles}\n"
+                       for path, cycles in sorted(self.stacks.items()))
+
+    def table(self):
+        """Return a table of the executions and cycles per label, where every address belongs to
+        the closest label before it, sorted by the number of cycles."""
+        addrs = [addr for addr, name in self._labels]
+        rows  = {}
+        for pc, count in self.counts.items():
+            index = bisect.bisect_right(addrs, pc) - 1
+            name  = self._labels[index][1] if index >= 0 else "?"
+            row   = rows.setdefault(name, [0, 0])
+            row[0] += count
+            row[1] += self.cycles[pc]
+        total = sum(cycles for count, cycles in rows.values()) or 1
+        name_width = max((len(name) for name in rows), default=0)
+        name_width = max(name_width, len("label"))
+        lines = [f"{'label':<{name_width}} {'count':>12} {'cycles':>12} {'%':>6}\n"]
+        for name, (count, cycles) in sorted(rows.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{name:<{name_width}} {count:>12} {cycles:>12} "
+                         f"{100 * cycles / total:>6.2f}\n")
+        return "".join(lines)
@@ -0,0 +1,170 @@
+import array
+import hashlib
+import io
+import multiprocessing
+import sys
+from collections import OrderedDict, namedtuple
+
+from .sim import SimulationError, ExternalMemory, ExternalBus, Simulator
+from .semihost import SemihostExit, Semihost
+
+
+__all__ = ["Job", "load_image", "run_image", "run_job", "run_jobs"]
+
+
+Job = namedtuple("Job", ("image", "stimulus", "limit"), defaults=((), None))
+Job.__doc__ = """Execution of ``image`` (a sequence of words, or the path of an image file) with
+external memory initialized with ``stimulus`` (likewise), until the firmware exits or
+``limit`` cycles have passed."""
+
+
+def load_image(path):
+    """Load an image from the file at ``path``: 16-bit little-endian words if its name ends with
+    ``.bin``, or one hexadecimal word per line (as written by ``boneless-as``) otherwise."""
+    with open(path, "rb") as file:
+        data = file.read()
+    if path.endswith(".bin"):
+        if len(data) % 2 != 0:
+            raise ValueError(f"Binary image {path} has an odd number of bytes")
+        words = array.array("H", data)
+        if sys.byteorder == "big":
+            words.byteswap()
+        return list(words)
+    words = []
+    for line, word in enumerate(data.decode("ascii", "replace").splitlines()):
+        try:
+            words.append(int(word, 16))
+        except ValueError:
+            raise ValueError(f"Invalid hex image {path} at line {line + 1}") from None
+    return words
+
+
+def _digest(words):
+    return hashlib.sha256(array.array("H", words).tobytes()).hexdigest()
+
+
+def _summary(sim, external):
+    return {
+        "instructions": sim.instructions,
+        "cycles": sim.cycles,
+        "pc":     sim.pc,
+        "w":      sim.w,
+        "flags":  sim.flags,
+        "regs":   sim.regs,
+        "memory": _digest(sim.mem),
+        "external": _digest(external),
+    }
+
+
+class _Machine:
+    # A simulator with external memory and a semihosting port (as in `run_semihosted`) for
+    # one image, which is reset to its initial state by restoring a snapshot. Restoring only
+    # copies the pages of memory that were changed, and keeps the predecoded instructions and
+    # translated blocks for the rest.
+    def __init__(self, image, *, pc=0, w=0xfff8, root=None):
+        bus = ExternalBus()
+        self.sim = Simulator(image, pc=pc, w=w, ext=bus)
+        bus.sim  = self.sim
+        self.memory   = bus.add(ExternalMemory(), 0, 0xfff8)
+        self.semihost = bus.add(Semihost(self.sim, root=root), 0xfff8, Semihost.size)
+        self.initial  = self.sim.snapshot()
+
+    def run(self, stimulus, limit, *, files=None, engine=None):
+        # Files 0 to 2 of the semihosting port are `files` if provided, and otherwise write to
+        # a buffer whose contents are returned as "output". Instructions are executed by
+        # `engine.run(limit)` (e.g. a `Profiler` or a `Tracer`), or by the simulator.
+        sim = self.sim
+        sim.restore(self.initial)
+        stimulus = list(stimulus[:0xfff8])
+        self.memory.data[:len(stimulus)] = stimulus
+        stdout = io.BytesIO()
+        self.semihost.regs = [0] * Semihost.size
+        self.semihost.files.update(files or {0: io.BytesIO(), 1: stdout, 2: stdout})
+        engine = engine or sim
+
+        result = {"status": None}
+        try:
+            # An instruction takes at most 20 cycles without wait states, so running a number of
+            # instructions proportional to the number of cycles left rarely overshoots `limit`.
+            while limit is None or sim.cycles < limit:
+                engine.run(None if limit is None else max((limit - sim.cycles) // 20, 1))
+        except SemihostExit as exit:
+            result["status"] = exit.status
+        except SimulationError as error:
+            result["error"] = str(error)
+        finally:
+            self.semihost.close()
+        result.update(_summary(sim, self.memory.data))
+        if files is None:
+            result["output"] = stdout.getvalue().decode("utf-8", "replace")
+        return result
+
+
+# Machines of the most recently used images in this process.
+_machines = OrderedDict()
+_MAX_MACHINES = 16
+
+def _machine(image):
+    key = image if isinstance(image, str) else tuple(image)
+    machine = _machines.pop(key, None)
+    if machine is None:
+        machine = _Machine(load_image(image) if isinstance(image, str) else image)
+        if len(_machines) == _MAX_MACHINES:
+            _machines.popitem(last=False)
+    _machines[key] = machine
+    return machine
+
+
+def run_image(image, stimulus=(), limit=None, *, pc=0, w=0xfff8, root=None, files=None,
+              engine=None):
+    """Execute ``image`` with external memory initialized with ``stimulus``, and a semihosting
+    port (with the directory ``root``) mapped at external address ``0xfff8``, until the firmware
+    exits or ``limit`` cycles have passed. Returns the result as in :func:`run_job`.
+
+    Files 0, 1, and 2 of the semihosting port are taken from the dictionary ``files`` if provided.
+    If ``engine`` is provided, it is called with the simulator, and must return an object whose
+    ``run(limit)`` method executes instructions, e.g. a :class:`Profiler` or a :class:`Tracer`.
+    """
+    machine = _Machine(image, pc=pc, w=w, root=root)
+    return machine.run(stimulus, limit, files=files,
+                       engine=None if engine is None else engine(machine.sim))
+
+
+def run_job(job):
+    """Execute ``job`` in this process, and return the result as a JSON-serializable dictionary
+    with the exit status (``None`` if the cycle limit was reached), the instruction and cycle
+    counts, the final PC, W, flags, and registers, SHA-256 digests of the main and external
+    memory, the output written to the semihosting port, and the error message if an illegal
+    instruction was executed."""
+    image, stimulus, limit = job
+    if isinstance(stimulus, str):
+        stimulus = load_image(stimulus)
+    return _machine(image).run(stimulus, limit)
+
+
+def _run_indexed(indexed_job):
+    index, job = indexed_job
+    try:
+        result = run_job(Job(*job))
+    except (OSError, ValueError) as error:
+        result = {"error": str(error)}
+    result["job"] = index
+    return result
+
+
+def run_jobs(jobs, *, processes=None):
+    """Execute ``jobs`` in a pool of ``processes`` worker processes (by default, one per CPU),
+    and yield the results of :func:`run_job` as they become available, each with the index of
+    its job in ``jobs`` added as ``"job"``, and ``"error"`` set if its image could not be loaded.
+
+    Each worker process keeps the simulators of the images it has recently executed, so jobs
+    sharing an image reuse its decoded instructions.
+    """
+    jobs = list(jobs)
+    if processes == 1:
+        yield from map(_run_indexed, enumerate(jobs))
+        return
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+    with context.Pool(processes) as pool:
+        yield from pool.imap_unordered(_run_indexed, enumerate(jobs))
@@ -0,0 +1,191 @@
+import os
+import sys
+
+from .sim import Device, ExternalMemory, ExternalBus, Simulator
+
+
+__all__ = ["SemihostExit", "Semihost", "run_semihosted"]
+
+
+class SemihostExit(Exception):
+    """Raised when the firmware exits through the semihosting port; ``status`` is the exit
+    status."""
+    def __init__(self, status):
+        super().__init__(f"Exited with status {status}")
+        self.status = status
+
+
+class Semihost(Device):
+    """Semihosting port.
+
+    Lets the firmware running in ``sim`` call into the host with a single write to the external
+    bus. The port has 8 registers; a call is made by writing its arguments to ``ARG0``-``ARG2``
+    and then its number to ``CMD``, after which its result can be read from ``RES0``-``RES3``
+    (least significant word first). The registers are:
+
+    ====== ====== ==================================
+    Offset Name   Access
+    ====== ====== ==================================
+    0      CMD    write: make a call
+    1      ARG0   read/write
+    2      ARG1   read/write
+    3      ARG2   read/write
+    4      RES0   read
+    5      RES1   read
+    6      RES2   read
+    7      RES3   read
+    ====== ====== ==================================
+
+    Buffers in main memory hold two bytes per word, the first one in the low byte. The calls are:
+
+    ====== ======== ================================= =================================
+    Number Name     Arguments                         Result
+    ====== ======== ================================= =================================
+    1      WRITE    file, buffer address, length      number of bytes written
+    2      WRITE0   file, address of a NUL-terminated number of bytes written
+                    string
+    3      READ     file, buffer address, length      number of bytes read, 0 at EOF
+    4      OPEN     path address, path length, mode   file, or ``0xffff`` on failure
+                    (0 read, 1 write, 2 append)
+    5      CLOSE    file                              0, or ``0xffff`` on failure
+    6      CLOCK    none                              ``sim.cycles`` (64 bits)
+    7      EXIT     status                            raises :class:`SemihostExit`
+    ====== ======== ================================= =================================
+
+    Files 0, 1, and 2 are ``stdin``, ``stdout``, and ``stderr``, which are binary files and
+    default to the standard streams. Paths are relative to the directory ``root``, and may not
+    point outside of it; if ``root`` is ``None``, files cannot be opened. Calls with an unknown
+    number, or with a file that is not open, return ``0xffff``.
+    """
+    size = 8
+
+    CMD, ARG0, ARG1, ARG2, RES0, RES1, RES2, RES3 = range(8)
+
+    WRITE, WRITE0, READ, OPEN, CLOSE, CLOCK, EXIT = range(1, 8)
+
+    def __init__(self, sim, *, stdin=None, stdout=None, stderr=None, root=None):
+        self.sim   = sim
+        self.root  = None if root is None else os.path.realpath(root)
+        self.files = {
+            0: sys.stdin.buffer  if stdin  is None else stdin,
+            1: sys.stdout.buffer if stdout is None else stdout,
+            2: sys.stderr.buffer if stderr is None else stderr,
+        }
+        self.regs  = [0] * self.size
+
+    def read(self, offset):
+        return self.regs[offset]
+
+    def write(self, offset, data):
+        if offset == self.CMD:
+            result = self._call(data, *self.regs[self.ARG0:self.ARG2 + 1])
+            self.regs[self.RES0:] = [(result >> 16 * index) & 0xffff for index in range(4)]
+        elif offset <= self.ARG2:
+            self.regs[offset] = data
+
+    def _load(self, addr, length):
+        mem = self.sim.mem
+        return bytes(mem[(addr + (index >> 1)) & 0xffff] >> 8 * (index & 1) & 0xff
+                     for index in range(length))
+
+    def _store(self, addr, data):
+        sim = self.sim
+        for index in range(0, len(data), 2):
+            word_addr = (addr + (index >> 1)) & 0xffff
+            if index + 1 < len(data):
+                word = data[index] | data[index + 1] << 8
+            else:
+                word = sim.mem[word_addr] & 0xff00 | data[index]
+            sim.mem[word_addr] = word
+            if sim._watch[word_addr]:
+                sim._invalidate(word_addr)
+
+    def _open(self, path, mode):
+        if self.root is None or mode not in (0, 1, 2) or b"\0" in path:
+            return 0xffff
+        path = os.path.realpath(os.path.join(self.root, path.decode("utf-8", "replace")))
+        if os.path.commonpath([self.root, path]) != self.root:
+            return 0xffff
+        try:
+            file = open(path, ("rb", "wb", "ab")[mode])
+        except OSError:
+            return 0xffff
+        fd = 3
+        while fd in self.files:
+            fd += 1
+        self.files[fd] = file
+        return fd
+
+    def _call(self, number, arg0, arg1, arg2):
+        if number == self.CLOCK:
+            return self.sim.cycles
+        if number == self.EXIT:
+            raise SemihostExit(arg0)
+        if number == self.OPEN:
+            return self._open(self._load(arg0, arg1), arg2)
+        if number not in (self.WRITE, self.WRITE0, self.READ, self.CLOSE) or \
+                arg0 not in self.files:
+            return 0xffff
+        file = self.files[arg0]
+        # Files may not support the operation, e.g. standard input is not writable.
+        if number == self.WRITE:
+            try:
+                file.write(self._load(arg1, arg2))
+            except OSError:
+                return 0xffff
+            return arg2
+        if number == self.WRITE0:
+            length = 0
+            while length < 0x20000 and \
+                    self.sim.mem[(arg1 + (length >> 1)) & 0xffff] >> 8 * (length & 1) & 0xff:
+                length += 1
+            try:
+                file.write(self._load(arg1, length))
+            except OSError:
+                return 0xffff
+            return length
+        if number == self.READ:
+            try:
+                data = file.read(arg2)
+            except OSError:
+                return 0xffff
+            self._store(arg1, data)
+            return len(data)
+        if number == self.CLOSE:
+            if arg0 < 3:
+                return 0xffff
+            self.files.pop(arg0).close()
+            return 0
+
+    def close(self):
+        """Close the files opened by the firmware."""
+        for fd in list(self.files):
+            if fd >= 3:
+                self.files.pop(fd).close()
+
+
+def run_semihosted(image, *, pc=0, w=0xfff8, ext=(), base=0xfff8, limit=None, **kwargs):
+    """Execute ``image`` with a :class:`Semihost` port mapped at external address ``base``, and
+    external memory initialized with ``ext`` everywhere else. Other keyword arguments are passed
+    to :class:`Semihost`.
+
+    Returns ``(status, sim)``, where ``status`` is the exit status, or ``None`` if ``limit``
+    instructions were executed first. After an exit, the program counter of ``sim`` is left at
+    the instruction that made the ``EXIT`` call.
+    """
+    bus = ExternalBus()
+    sim = Simulator(image, pc=pc, w=w, ext=bus)
+    bus.sim = sim
+    if base > 0:
+        bus.add(ExternalMemory(ext[:base]), 0, base)
+    semihost = bus.add(Semihost(sim, **kwargs), base, Semihost.size)
+    if base + Semihost.size < 0x10000:
+        bus.add(ExternalMemory(ext[base + Semihost.size:]), base + Semihost.size,
+                0x10000 - base - Semihost.size)
+    try:
+        sim.run(limit)
+    except SemihostExit as exit:
+        return exit.status, sim
+    finally:
+        semihost.close()
+    return None, sim
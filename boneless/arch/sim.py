@@ -0,0 +1,1001 @@
+import array
+import asyncio
+import inspect
+import pickle
+import re
+import textwrap
+import zlib
+
+from .instr import Instr
+from . import opcode
+
+
+__all__ = ["SimulationError", "Device", "ExternalMemory", "ExternalBus", "Simulator"]
+
+
+class SimulationError(Exception):
+    pass
+
+
+class _Suspended(SimulationError):
+    # Raised by the external bus when an access returns an awaitable; the instruction performing
+    # it has no effect, and is executed again once the awaitable is done.
+    def __init__(self, key, awaitable):
+        super().__init__(f"External bus {key[0]} at {key[1]:04x} must be awaited; "
+                         f"use Simulator.run_async")
+        self.key       = key
+        self.awaitable = awaitable
+
+
+# Instruction semantics
+# ---------------------
+#
+# The behavior of every instruction is described by a fragment of Python code operating on
+# the following variables:
+#  * `m`: main memory, as a list of 65536 words;
+#  * `w`: register window base address (always a multiple of 8);
+#  * `z`, `s`, `c`, `v`: flags;
+#  * `pc`: address of the next instruction; assigning it performs a jump;
+#  * `rsd`, `ra`, `rb`: register numbers;
+#  * `imm`: 16-bit immediate, already extended (but not yet added to PC for PC-relative forms);
+#  * `sim`: the simulator itself, used to access the external bus and to count cycles spent
+#    by instructions whose timing depends on the operands.
+#
+# Memory stores are written as `M[addr] = value`, which lets the code generator add any
+# bookkeeping that is required when memory changes (such as invalidating predecoded instructions).
+# The fragments are then stitched into specialized Python functions; see the comment in
+# `mc.InstrMeta` for why this uses `exec`.
+
+def _alu_operands(cls, invert=False):
+    invert = " ^ 0xffff" if invert else ""
+    if issubclass(cls, opcode.M_RRR):
+        return f"a = m[w|ra]; b = m[w|rb]{invert}"
+    else:
+        return f"a = m[w|ra]; b = imm{invert}"
+
+_ZS_FLAGS = "z = r == 0; s = r >= 0x8000"
+_CV_FLAGS = "c = r > 0xffff; r &= 0xffff; v = ((a ^ r) & (b ^ r)) >= 0x8000"
+
+_CONDITIONS = {
+    opcode.T_Z:     "z",
+    opcode.T_S:     "s",
+    opcode.T_C:     "c",
+    opcode.T_V:     "v",
+    opcode.T_nCoZ:  "(not c or z)",
+    opcode.T_SxV:   "(s != v)",
+    opcode.T_SxVoZ: "(s != v or z)",
+    opcode.T_A:     None,
+}
+
+def _semantics(cls):
+    if issubclass(cls, opcode.C_LOGIC):
+        operands = _alu_operands(cls)
+        if issubclass(cls, opcode.T_AND):
+            return f"{operands}; r = a & b; M[w|rsd] = r; {_ZS_FLAGS}"
+        if issubclass(cls, opcode.T_OR):
+            return f"{operands}; r = a | b; M[w|rsd] = r; {_ZS_FLAGS}"
+        if issubclass(cls, opcode.T_XOR):
+            return f"{operands}; r = a ^ b; M[w|rsd] = r; {_ZS_FLAGS}"
+        if issubclass(cls, opcode.T_CMP):
+            operands = _alu_operands(cls, invert=True)
+            return f"{operands}; r = a + b + 1; {_CV_FLAGS}; {_ZS_FLAGS}"
+
+    if issubclass(cls, opcode.C_ARITH):
+        subtract = issubclass(cls, (opcode.T_SUB, opcode.T_SBC))
+        operands = _alu_operands(cls, invert=subtract)
+        if issubclass(cls, (opcode.T_ADC, opcode.T_SBC)):
+            compute = "r = a + b + c"
+        elif subtract:
+            compute = "r = a + b + 1"
+        else:
+            compute = "r = a + b"
+        return f"{operands}; {compute}; {_CV_FLAGS}; M[w|rsd] = r; {_ZS_FLAGS}"
+
+    if issubclass(cls, opcode.C_SHIFT):
+        operands = _alu_operands(cls)
+        if issubclass(cls, opcode.T_SLL):
+            compute = "r = (a << n) & 0xffff"
+        if issubclass(cls, opcode.T_ROL):
+            compute = "r = ((a << n) | (a >> (16 - n))) & 0xffff"
+        if issubclass(cls, opcode.T_SRL):
+            compute = "r = a >> n"
+        if issubclass(cls, opcode.T_SRA):
+            compute = "r = ((a ^ 0x8000) - 0x8000 >> n) & 0xffff"
+        code = f"{operands}; n = b & 0xf; {compute}; M[w|rsd] = r; {_ZS_FLAGS}"
+        if issubclass(cls, opcode.M_RRR):
+            # For immediate shifts, the shift amount is known when the instruction is decoded.
+            code += "; sim.cycles += n"
+        return code
+
+    if cls in (opcode.LD, opcode.LDR):
+        base = "m[w|ra] + imm + pc" if cls is opcode.LDR else "m[w|ra] + imm"
+        return f"M[w|rsd] = m[({base}) & 0xffff]"
+    if cls in (opcode.ST, opcode.STR):
+        base = "m[w|ra] + imm + pc" if cls is opcode.STR else "m[w|ra] + imm"
+        return f"M[({base}) & 0xffff] = m[w|rsd]"
+    if cls is opcode.LDX:
+        return "M[w|rsd] = sim.ext.read((m[w|ra] + imm) & 0xffff)"
+    if cls is opcode.LDXA:
+        return "M[w|rsd] = sim.ext.read(imm)"
+    if cls is opcode.STX:
+        return "sim.ext.write((m[w|ra] + imm) & 0xffff, m[w|rsd])"
+    if cls is opcode.STXA:
+        return "sim.ext.write(imm, m[w|rsd])"
+
+    if cls is opcode.MOVI:
+        return "M[w|rsd] = imm"
+    if cls is opcode.MOVR:
+        return "M[w|rsd] = (imm + pc) & 0xffff"
+
+    if cls is opcode.STW:
+        return "w = m[w|rb] & 0xfff8"
+    if cls is opcode.XCHW:
+        return "t = w; w = m[w|rb] & 0xfff8; M[w|rsd] = t"
+    if cls is opcode.ADJW:
+        return "w = (w + imm) & 0xfff8"
+    if cls is opcode.LDW:
+        return "t = w; w = (w + imm) & 0xfff8; M[w|rsd] = t"
+
+    if cls is opcode.JR:
+        return "pc = (m[w|rsd] + imm) & 0xffff"
+    if cls is opcode.JRAL:
+        return "t = m[w|rb]; M[w|rsd] = pc; pc = t"
+    if cls is opcode.JVT:
+        return "t = m[w|rsd]; pc = (t + m[(t + imm) & 0xffff]) & 0xffff"
+    if cls is opcode.JST:
+        return "t = (imm + pc) & 0xffff; pc = (m[(m[w|rsd] + t) & 0xffff] + t) & 0xffff"
+    if cls is opcode.JAL:
+        return "M[w|rsd] = pc; pc = (pc + imm) & 0xffff"
+
+    if issubclass(cls, opcode.C_JCOND):
+        for cond_cls, cond in _CONDITIONS.items():
+            if issubclass(cls, cond_cls):
+                break
+        if cond is None:
+            # Unconditional jump or no operation.
+            if issubclass(cls, opcode.M_FL1):
+                return "pc = (pc + imm) & 0xffff"
+            return "pass"
+        if issubclass(cls, opcode.M_FL1):
+            return f"if {cond}: pc = (pc + imm) & 0xffff"
+        return f"if not {cond}: pc = (pc + imm) & 0xffff"
+
+    if cls is opcode.EXTI:
+        return "pass"
+
+    raise NotImplementedError(f"No semantics for instruction {cls.__name__}")
+
+
+# Instruction timing
+# ------------------
+#
+# `CoreFSM` spends FETCH, LOAD-A, LOAD-B, and EXECUTE cycles on most instructions, and one more
+# EXECUTE cycle on instructions that update W or PC in two steps. An EXTI prefix only spends
+# a LOAD-A cycle, and shifts spend one more EXECUTE cycle per bit of shift amount. The table
+# derived from the gateware by `boneless.gateware.timing` must agree with this one.
+
+def _timing(cls):
+    if cls is opcode.EXTI:
+        return 1
+    if cls in (opcode.STW, opcode.XCHW, opcode.ADJW, opcode.LDW,
+               opcode.JRAL, opcode.JST, opcode.JAL):
+        return 5
+    return 4
+
+
+_STATE  = ("w", "z", "s", "c", "v")
+_FIELDS = ("rsd", "ra", "rb", "imm")
+
+def _expand(code, on_watch):
+    # Split the fragment into statements and lower memory stores. Stores to words that predecoded
+    # instructions depend on are rare, so they are checked with a single lookup in `watch`, and
+    # handled out of line by `on_watch`.
+    lines = []
+    for stmt in code.split("; "):
+        match = re.match(r"^M\[(.+)\] = (.+)$", stmt)
+        if match:
+            lines.append(f"_a = {match[1]}")
+            lines.append(f"m[_a] = {match[2]}")
+            lines.append("if watch[_a]:")
+            lines.extend(f"    {line}" for line in on_watch)
+        else:
+            lines.append(stmt)
+    return lines
+
+def _compile(name, args, body):
+    source = f"def {name}({', '.join(args)}):\n" + textwrap.indent("\n".join(body), "    ")
+    namespace = {}
+    exec(compile(source, f"<{name}>", "exec"), {}, namespace)
+    return namespace[name], source
+
+def _compile_handler(cls, code, uses, defs):
+    return _compile(f"_exec_{cls.__name__}", ("sim", "pc", *_FIELDS), [
+        "m = sim.mem",
+        *(["watch = sim._watch"] if "M[" in code else []),
+        *(f"{name} = sim.{name}" for name in uses),
+        *_expand(code, on_watch=["sim._invalidate(_a)"]),
+        *(f"sim.{name} = {name}" for name in defs),
+        "return pc",
+    ])[0]
+
+def _compile_fields(cls):
+    # Extract register numbers and immediates from an instruction word, using the same lookup
+    # tables (reduced to 16-bit values) as the operand classes.
+    fields = {}
+    for match in re.finditer(r"([A-Za-z])\1*", cls.coding):
+        field_name   = Instr.abbrevs[match[1]]
+        field_mask   = (1 << (match.end() - match.start())) - 1
+        field_offset = len(cls.coding) - match.end()
+        fields[field_name] = (field_mask, field_offset)
+    luts = {}
+    exprs = []
+    for field_name in _FIELDS:
+        if field_name not in fields:
+            exprs.append("0")
+            continue
+        field_mask, field_offset = fields[field_name]
+        field_type = cls._field_types[field_name]
+        luts[field_name] = [field_type.value_from_bits(bits) & 0xffff
+                            for bits in range(field_mask + 1)]
+        exprs.append(f"{field_name}[(word >> {field_offset}) & {field_mask}]")
+    source = f"def fields(word):\n    return {', '.join(exprs)}"
+    namespace = {}
+    exec(source, luts, namespace)
+    return namespace["fields"]
+
+
+class _Decoding:
+    __slots__ = ("cls", "code", "uses", "defs", "jumps", "external", "handler", "fields",
+                 "timing", "shift_imm")
+
+    def __init__(self, cls):
+        self.cls      = cls
+        self.code     = _semantics(cls)
+        self.uses     = {name for name in _STATE if re.search(rf"\b{name}\b", self.code)}
+        self.defs     = {name for name in _STATE
+                         if re.search(rf"(^|; ){name} (=|\^=|&=)", self.code)}
+        self.jumps    = re.search(r"(^|: |; )pc = ", self.code) is not None
+        self.external = "sim.ext" in self.code
+        self.handler  = _compile_handler(cls, self.code, self.uses, self.defs)
+        self.fields   = _compile_fields(cls)
+        self.timing   = _timing(cls)
+        self.shift_imm = issubclass(cls, opcode.C_SHIFT) and issubclass(cls, opcode.M_RRI)
+
+    def cycles(self, length, imm):
+        cycles = self.timing + length - 1
+        if self.shift_imm:
+            cycles += imm & 0xf
+        return cycles
+
+_decodings = {}
+for _instr_cls in set(Instr.decodings.values()):
+    _decodings[_instr_cls] = _Decoding(_instr_cls)
+del _instr_cls
+
+
+class _Block:
+    __slots__ = ("run", "length", "inner", "source")
+
+    def __init__(self, run, length, inner, source):
+        self.run    = run
+        self.length = length
+        self.inner  = inner
+        self.source = source
+
+
+# Idle loops
+# ----------
+#
+# Firmware spends most of its time in two kinds of loops, which are fast-forwarded instead of
+# being executed iteration by iteration:
+#  * counting loops, consisting of an `ADDI`/`SUBI` instruction optionally followed by a chain of
+#    `ADCI`/`SBCI` instructions (which together add a constant to a multi-word counter) and
+#    a branch back to the start of the loop;
+#  * polling loops, consisting of external bus reads and instructions that only write registers,
+#    followed by a branch back to the start of the loop.
+#
+# The flags set by a counting loop are the flags of a single wide addition, and only depend on
+# which of a few intervals the counter is in. All iterations that start in the same interval as
+# the current one branch the same way, so they can be executed at once.
+#
+# An iteration of a polling loop that leaves the machine state unchanged will be repeated exactly
+# until the external bus returns different data. If the external bus provides a `next_event`
+# method, it is called with the cycle count at the start of the iteration, and returns the cycle
+# count at which that may first happen, or `None` if it never happens by itself.
+
+_UNLIMITED = 1 << 64
+
+def _condition(cls):
+    for cond_cls, cond in _CONDITIONS.items():
+        if issubclass(cls, cond_cls):
+            break
+    if cond is None:
+        return lambda z, s, c, v: issubclass(cls, opcode.M_FL1)
+    if not issubclass(cls, opcode.M_FL1):
+        cond = f"not {cond}"
+    return eval(f"lambda z, s, c, v: {cond}")
+
+
+class _CountingLoop:
+    __slots__ = ("start", "iterate", "regs", "addend", "operand", "modulus", "top", "bounds",
+                 "taken", "length", "cycles", "depends")
+
+    def __init__(self, start, iterate, regs, addend, operand, taken, length, cycles, depends):
+        self.start   = start
+        self.iterate = iterate
+        self.regs    = regs
+        self.addend  = addend
+        self.operand = operand
+        self.modulus = 1 << 16 * len(regs)
+        self.top     = self.modulus >> 16
+        self.taken   = taken
+        self.length  = length
+        self.cycles  = cycles
+        self.depends = depends
+        # Values of the counter at which any of the flags computed from it may change.
+        modulus = self.modulus
+        half    = modulus >> 1
+        self.bounds = sorted({0, half, (modulus - addend) % modulus,
+                              (modulus - addend + self.top) % modulus, (half - addend) % modulus})
+
+    def flags(self, x):
+        r = x + self.addend
+        c = r >= self.modulus
+        r %= self.modulus
+        half = self.modulus >> 1
+        # The zero flag is only computed from the most significant word.
+        return r < self.top, r >= half, c, ((x ^ r) & (self.operand ^ r)) >= half
+
+    def run(self, sim, budget):
+        iterations = self.fast_forward(sim, budget)
+        executed = iterations * self.length
+        spent    = iterations * self.cycles
+        pc = self.start
+        if budget - executed >= self.length:
+            pc, more_executed, more_spent = self.iterate(sim, self.length)
+            executed += more_executed
+            spent    += more_spent
+        return pc, executed, spent
+
+    def fast_forward(self, sim, budget):
+        mem, w = sim.mem, sim.w
+        addrs = [w | reg for reg in self.regs]
+        if not self.depends.isdisjoint(addrs):
+            return 0
+        if addrs:
+            x = 0
+            for index, addr in enumerate(addrs):
+                x |= mem[addr] << 16 * index
+            flags = self.flags(x)
+        else:
+            flags = sim.z, sim.s, sim.c, sim.v
+        if not self.taken(*flags):
+            return 0
+
+        # Count the iterations that start in the same interval as this one.
+        step = self.addend % self.modulus
+        if step == 0:
+            if budget >= _UNLIMITED:
+                return 0
+            iterations = budget // self.length
+        elif step <= self.modulus >> 1:
+            bound = next((bound for bound in self.bounds if bound > x), self.modulus)
+            iterations = min((bound - 1 - x) // step + 1, budget // self.length)
+        else:
+            step -= self.modulus
+            bound = max(bound for bound in self.bounds if bound <= x)
+            iterations = min((x - bound) // -step + 1, budget // self.length)
+        if not addrs:
+            return iterations
+
+        x = (x + iterations * step) % self.modulus
+        watch = sim._watch
+        for index, addr in enumerate(addrs):
+            mem[addr] = (x >> 16 * index) & 0xffff
+            if watch[addr]:
+                sim._invalidate(addr)
+        sim.z, sim.s, sim.c, sim.v = flags
+        return iterations
+
+
+class _Stopped(Exception):
+    # Raised by blocks that are interrupted by an exception after executing some instructions.
+    def __init__(self, pc, executed):
+        self.pc       = pc
+        self.executed = executed
+
+
+class _PollingLoop:
+    __slots__ = ("start", "length")
+
+    def __init__(self, start, length):
+        self.start  = start
+        self.length = length
+
+    def run(self, sim, budget):
+        # Devices on the external bus may observe the cycle count, so it is updated as
+        # the instructions are executed rather than returned.
+        mem, w, cache = sim.mem, sim.w, sim._cache
+        state  = (w, mem[w:w + 8], sim.z, sim.s, sim.c, sim.v)
+        cycles = sim.cycles
+        pc = self.start
+        for executed in range(self.length):
+            try:
+                entry = cache[pc]
+                if entry is None:
+                    entry = sim._predecode(pc)
+                handler, length, rsd, ra, rb, imm, timing = entry
+                pc = handler(sim, (pc + length) & 0xffff, rsd, ra, rb, imm)
+            except Exception as error:
+                raise _Stopped(pc, executed) from error
+            sim.cycles += timing
+        if pc != self.start or (sim.w, mem[sim.w:sim.w + 8], sim.z, sim.s, sim.c, sim.v) != state:
+            return pc, self.length, 0
+
+        next_event = getattr(sim.ext, "next_event", None)
+        if next_event is None:
+            return pc, self.length, 0
+        # The reads of the iteration were made after it started, so the first event after its
+        # start is the first one they could have missed. Only the iterations that end before it
+        # are skipped.
+        event  = next_event(cycles)
+        period = sim.cycles - cycles
+        if event is None:
+            if budget >= _UNLIMITED:
+                return pc, self.length, 0
+            iterations = budget // self.length - 1
+        else:
+            iterations = min(max(event - sim.cycles, 0) // period, budget // self.length - 1)
+        sim.cycles += iterations * period
+        return pc, (iterations + 1) * self.length, 0
+
+
+class Device:
+    """Device on the external bus.
+
+    Accesses to a device are made with addresses relative to the start of its range, and take
+    ``read_wait`` or ``write_wait`` more cycles than an access to memory. Devices whose registers
+    change by themselves must override :meth:`next_event`; by default, the registers of a device
+    only change when it is written.
+    """
+    read_wait  = 0
+    write_wait = 0
+
+    def read(self, offset):
+        return 0
+
+    def write(self, offset, data):
+        pass
+
+    def next_event(self, cycles):
+        """Return the earliest cycle count, greater than ``cycles``, at which reads may return
+        different data without any writes in between, or ``None`` if that never happens."""
+        return None
+
+    def snapshot(self):
+        """Return the state of the device, as a picklable object."""
+        return None
+
+    def restore(self, state):
+        """Restore the state of the device returned by :meth:`snapshot`."""
+        pass
+
+
+class ExternalMemory(Device):
+    """External bus backed by 64K words of memory."""
+    def __init__(self, data=()):
+        self.data = [0] * 0x10000
+        self.data[:len(data)] = data
+
+    def read(self, addr):
+        return self.data[addr]
+
+    def write(self, addr, data):
+        self.data[addr] = data
+
+    def snapshot(self):
+        return list(self.data)
+
+    def restore(self, state):
+        if self.data != state:
+            self.data[:] = state
+
+
+class ExternalBus:
+    """External bus with devices mapped to address ranges.
+
+    The device and its base address are kept for every one of the 64K addresses, so accesses
+    are dispatched in constant time regardless of the number of devices. The wait states of
+    a device are added to the cycle count of ``sim``, if provided. Accesses to addresses without
+    a device raise :class:`SimulationError`.
+
+    The ``read`` and ``write`` methods of a device may return awaitables (e.g. if they are
+    coroutine functions), in which case the simulator must be run with
+    :meth:`Simulator.run_async`.
+    """
+    def __init__(self, sim=None):
+        self.sim     = sim
+        self.devices = []
+        self._map    = [None] * 0x10000
+        self._resumed = None
+
+    def add(self, device, addr, size):
+        """Map ``device`` to ``size`` words starting at ``addr``."""
+        if addr < 0 or size <= 0 or addr + size > 0x10000:
+            raise ValueError(f"Address range {addr:#06x}+{size:#x} is invalid")
+        for other_addr in range(addr, addr + size):
+            if self._map[other_addr] is not None:
+                raise ValueError(f"Address range {addr:#06x}+{size:#x} overlaps a device "
+                                 f"at {other_addr:#06x}")
+        self._map[addr:addr + size] = [(device, addr)] * size
+        self.devices.append(device)
+        return device
+
+    def read(self, addr):
+        entry = self._map[addr]
+        if entry is None:
+            raise SimulationError(f"Read from unmapped external address {addr:04x}")
+        device, base = entry
+        if self._resumed is not None and self._resumed[0] == ("read", addr):
+            data = self._resumed[1]
+            self._resumed = None
+        else:
+            data = device.read(addr - base)
+            if inspect.isawaitable(data):
+                raise _Suspended(("read", addr), data)
+        if device.read_wait and self.sim is not None:
+            self.sim.cycles += device.read_wait
+        return data
+
+    def write(self, addr, data):
+        entry = self._map[addr]
+        if entry is None:
+            raise SimulationError(f"Write to unmapped external address {addr:04x}")
+        device, base = entry
+        if self._resumed is not None and self._resumed[0] == ("write", addr):
+            self._resumed = None
+        else:
+            result = device.write(addr - base, data)
+            if inspect.isawaitable(result):
+                raise _Suspended(("write", addr), result)
+        if device.write_wait and self.sim is not None:
+            self.sim.cycles += device.write_wait
+
+    def snapshot(self):
+        return [device.snapshot() for device in self.devices]
+
+    def restore(self, state):
+        for device, device_state in zip(self.devices, state):
+            device.restore(device_state)
+
+    def next_event(self, cycles):
+        events = [event for event in (device.next_event(cycles) for device in self.devices)
+                  if event is not None]
+        return min(events, default=None)
+
+
+class Simulator:
+    """Instruction set simulator.
+
+    Executes machine code (as produced by :meth:`Instr.assemble`) placed into 64K words of main
+    memory, which also contains the register window at address ``w``. Accesses to the external
+    bus are forwarded to the ``ext`` object, which must provide ``read(addr)`` and
+    ``write(addr, data)`` methods; an :class:`ExternalBus` can be used to map several devices.
+
+    Instructions are decoded once per address and kept in a predecode cache. If ``translate`` is
+    true, straight-line runs of instructions ending with a jump, starting at addresses where
+    execution started ``translate_threshold`` times, are also translated into Python functions
+    and kept in a block cache; instructions that access the external bus, as well as
+    the instructions where execution must stop, are always executed one by one. Stores performed
+    by the program invalidate both caches as necessary, but if ``mem`` is modified directly while
+    the code in it is being executed, :meth:`flush` must be called afterwards.
+
+    The number of executed instructions is counted in ``instructions``, and the number of clock
+    cycles :class:`boneless.gateware.CoreFSM` would spend executing them in ``cycles``. The cycle
+    count is kept current while instructions are executed, so devices on the external bus may
+    use it as a time base.
+
+    Counting loops (a constant added to a register, or a multi-word counter, followed by a branch
+    back) and polling loops (external bus reads that leave the machine state unchanged) are not
+    executed iteration by iteration, but fast-forwarded with the exact instruction and cycle
+    count. For polling loops, the ``ext`` object may provide a ``next_event(cycles)`` method
+    returning the earliest cycle count at which its reads may return different data, or ``None``
+    if that never happens without a write; without it, polling loops are executed normally.
+    Fast-forwarding requires ``translate`` to be true, and is never done past ``limit``.
+    """
+    max_block_length    = 64
+    translate_threshold = 16
+
+    def __init__(self, image=(), *, pc=0, w=0xfff8, ext=None, translate=True):
+        self.mem  = [0] * 0x10000
+        self.ext  = ExternalMemory() if ext is None else ext
+        self.pc   = pc
+        self.w    = w & 0xfff8
+        self.z    = False
+        self.s    = False
+        self.c    = False
+        self.v    = False
+        self.instructions = 0
+        self.cycles       = 0
+        self.translate    = translate
+        # Predecoded instructions and translated blocks, indexed by address, and the set of
+        # addresses (as a bitmap) of every word that affects either of them. For blocks, the start
+        # addresses of every block depending on a word are also kept, indexed by its address.
+        self._cache  = [None] * 0x10000
+        self._blocks = [None] * 0x10000
+        self._owners = {}
+        # The number of times execution started at every address that has no translated block,
+        # up to `translate_threshold`.
+        self._heat   = bytearray(0x10000)
+        self._watch  = bytearray(0x10000)
+        # Pages (of 256 words) changed since the last snapshot was taken or restored, and
+        # the snapshot itself.
+        self._dirty    = None
+        self._baseline = None
+        self.load(image)
+
+    def load(self, image, addr=0):
+        """Place words from ``image`` into main memory starting at ``addr``."""
+        for offset, word in enumerate(image):
+            self.mem[(addr + offset) & 0xffff] = word
+        self.flush()
+
+    def flush(self):
+        """Discard all predecoded instructions and translated blocks."""
+        self._cache[:]  = [None] * 0x10000
+        self._blocks[:] = [None] * 0x10000
+        self._owners.clear()
+        self._heat[:]   = bytes(0x10000)
+        self._watch[:]  = bytes(0x10000)
+        if self._dirty is not None:
+            # The memory may have been changed anywhere.
+            self._dirty[:] = b"\x01" * 0x100
+
+    def _discard(self, addr):
+        # The word at `addr` may be a part of the instruction at `addr`, or the second half of
+        # an instruction with an EXTI prefix at `addr - 1`.
+        self._cache[addr] = None
+        self._cache[(addr - 1) & 0xffff] = None
+        starts = self._owners.pop(addr, None)
+        if starts is not None:
+            for start in starts:
+                self._blocks[start] = None
+
+    def _invalidate(self, addr):
+        self._discard(addr)
+        self._watch[addr] = 0
+        if self._dirty is not None and not self._dirty[addr >> 8]:
+            # Every word of a page that is not dirty is watched, so the first store to it
+            # ends up here. Only keep watching the words that predecoded instructions and
+            # translated blocks depend on.
+            page = addr & 0xff00
+            self._dirty[addr >> 8] = 1
+            cache, owners, watch = self._cache, self._owners, self._watch
+            for word in range(page, page + 0x100):
+                watch[word] = (cache[word] is not None or
+                               cache[(word - 1) & 0xffff] is not None or word in owners)
+
+    def _depends(self, pc, length):
+        # Whether an EXTI prefix is fused with the next instruction depends on the next word
+        # even if the prefix is executed alone.
+        if self.mem[pc] & Instr._ext_mask == Instr._ext_code:
+            length = 2
+        return [(pc + offset) & 0xffff for offset in range(length)]
+
+    def _predecode(self, pc):
+        instr_cls, length, rsd, ra, rb, imm = self.decode(pc)
+        decoding = _decodings[instr_cls]
+        entry = (decoding.handler, length, rsd, ra, rb, imm, decoding.cycles(length, imm))
+        self._cache[pc] = entry
+        for addr in self._depends(pc, length):
+            self._watch[addr] = 1
+        return entry
+
+    def _polling_loop(self, start):
+        pc       = start
+        instrs   = []
+        external = False
+        while len(instrs) < self.max_block_length:
+            try:
+                instr_cls, length, *fields = self.decode(pc)
+            except SimulationError:
+                return None
+            decoding = _decodings[instr_cls]
+            instrs.append((pc, length))
+            pc = (pc + length) & 0xffff
+            if decoding.jumps:
+                if not (issubclass(decoding.cls, opcode.C_JCOND) and
+                        (pc + fields[-1]) & 0xffff == start):
+                    return None
+                break
+            if "w" in decoding.defs or "sim.ext.write" in decoding.code:
+                return None
+            if any(store != "w|rsd" for store in re.findall(r"M\[(.+?)\] = ", decoding.code)):
+                return None
+            external |= decoding.external
+        else:
+            return None
+        if not external:
+            return None
+        return _PollingLoop(start, len(instrs)), instrs
+
+    def _counting_loop(self, start, instrs, iterate, timing):
+        *chain, (last_pc, last_length, last_decoding, last_fields) = instrs
+        if not issubclass(last_decoding.cls, opcode.C_JCOND):
+            return None
+        regs     = []
+        operand  = 0
+        subtract = False
+        for index, (pc, length, decoding, (rsd, ra, rb, imm)) in enumerate(chain):
+            if index == 0:
+                subtract = decoding.cls is opcode.SUBI
+                if decoding.cls is not (opcode.SUBI if subtract else opcode.ADDI):
+                    return None
+            elif decoding.cls is not (opcode.SBCI if subtract else opcode.ADCI):
+                return None
+            if rsd != ra or rsd in regs:
+                return None
+            regs.append(rsd)
+            operand |= (imm ^ 0xffff if subtract else imm) << 16 * index
+        addend = operand + 1 if subtract else operand
+        depends = frozenset(addr for pc, length, *_ in instrs
+                            for addr in self._depends(pc, length))
+        return _CountingLoop(start, iterate, regs, addend, operand,
+                             _condition(last_decoding.cls), len(instrs), sum(timing), depends)
+
+    def _translate(self, start):
+        pc      = start
+        instrs  = []
+        polling = self._polling_loop(start)
+        while polling is None and len(instrs) < self.max_block_length:
+            try:
+                instr_cls, length, *fields = self.decode(pc)
+            except SimulationError:
+                break
+            decoding = _decodings[instr_cls]
+            if decoding.external:
+                break
+            instrs.append((pc, length, decoding, fields))
+            pc = (pc + length) & 0xffff
+            if decoding.jumps:
+                break
+
+        if polling is not None:
+            loop, instrs = polling
+            block = _Block(loop.run, loop.length, frozenset(pc for pc, _ in instrs[1:]), None)
+            depends = [addr for pc, length in instrs for addr in self._depends(pc, length)]
+        elif instrs:
+            uses   = set().union(*(decoding.uses for _, _, decoding, _ in instrs))
+            defs   = set().union(*(decoding.defs for _, _, decoding, _ in instrs))
+            stores = any("M[" in decoding.code for _, _, decoding, _ in instrs)
+            # If the block ends with a branch to its own start, which is how delay and polling
+            # loops look like, iterate inside the generated function.
+            last_pc, last_length, last_decoding, last_fields = instrs[-1]
+            looping = (issubclass(last_decoding.cls, opcode.C_JCOND) and
+                       (last_pc + last_length + last_fields[-1]) & 0xffff == start)
+            writeback = [f"sim.{name} = {name}" for name in sorted(defs)]
+            header = [
+                "m = sim.mem",
+                *(["watch = sim._watch", "stale = False"] if stores else []),
+                *(f"{name} = sim.{name}" for name in sorted(uses)),
+            ]
+            # The number of cycles spent in the block is returned together with the number of
+            # instructions; it only varies within the block for register shifts, which count
+            # the shift amount themselves.
+            timing = [decoding.cycles(length, fields[-1]) for _, length, decoding, fields in instrs]
+            # The iterations are counted in `_n`, since the semantics of shifts use `n`.
+            if looping:
+                count  = "_n + "
+                cycles = f"_n // {len(instrs)} * {sum(timing)} + "
+            else:
+                count  = cycles = ""
+            body = []
+            for index, (pc, length, decoding, fields) in enumerate(instrs):
+                next_pc = (pc + length) & 0xffff
+                # Specialize the semantics for this instruction by substituting operands and
+                # the address of the next instruction.
+                code = re.sub(r"\b(rsd|ra|rb|imm)\b",
+                              lambda match: str(fields[_FIELDS.index(match[1])]),
+                              decoding.code)
+                code = re.sub(r"\bpc\b(?! = )", f"{next_pc:#06x}", code)
+                if decoding.jumps:
+                    body.append(f"pc = {next_pc:#06x}")
+                body.extend(_expand(code, on_watch=["sim._invalidate(_a)", "stale = True"]))
+                next_pc = "pc" if decoding.jumps else f"{next_pc:#06x}"
+                if index + 1 < len(instrs) and "M[" in decoding.code:
+                    # The instruction may have changed the code of this block.
+                    body.append("if stale:")
+                    body.extend(f"    {line}" for line in writeback)
+                    body.append(f"    return {next_pc}, {count}{index + 1}, "
+                                f"{cycles}{sum(timing[:index + 1])}")
+            if looping:
+                body = [
+                    *header,
+                    "_n = 0",
+                    "while True:",
+                    *(f"    {line}" for line in body),
+                    f"    _n += {len(instrs)}",
+                    f"    if pc != {start:#06x} or _n + {len(instrs)} > limit:",
+                    "        break",
+                    *writeback,
+                    f"return pc, _n, _n // {len(instrs)} * {sum(timing)}",
+                ]
+            else:
+                body = [
+                    *header,
+                    *body,
+                    *writeback,
+                    f"return {next_pc}, {len(instrs)}, {sum(timing)}",
+                ]
+            run, source = _compile(f"_block_{start:04x}", ("sim", "limit"), body)
+            if looping:
+                loop = self._counting_loop(start, instrs, run, timing)
+                if loop is not None:
+                    run = loop.run
+            block = _Block(run, len(instrs), frozenset(pc for pc, *_ in instrs[1:]), source)
+            depends = [addr for pc, length, *_ in instrs for addr in self._depends(pc, length)]
+        else:
+            # The block would be empty; the instruction must be executed by the interpreter.
+            block = False
+            depends = self._depends(start, 1)
+
+        self._blocks[start] = block
+        for addr in depends:
+            self._watch[addr] = 1
+            self._owners.setdefault(addr, []).append(start)
+        return block
+
+    def snapshot(self):
+        """Return the state of the machine, including the state of the external bus if ``ext``
+        provides ``snapshot()`` and ``restore(state)`` methods, as a compressed binary blob.
+
+        Memory is tracked for changes from then on, so restoring the most recently taken or
+        restored snapshot only copies the pages of memory that have changed since.
+        """
+        ext_snapshot = getattr(self.ext, "snapshot", None)
+        state = (self.pc, self.w, self.flags, self.instructions, self.cycles,
+                 array.array("H", self.mem).tobytes(),
+                 None if ext_snapshot is None else ext_snapshot())
+        blob = zlib.compress(pickle.dumps(state), 1)
+        self._track(blob, state)
+        return blob
+
+    def restore(self, blob):
+        """Restore the state of the machine from a blob returned by :meth:`snapshot`."""
+        if self._baseline is not None and self._baseline[0] is blob:
+            _, state, mem = self._baseline
+            dirty, watch = self._dirty, self._watch
+            for page in range(0x100):
+                if not dirty[page]:
+                    continue
+                start = page << 8
+                self.mem[start:start + 0x100] = mem[start:start + 0x100]
+                for addr in range(start, start + 0x100):
+                    if watch[addr]:
+                        self._discard(addr)
+                watch[start:start + 0x100] = b"\x01" * 0x100
+                dirty[page] = 0
+        else:
+            state = pickle.loads(zlib.decompress(blob))
+            self.mem[:] = array.array("H", state[5])
+            self.flush()
+            self._track(blob, state)
+        self.pc, self.w, flags, self.instructions, self.cycles, _, ext_state = state
+        for flag in "zscv":
+            setattr(self, flag, flag in flags)
+        if ext_state is not None:
+            self.ext.restore(ext_state)
+
+    def _track(self, blob, state):
+        self._baseline = (blob, state, list(self.mem))
+        self._dirty    = bytearray(0x100)
+        self._watch[:] = b"\x01" * 0x10000
+
+    @property
+    def regs(self):
+        """Contents of the registers R0 to R7 in the current window."""
+        return self.mem[self.w:self.w + 8]
+
+    @property
+    def flags(self):
+        """Names of the set flags, as a subset of ``"zscv"``."""
+        return "".join(flag for flag in "zscv" if getattr(self, flag))
+
+    def decode(self, pc):
+        """Decode the instruction at ``pc``, and return its class, length, and fields."""
+        mem  = self.mem
+        word = mem[pc]
+        if word & Instr._ext_mask == Instr._ext_code:
+            # An EXTI prefix followed by a non-EXTI instruction is executed together with it,
+            # which is also how `Instr.decode` treats such a sequence.
+            next_word = mem[(pc + 1) & 0xffff]
+            next_cls  = Instr.decodings.get(next_word)
+            if next_cls is not None and next_cls is not opcode.EXTI:
+                decoding = _decodings[next_cls]
+                rsd, ra, rb, _ = decoding.fields(next_word)
+                imm = ((word & Instr._i13_mask) << 3 | next_word & Instr._i3_mask) & 0xffff
+                return next_cls, 2, rsd, ra, rb, imm
+        instr_cls = Instr.decodings.get(word)
+        if instr_cls is None:
+            raise SimulationError(f"Illegal instruction {word:04x} at {pc:04x}")
+        return (instr_cls, 1, *_decodings[instr_cls].fields(word))
+
+    def step(self):
+        """Execute one instruction."""
+        return self.run(1)
+
+    def run(self, limit=None, *, until=()):
+        """Execute instructions until ``limit`` instructions have been executed, or until
+        the program counter reaches one of the addresses in ``until``. Returns the number of
+        executed instructions."""
+        until  = frozenset(until)
+        cache  = self._cache
+        blocks = self._blocks if self.translate else None
+        heat   = self._heat
+        threshold = self.translate_threshold
+        pc     = self.pc
+        count  = 0
+        try:
+            while limit is None or count < limit:
+                if blocks is not None:
+                    block = blocks[pc]
+                    if block is None and (limit is None or limit - count > 1):
+                        # Translating a block takes much longer than interpreting it, so only
+                        # the addresses where execution starts often enough are translated.
+                        if heat[pc] < threshold:
+                            heat[pc] += 1
+                        else:
+                            block = self._translate(pc)
+                    if block and (limit is None or count + block.length <= limit) and \
+                            (not until or until.isdisjoint(block.inner)):
+                        if pc in until:
+                            budget = block.length
+                        elif limit is None:
+                            budget = 1 << 64
+                        else:
+                            budget = limit - count
+                        try:
+                            pc, executed, spent = block.run(self, budget)
+                        except _Stopped as stopped:
+                            pc     = stopped.pc
+                            count += stopped.executed
+                            raise stopped.__cause__ from None
+                        count += executed
+                        self.cycles += spent
+                        if pc in until:
+                            break
+                        continue
+                entry = cache[pc]
+                if entry is None:
+                    entry = self._predecode(pc)
+                handler, length, rsd, ra, rb, imm, timing = entry
+                pc = handler(self, (pc + length) & 0xffff, rsd, ra, rb, imm)
+                count += 1
+                self.cycles += timing
+                if pc in until:
+                    break
+        finally:
+            self.pc = pc
+            self.instructions += count
+        return count
+
+    async def run_async(self, limit=None, *, until=(), quantum=10000):
+        """Execute instructions like :meth:`run`, yielding to the event loop after every
+        ``quantum`` instructions, and while waiting for external bus accesses that return
+        awaitables. Many simulators can be run cooperatively in one event loop this way.
+        Returns the number of executed instructions."""
+        until = frozenset(until)
+        count = 0
+        while limit is None or count < limit:
+            budget = quantum if limit is None else min(quantum, limit - count)
+            start  = self.instructions
+            try:
+                count += self.run(budget, until=until)
+            except _Suspended as suspended:
+                count += self.instructions - start
+                self.ext._resumed = (suspended.key, await suspended.awaitable)
+                continue
+            if self.pc in until:
+                break
+            await asyncio.sleep(0)
+        return count
@@ -0,0 +1,275 @@
+import array
+import sys
+from collections import namedtuple
+
+from . import opcode
+
+
+__all__ = ["format_insn", "TraceRecord", "Tracer", "read_trace", "trace_to_text",
+           "trace_to_vcd"]
+
+
+def format_insn(word):
+    """Return the mnemonic of the instruction ``word``, or its hex value if it is illegal."""
+    try:
+        return str(opcode.Instr.from_int(word)).expandtabs(1)
+    except ValueError:
+        return "{:04x}".format(word)
+
+
+# Trace format
+# ------------
+#
+# A trace file starts with `_MAGIC`, followed by fixed-width records of `_FIELDS` 16-bit
+# little-endian words, one per executed instruction:
+#  * address of the instruction;
+#  * the instruction word, and the word following it if the instruction has an EXTI prefix;
+#  * the window pointer after the instruction;
+#  * address and data of a word written to main memory;
+#  * address and data of a word written to the external bus;
+#  * number of cycles spent on the instruction;
+#  * flags after the instruction (`_F_*`), and whether the writes and the second word are valid.
+
+_MAGIC  = b"BNLSTRC\x01"
+_FIELDS = 10
+
+_F_Z, _F_S, _F_C, _F_V = 0x01, 0x02, 0x04, 0x08
+_F_MEM  = 0x10
+_F_EXT  = 0x20
+_F_LONG = 0x40
+
+_PAGE = b"\x01" * 0x100
+
+
+class TraceRecord(namedtuple("TraceRecord", ("pc", "insn", "w", "flags", "mem_write",
+                                             "ext_write", "cycles"))):
+    """Executed instruction. ``insn`` is a tuple of one or two words, ``flags`` is a subset of
+    ``"zscv"``, and ``mem_write`` and ``ext_write`` are ``(addr, data)`` tuples or ``None``."""
+
+    @property
+    def mnemonic(self):
+        if len(self.insn) == 2:
+            instr, _ = opcode.Instr.decode(self.insn)
+            return str(instr).expandtabs(1)
+        return format_insn(self.insn[0])
+
+
+class _RecordingBus:
+    # Forwards accesses to the external bus of a simulator, and keeps the last write.
+    def __init__(self, ext):
+        self.ext   = ext
+        self.write_addr = None
+        self.write_data = None
+
+    def read(self, addr):
+        return self.ext.read(addr)
+
+    def write(self, addr, data):
+        self.ext.write(addr, data)
+        self.write_addr = addr
+        self.write_data = data
+
+    def __getattr__(self, name):
+        return getattr(self.ext, name)
+
+
+class Tracer:
+    """Execution tracer.
+
+    Executes code in the simulator ``sim`` one instruction at a time, and writes a record of
+    every instruction to the binary file ``file``. Records are kept in a buffer of ``chunk``
+    records, which is written to ``file`` when it is full and by :meth:`close`.
+    """
+    def __init__(self, sim, file, *, chunk=65536):
+        self.sim   = sim
+        self.file  = file
+        self.chunk = chunk
+        self._buffer = array.array("H")
+        file.write(_MAGIC)
+
+    def flush(self):
+        """Write the buffered records to the file."""
+        if sys.byteorder == "big":
+            self._buffer.byteswap()
+        self._buffer.tofile(self.file)
+        del self._buffer[:]
+
+    def close(self):
+        """Write the buffered records to the file, and close it."""
+        self.flush()
+        self.file.close()
+
+    def run(self, limit=None, *, until=()):
+        """Execute instructions like :meth:`Simulator.run`, and record them. Returns the number
+        of executed instructions."""
+        sim    = self.sim
+        until  = frozenset(until)
+        mem    = sim.mem
+        cache  = sim._cache
+        buffer = self._buffer
+        size   = self.chunk * _FIELDS
+        ext    = sim.ext
+        bus    = sim.ext = _RecordingBus(ext)
+        # Every store is reported to `_invalidate` while every word of memory is watched. It may
+        # stop watching other words of the same page, so the whole page is watched again.
+        # Afterwards, the words that were watched before are watched again, together with those
+        # that instructions predecoded while tracing depend on; stores have already discarded
+        # the predecoded instructions and translated blocks they affect.
+        invalidate = sim._invalidate
+        watch  = sim._watch
+        saved  = bytes(watch)
+        decoded = []
+        writes = []
+        def record_store(addr):
+            invalidate(addr)
+            page = addr & 0xff00
+            watch[page:page + 0x100] = _PAGE
+            writes.append(addr)
+        sim._invalidate = record_store
+        sim._watch[:] = b"\x01" * 0x10000
+        count = 0
+        try:
+            while limit is None or count < limit:
+                pc    = sim.pc
+                entry = cache[pc]
+                if entry is None:
+                    entry = sim._predecode(pc)
+                    decoded.append(pc)
+                handler, length, rsd, ra, rb, imm, timing = entry
+                insn   = mem[pc]
+                insn2  = mem[(pc + 1) & 0xffff] if length == 2 else 0
+                cycles = sim.cycles
+                sim.pc = handler(sim, (pc + length) & 0xffff, rsd, ra, rb, imm)
+                sim.cycles += timing
+                sim.instructions += 1
+                count += 1
+
+                flags = (sim.z * _F_Z) | (sim.s * _F_S) | (sim.c * _F_C) | (sim.v * _F_V)
+                if length == 2:
+                    flags |= _F_LONG
+                mem_addr = mem_data = ext_addr = ext_data = 0
+                if writes:
+                    flags |= _F_MEM
+                    mem_addr = writes[-1]
+                    mem_data = mem[mem_addr]
+                    writes.clear()
+                if bus.write_addr is not None:
+                    flags |= _F_EXT
+                    ext_addr, ext_data = bus.write_addr, bus.write_data
+                    bus.write_addr = None
+                buffer.extend((pc, insn, insn2, sim.w, mem_addr, mem_data, ext_addr, ext_data,
+                               min(sim.cycles - cycles, 0xffff), flags))
+                if len(buffer) >= size:
+                    self.flush()
+                if sim.pc in until:
+                    break
+        finally:
+            sim.ext = ext
+            del sim._invalidate
+            watch[:] = saved
+            for pc in decoded:
+                entry = cache[pc]
+                if entry is not None:
+                    for addr in sim._depends(pc, entry[1]):
+                        watch[addr] = 1
+        return count
+
+
+def read_trace(file, *, chunk=65536):
+    """Read records from the binary trace ``file``, and yield them as :class:`TraceRecord`."""
+    if file.read(len(_MAGIC)) != _MAGIC:
+        raise ValueError("Not a Boneless trace file")
+    while True:
+        data = file.read(chunk * _FIELDS * 2)
+        if not data:
+            break
+        if len(data) % (_FIELDS * 2) != 0:
+            raise ValueError("Truncated Boneless trace file")
+        words = array.array("H", data)
+        if sys.byteorder == "big":
+            words.byteswap()
+        for index in range(0, len(words), _FIELDS):
+            pc, insn, insn2, w, mem_addr, mem_data, ext_addr, ext_data, cycles, flags = \
+                words[index:index + _FIELDS]
+            yield TraceRecord(
+                pc=pc,
+                insn=(insn, insn2) if flags & _F_LONG else (insn,),
+                w=w,
+                flags="".join(flag for flag, bit in zip("zscv", (_F_Z, _F_S, _F_C, _F_V))
+                              if flags & bit),
+                mem_write=(mem_addr, mem_data) if flags & _F_MEM else None,
+                ext_write=(ext_addr, ext_data) if flags & _F_EXT else None,
+                cycles=cycles)
+
+
+def trace_to_text(records, output):
+    """Write ``records`` to the text file ``output``, one line per instruction."""
+    for record in records:
+        line = f"{record.pc:04x}: {' '.join(f'{word:04x}' for word in record.insn):<9} " \
+               f"{record.mnemonic:<20} W={record.w:04x} F={record.flags or '-':<4}"
+        if record.mem_write is not None:
+            line += " M[{:04x}]<-{:04x}".format(*record.mem_write)
+        if record.ext_write is not None:
+            line += " X[{:04x}]<-{:04x}".format(*record.ext_write)
+        output.write(line.rstrip() + "\n")
+
+
+def trace_to_vcd(records, output, *, timescale="1 us"):
+    """Write ``records`` to the VCD file ``output``, with one clock cycle per ``timescale``.
+
+    The mnemonic of every instruction is written as a string variable, which is displayed by
+    GTKWave and most other waveform viewers.
+    """
+    signals = [
+        ("pc",       16),
+        ("insn",     "string"),
+        ("w",        16),
+        ("flags",    4),
+        ("mem_we",   1),
+        ("mem_addr", 16),
+        ("mem_data", 16),
+        ("ext_we",   1),
+        ("ext_addr", 16),
+        ("ext_data", 16),
+    ]
+    codes = {name: chr(33 + index) for index, (name, _) in enumerate(signals)}
+    output.write(f"$timescale {timescale} $end\n")
+    output.write("$scope module boneless $end\n")
+    for name, width in signals:
+        if width == "string":
+            output.write(f"$var string 1 {codes[name]} {name} $end\n")
+        else:
+            output.write(f"$var wire {width} {codes[name]} {name} $end\n")
+    output.write("$upscope $end\n")
+    output.write("$enddefinitions $end\n")
+
+    def change(name, value):
+        if value == values.get(name):
+            return
+        values[name] = value
+        width = dict(signals)[name]
+        if width == "string":
+            output.write(f"s{value.replace(' ', '_')} {codes[name]}\n")
+        elif width == 1:
+            output.write(f"{value}{codes[name]}\n")
+        else:
+            output.write(f"b{value:b} {codes[name]}\n")
+
+    values = {}
+    time = 0
+    for record in records:
+        output.write(f"#{time}\n")
+        change("pc", record.pc)
+        change("insn", record.mnemonic)
+        change("w", record.w)
+        change("flags", sum(1 << (3 - "zscv".index(flag)) for flag in record.flags))
+        change("mem_we", int(record.mem_write is not None))
+        if record.mem_write is not None:
+            change("mem_addr", record.mem_write[0])
+            change("mem_data", record.mem_write[1])
+        change("ext_we", int(record.ext_write is not None))
+        if record.ext_write is not None:
+            change("ext_addr", record.ext_write[0])
+            change("ext_data", record.ext_write[1])
+        time += record.cycles
+    output.write(f"#{time}\n")
@@ -1,8 +1,14 @@
 import sys
+import json
 import argparse
+import itertools
 
+from .arch.cache import enable_cache
 from .arch.asm import TranslationError
 from .arch.opcode import Instr
+from .arch.obj import Object, link
+# The simulator and the tools built on it are imported by the commands that use them, so that
+# `boneless-as` and `boneless-dis`, which are run many times by builds, start quickly.
 
 
 def as_options(parser):
@@ -12,20 +18,70 @@ def as_options(parser):
     parser.add_argument("-o", "--output",
         metavar="OUTPUT", type=argparse.FileType("w"),
         help="write machine code (hex) to OUTPUT")
+    parser.add_argument("-c", "--compile",
+        default=False, action="store_true",
+        help="write a relocatable object (JSON) for boneless-ld instead of machine code; "
+             "labels may be defined in other objects")
+    parser.add_argument("--cache-dir",
+        metavar="DIR",
+        help="reuse the results of assembling the same INPUT before, kept in DIR")
     return parser
 
 def as_main(args=None):
     if args is None:
+        enable_cache()
         args = as_options(argparse.ArgumentParser()).parse_args()
 
     input  = args.input.read()
     output = args.output or sys.stdout
     try:
-        for word in Instr.assemble(input):
-            output.write("{:04x}\n".format(word))
+        if args.compile:
+            output.write(Object.assemble(input, instr_cls=Instr,
+                                         cache_dir=args.cache_dir).to_json() + "\n")
+        else:
+            for word in Instr.assemble(input, cache_dir=args.cache_dir):
+                output.write("{:04x}\n".format(word))
+    except TranslationError as error:
+        print(f"Error: {error}", file=sys.stderr)
+        exit(1)
+
+
+def ld_options(parser):
+    parser.add_argument("inputs",
+        metavar="INPUT", type=argparse.FileType("r"), nargs="+",
+        help="read relocatable objects from INPUT, and place them in the given order")
+    parser.add_argument("-o", "--output",
+        metavar="OUTPUT", type=argparse.FileType("w"),
+        help="write machine code (hex) to OUTPUT")
+    parser.add_argument("-m", "--map",
+        metavar="MAP", type=argparse.FileType("w"),
+        help="write the address of every label to MAP, one per line")
+    return parser
+
+def ld_main(args=None):
+    if args is None:
+        enable_cache()
+        args = ld_options(argparse.ArgumentParser()).parse_args()
+
+    objects = []
+    for input in args.inputs:
+        try:
+            objects.append(Object.from_json(input.read(), instr_cls=Instr))
+        except ValueError as error:
+            print(f"Error: {error} in {input.name}", file=sys.stderr)
+            exit(1)
+    output = args.output or sys.stdout
+    labels = {}
+    try:
+        image = link(objects, names=[input.name for input in args.inputs], labels=labels)
     except TranslationError as error:
         print(f"Error: {error}", file=sys.stderr)
         exit(1)
+    for word in image:
+        output.write("{:04x}\n".format(word))
+    if args.map:
+        for name, addr in sorted(labels.items(), key=lambda item: (item[1], item[0])):
+            args.map.write(f"{addr:04x} {name}\n")
 
 
 def dis_options(parser):
@@ -42,6 +98,7 @@ def dis_options(parser):
 
 def dis_main(args=None):
     if args is None:
+        enable_cache()
         args = dis_options(argparse.ArgumentParser()).parse_args()
 
     input  = []
@@ -55,12 +112,216 @@ def dis_main(args=None):
     output.write(Instr.disassemble(input, as_text=True, labels=args.labels))
 
 
+def trace_options(parser):
+    parser.add_argument("input",
+        metavar="INPUT", type=argparse.FileType("rb"),
+        help="read binary execution trace from INPUT")
+    parser.add_argument("-o", "--output",
+        metavar="OUTPUT", type=argparse.FileType("w"),
+        help="write converted trace to OUTPUT")
+    parser.add_argument("-f", "--format",
+        choices=("text", "vcd"), default="text",
+        help="convert trace to FORMAT (default: %(default)s)")
+    parser.add_argument("-p", "--pc",
+        metavar="ADDR", type=lambda value: int(value, 16), action="append",
+        help="only include instructions at hex address ADDR (may be repeated)")
+    parser.add_argument("-s", "--start",
+        metavar="INDEX", type=int, default=0,
+        help="skip the first INDEX instructions")
+    parser.add_argument("-n", "--count",
+        metavar="COUNT", type=int, default=None,
+        help="include at most COUNT instructions")
+    return parser
+
+def trace_main(args=None):
+    if args is None:
+        enable_cache()
+        args = trace_options(argparse.ArgumentParser()).parse_args()
+    from .arch.trace import read_trace, trace_to_text, trace_to_vcd
+
+    output  = args.output or sys.stdout
+    records = read_trace(args.input)
+    stop = None if args.count is None else args.start + args.count
+    records = itertools.islice(records, args.start, stop)
+    if args.pc:
+        pcs = set(args.pc)
+        records = (record for record in records if record.pc in pcs)
+    try:
+        if args.format == "text":
+            trace_to_text(records, output)
+        else:
+            trace_to_vcd(records, output)
+    except ValueError as error:
+        print(f"Error: {error}", file=sys.stderr)
+        exit(1)
+
+
+def gdbserver_options(parser):
+    parser.add_argument("input",
+        metavar="INPUT", type=argparse.FileType("r"),
+        help="read machine code (hex) from INPUT")
+    parser.add_argument("-H", "--host",
+        metavar="HOST", default="127.0.0.1",
+        help="listen on HOST (default: %(default)s)")
+    parser.add_argument("-p", "--port",
+        metavar="PORT", type=int, default=1234,
+        help="listen on TCP port PORT (default: %(default)s)")
+    parser.add_argument("-r", "--reverse",
+        default=False, action="store_true",
+        help="record execution history for reverse stepping and continuing")
+    return parser
+
+def gdbserver_main(args=None):
+    if args is None:
+        enable_cache()
+        args = gdbserver_options(argparse.ArgumentParser()).parse_args()
+    from .arch.sim import Simulator
+    from .arch.gdb import GDBStub
+    from .arch.history import History
+
+    image  = []
+    for line, word in enumerate(args.input.read().splitlines()):
+        try:
+            image.append(int(word, 16))
+        except ValueError:
+            print(f"Error: Invalid hex file at line {line+1}", file=sys.stderr)
+            exit(1)
+    print(f"Listening on {args.host}:{args.port}", file=sys.stderr)
+    sim = Simulator(image)
+    history = History(sim) if args.reverse else None
+    GDBStub(sim, history=history).listen(args.host, args.port)
+
+
+def run_options(parser):
+    parser.add_argument("input",
+        metavar="IMAGE", nargs="?",
+        help="execute machine code from IMAGE (hex, or binary if named *.bin)")
+    parser.add_argument("-l", "--limit",
+        metavar="CYCLES", type=int, default=None,
+        help="stop after CYCLES cycles")
+    parser.add_argument("--pc",
+        metavar="ADDR", type=lambda value: int(value, 16), default=0,
+        help="start execution at hex address ADDR (default: 0000)")
+    parser.add_argument("--w",
+        metavar="ADDR", type=lambda value: int(value, 16), default=0xfff8,
+        help="place the register window at hex address ADDR (default: fff8)")
+    parser.add_argument("-x", "--ext",
+        metavar="STIMULUS",
+        help="initialize external memory from STIMULUS (hex, or binary if named *.bin)")
+    parser.add_argument("-r", "--root",
+        metavar="DIR",
+        help="allow the firmware to open files in DIR through the semihosting port")
+    engine = parser.add_mutually_exclusive_group()
+    engine.add_argument("-p", "--profile",
+        metavar="PROFILE", type=argparse.FileType("w"),
+        help="write the cycles spent per call stack to PROFILE, in collapsed stack format")
+    engine.add_argument("-t", "--trace",
+        metavar="TRACE", type=argparse.FileType("wb"),
+        help="write a binary execution trace to TRACE")
+    engine.add_argument("-c", "--coverage",
+        metavar="COVERAGE", type=argparse.FileType("wb"),
+        help="write instruction and branch coverage bitmaps to COVERAGE")
+    parser.add_argument("-m", "--matrix",
+        metavar="MATRIX", type=argparse.FileType("r"),
+        help="instead of IMAGE, execute the jobs in MATRIX, one JSON object per line with "
+             "the keys \"image\", \"stimulus\" (optional), and \"limit\" (cycles, optional)")
+    parser.add_argument("-j", "--jobs",
+        metavar="N", type=int, default=None,
+        help="run N jobs from MATRIX at once (default: one per CPU)")
+    parser.add_argument("-o", "--output",
+        metavar="OUTPUT", type=argparse.FileType("w"),
+        help="write results of jobs from MATRIX to OUTPUT, one JSON object per line")
+    return parser
+
+def run_main(args=None):
+    if args is None:
+        enable_cache()
+        args = run_options(argparse.ArgumentParser()).parse_args()
+    from .arch.prof import Profiler
+    from .arch.cov import Coverage
+    from .arch.trace import Tracer
+    from .arch.runner import load_image, run_image
+
+    if (args.input is None) == (args.matrix is None):
+        print("Error: Exactly one of IMAGE and --matrix must be specified", file=sys.stderr)
+        exit(1)
+    if args.matrix is not None:
+        run_matrix(args)
+        return
+
+    try:
+        image    = load_image(args.input)
+        stimulus = () if args.ext is None else load_image(args.ext)
+    except (OSError, ValueError) as error:
+        print(f"Error: {error}", file=sys.stderr)
+        exit(1)
+    engines = []
+    def engine(sim):
+        if args.profile:
+            engines.append(Profiler(sim))
+        elif args.trace:
+            engines.append(Tracer(sim, args.trace))
+        else:
+            engines.append(Coverage(sim))
+        return engines[0]
+    files  = {0: sys.stdin.buffer, 1: sys.stdout.buffer, 2: sys.stderr.buffer}
+    traced = args.profile or args.trace or args.coverage
+    result = run_image(image, stimulus, args.limit, pc=args.pc, w=args.w, root=args.root,
+                       files=files, engine=engine if traced else None)
+    sys.stdout.flush()
+    if args.profile:
+        args.profile.write(engines[0].collapsed())
+        args.profile.close()
+    if args.trace:
+        engines[0].close()
+    if args.coverage:
+        args.coverage.write(engines[0].to_bytes())
+        args.coverage.close()
+
+    if "error" in result:
+        print(f"Error: {result['error']}", file=sys.stderr)
+    elif result["status"] is None:
+        print("Stopped: cycle limit reached", file=sys.stderr)
+    else:
+        print(f"Exited with status {result['status']}", file=sys.stderr)
+    instructions = result["instructions"]
+    print(f"cycles:       {result['cycles']}", file=sys.stderr)
+    print(f"instructions: {instructions}", file=sys.stderr)
+    print(f"CPI:          {result['cycles'] / instructions if instructions else 0:.3f}",
+          file=sys.stderr)
+    if "error" in result:
+        exit(1)
+    exit((result["status"] or 0) & 0xff)
+
+def run_matrix(args):
+    from .arch.runner import Job, run_jobs
+    jobs = []
+    for line, text in enumerate(args.matrix.read().splitlines()):
+        if not text.strip():
+            continue
+        try:
+            job = json.loads(text)
+            jobs.append(Job(job["image"], job.get("stimulus", ()), job.get("limit")))
+        except (ValueError, KeyError, TypeError):
+            print(f"Error: Invalid job at line {line+1}", file=sys.stderr)
+            exit(1)
+    output = args.output or sys.stdout
+    for result in run_jobs(jobs, processes=args.jobs):
+        output.write(json.dumps(result) + "\n")
+        output.flush()
+
+
 tools  = [
-    ("as",  as_options,  as_main),
-    ("dis", dis_options, dis_main),
+    ("as",    as_options,    as_main),
+    ("ld",    ld_options,    ld_main),
+    ("dis",   dis_options,   dis_main),
+    ("trace", trace_options, trace_main),
+    ("gdbserver", gdbserver_options, gdbserver_main),
+    ("run",   run_options,   run_main),
 ]
 
 def main():
+    enable_cache()
     parser = argparse.ArgumentParser()
     p_tool = parser.add_subparsers(dest="tool", required=True)
     for tool_name, tool_options, tool_main in tools:
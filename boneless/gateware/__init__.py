@@ -1,2 +1,3 @@
 from .alsru import ALSRU
 from .core import CoreFSM
+from .model import CoreModel
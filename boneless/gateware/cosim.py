@@ -0,0 +1,189 @@
+from amaranth import *
+from amaranth.lib import memory
+from amaranth.sim import Simulator
+
+from ..arch.opcode import Instr, EXTI
+from ..arch.sim import SimulationError, ExternalMemory, Simulator as ReferenceSimulator
+from .core import CoreFSM
+
+
+__all__ = ["DivergenceError", "cosimulate"]
+
+
+class DivergenceError(Exception):
+    pass
+
+
+class _RecordingExternalMemory(ExternalMemory):
+    def __init__(self, data=()):
+        super().__init__(data)
+        self.writes = []
+
+    def write(self, addr, data):
+        super().write(addr, data)
+        self.writes.append((addr, data))
+
+
+class _RecordingSimulator(ReferenceSimulator):
+    # Every word of main memory is watched, so that every store is reported to `_invalidate`.
+    def __init__(self, *args, **kwargs):
+        self.writes = []
+        super().__init__(*args, **kwargs, translate=False)
+
+    def flush(self):
+        super().flush()
+        self._watch[:] = b"\x01" * 0x10000
+
+    def _invalidate(self, addr):
+        super()._invalidate(addr)
+        self._watch[addr] = 1
+        self.writes.append((addr, self.mem[addr]))
+
+
+class _Testbench(Elaboratable):
+    def __init__(self, dut, ext_data):
+        self.dut = dut
+        self.ext_data = ext_data
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.dut = self.dut
+        m.submodules.ext = ext = memory.Memory(self.ext_data)
+        m_extrd = ext.read_port()
+        m_extwr = ext.write_port()
+        m.d.comb += [
+            m_extrd.addr.eq(self.dut.o_bus_addr),
+            self.dut.i_ext_data.eq(m_extrd.data),
+            m_extrd.en.eq(self.dut.o_ext_re),
+            m_extwr.addr.eq(self.dut.o_bus_addr),
+            m_extwr.data.eq(self.dut.o_ext_data),
+            m_extwr.en.eq(self.dut.o_ext_we),
+        ]
+        return m
+
+
+def _format(value):
+    if isinstance(value, int):
+        return f"{value:04x}"
+    if isinstance(value, list):
+        return "[" + ", ".join(f"{addr:04x}<-{data:04x}" for addr, data in value) + "]"
+    return repr(value)
+
+
+def _disassemble(mem, center, context):
+    lines = []
+    for addr in range(max(center - context, 0), min(center + context + 1, len(mem))):
+        try:
+            text = str(Instr.from_int(mem[addr])).expandtabs(1)
+        except ValueError:
+            text = "?"
+        marker = ">" if addr == center else " "
+        lines.append(f"{marker} {addr:04x}: {mem[addr]:04x}  {text}")
+    return "\n".join(lines)
+
+
+def cosimulate(image, *, pc=0, w=0xfff8, flags="", ext=(), limit=None, depth=0x10000,
+               context=4):
+    """Execute ``image`` in the reference simulator and in :class:`CoreFSM` in lockstep.
+
+    The reference simulator runs first, until ``limit`` instructions are executed, until it
+    reaches an illegal instruction (which the gateware does not trap), or, if ``limit`` is
+    ``None``, until it reaches an instruction that jumps to itself without changing any state,
+    and records the state after every instruction. Then :class:`CoreFSM`, connected to
+    ``depth`` words of main and external memory, runs once for the same number of instructions,
+    and its state is compared with the recorded one every time an instruction is done:
+    the program counter, the window pointer, the flags, and every word written to main and
+    external memory.
+
+    Raises :class:`DivergenceError` at the first difference, with a disassembly of ``context``
+    words around the instruction that diverged. Returns the reference simulator otherwise.
+    """
+    sim = _RecordingSimulator(image, pc=pc, w=w, ext=_RecordingExternalMemory(ext))
+    for flag in flags:
+        setattr(sim, flag, True)
+    initial = list(sim.mem)
+
+    expected = []
+    prefix   = None
+    while limit is None or len(expected) < limit:
+        start  = sim.pc
+        before = (sim.w, sim.flags)
+        try:
+            instr_cls = sim.decode(start)[0]
+            sim.step()
+        except SimulationError:
+            break
+        if instr_cls is EXTI:
+            # An EXTI prefix that is not followed by an instruction it can be fused with is
+            # executed alone by the reference simulator, but the gateware keeps fetching until
+            # it reaches such an instruction, and only then finishes.
+            if prefix is None:
+                prefix = start
+            continue
+        if prefix is not None:
+            start, prefix = prefix, None
+        expected.append((start, {
+            "PC":    sim.pc,
+            "W":     sim.w,
+            "flags": sim.flags,
+            "memory writes":   sim.writes,
+            "external writes": sim.ext.writes,
+        }))
+        halted = (sim.pc == start and (sim.w, sim.flags) == before and
+                  not sim.writes and not sim.ext.writes)
+        sim.writes, sim.ext.writes = [], []
+        if limit is None and halted:
+            # The instruction jumps to itself without changing anything, e.g. `J .` at the end
+            # of a program; it would be executed in the same way forever.
+            break
+
+    dut = CoreFSM(reset_pc=pc, reset_w=w,
+                  mem_data=memory.MemoryData(shape=16, depth=depth, init=image[:depth]))
+    testbench = _Testbench(dut, memory.MemoryData(shape=16, depth=depth, init=ext[:depth]))
+    divergence = None
+
+    async def compare(ctx):
+        nonlocal divergence
+        for flag in flags:
+            ctx.set(dut.r_f[flag], 1)
+        for index, (start, state) in enumerate(expected):
+            writes, ext_writes = [], []
+            while True:
+                if ctx.get(dut.o_mem_we):
+                    # Shifts write the intermediate result back to the register every cycle;
+                    # only the last of consecutive writes to the same word is observable.
+                    addr = ctx.get(dut.o_bus_addr)
+                    if writes and writes[-1][0] == addr:
+                        writes.pop()
+                    writes.append((addr, ctx.get(dut.o_mem_data)))
+                if ctx.get(dut.o_ext_we):
+                    ext_writes.append((ctx.get(dut.o_bus_addr), ctx.get(dut.o_ext_data)))
+                done = ctx.get(dut.o_done)
+                await ctx.tick()
+                if done:
+                    break
+            actual = {
+                "PC":    ctx.get(dut.o_pc),
+                "W":     ctx.get(dut.r_w) << 3,
+                "flags": "".join(flag for flag in "zscv" if ctx.get(dut.r_f[flag])),
+                "memory writes":   writes,
+                "external writes": ext_writes,
+            }
+            if actual != state:
+                divergence = index, start, state, actual
+                return
+
+    gateware = Simulator(testbench)
+    gateware.add_clock(1e-6)
+    gateware.add_testbench(compare)
+    gateware.run()
+
+    if divergence is not None:
+        index, start, state, actual = divergence
+        details = "\n".join(f"  {name} is {_format(actual[name])}, "
+                            f"expected {_format(state[name])}"
+                            for name in state if actual[name] != state[name])
+        raise DivergenceError(f"Divergence at instruction {index} (address {start:04x}):\n"
+                              f"{details}\n"
+                              f"{_disassemble(initial, start, context)}")
+    return sim
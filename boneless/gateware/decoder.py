@@ -3,6 +3,7 @@ from amaranth.lib import enum, data, wiring
 from amaranth.lib.wiring import In, Out
 
 from ..arch import instr as instr, opcode as opcode
+from ..arch.trace import format_insn
 from .alsru import ALSRU
 
 
@@ -181,13 +182,7 @@ class InstructionDecoder(wiring.Component):
             "r_exti":  Out(1),
         })
 
-        def insn_decoder(encoding):
-            try:
-                insn = opcode.Instr.from_int(encoding)
-                return str(insn).expandtabs(1)
-            except ValueError:
-                return "{:04x}".format(encoding)
-        self.i_insn = Signal.like(self.i_insn, decoder=insn_decoder)
+        self.i_insn = Signal.like(self.i_insn, decoder=format_insn)
 
         self.m_imm  = ImmediateDecoder()
 
@@ -0,0 +1,145 @@
+from amaranth import *
+from amaranth.lib import data, wiring
+from amaranth.lib.wiring import In, Out
+
+from ..arch.sim import _Suspended, Device, ExternalBus, Simulator as ReferenceSimulator
+
+
+__all__ = ["CoreModel"]
+
+
+class _PortDevice(Device):
+    # Performs external bus accesses through the ports of the model, at the same cycles as
+    # `CoreFSM` would.
+    def __init__(self, core):
+        self.core = core
+
+    def read(self, addr):
+        return self.core._read(addr)
+
+    def write(self, addr, data):
+        return self.core._write(addr, data)
+
+    def next_event(self, cycles):
+        # Registers of devices in the gateware may change at any cycle.
+        return cycles + 1
+
+
+class CoreModel(wiring.Component):
+    """Behavioural model of :class:`CoreFSM` for simulation.
+
+    Has the same signature as :class:`CoreFSM`, but no logic of its own: instructions are
+    executed by :class:`boneless.arch.sim.Simulator` in the simulator process :meth:`process`,
+    which must be added to the Amaranth simulator with ``add_process``.
+
+    The model runs ahead of the gateware for up to ``quantum`` instructions at a time, and only
+    waits for the clock before external bus accesses, which are made in the same cycles and with
+    the same signals as in :class:`CoreFSM`. The main memory is kept by the model and initialized
+    from ``mem_data``; the main memory ports are not used. ``o_pc``, ``r_w``, and ``r_f`` are
+    updated before every external bus access and after every ``quantum`` instructions; the rest
+    of the outputs, which are internal to :class:`CoreFSM`, are not driven.
+
+    If ``period`` is the period of the ``sync`` clock in seconds, the model waits for the clock
+    with a delay instead of with one wakeup per cycle, which is several times faster.
+    """
+    def __init__(self, reset_pc=0, reset_w=0xffff, mem_data=None, *, quantum=1000, period=None):
+        # Same as the signature of `CoreFSM`.
+        super().__init__({
+            "o_pc":       Out(16),
+            "r_w":        Out(13, init=reset_w >> 3),
+            "r_f":        Out(data.StructLayout({"z": 1, "s": 1, "c": 1, "v": 1})),
+
+            "r_insn":     Out(16),
+            "s_base":     Out(16),
+            "s_a":        Out(16),
+            "r_a":        Out(16),
+            "s_b":        Out(16),
+
+            "r_cycle":    Out(1),
+            "o_done":     Out(1),
+
+            "o_bus_addr": Out(16),
+
+            "i_mem_data": In(16),
+            "o_mem_re":   Out(1),
+            "o_mem_data": Out(16),
+            "o_mem_we":   Out(1),
+
+            "i_ext_data": In(16),
+            "o_ext_re":   Out(1),
+            "o_ext_data": Out(16),
+            "o_ext_we":   Out(1),
+        })
+
+        bus = ExternalBus()
+        bus.add(_PortDevice(self), 0, 0x10000)
+        image = [] if mem_data is None else list(mem_data.init)
+        self.sim     = ReferenceSimulator(image, pc=reset_pc, w=reset_w, ext=bus)
+        self.quantum = quantum
+        self.period  = period
+
+        self.mem_data = mem_data
+        self._ctx     = None
+        # Number of clock cycles the gateware has been simulated for.
+        self._cycles  = 0
+
+    def elaborate(self, platform):
+        return Module()
+
+    async def _advance(self, cycles):
+        ctx, sim = self._ctx, self.sim
+        if cycles > self._cycles:
+            # Waking up on every clock edge takes most of the time spent in the model; if the clock
+            # period is known, most of the edges are skipped over.
+            await ctx.tick()
+            remaining = cycles - self._cycles - 1
+            if self.period is not None and remaining > 1:
+                await ctx.delay((remaining - 0.5) * self.period)
+                await ctx.tick()
+            else:
+                for _ in range(remaining):
+                    await ctx.tick()
+            self._cycles = cycles
+        ctx.set(self.o_pc, sim.pc)
+        ctx.set(self.r_w, sim.w >> 3)
+        for flag in "zscv":
+            ctx.set(self.r_f[flag], getattr(sim, flag))
+
+    # The instruction making the access starts with a FETCH cycle at `sim.cycles`, followed by
+    # one LOAD-A cycle per word, a LOAD-B cycle, and an EXECUTE cycle.
+
+    async def _read(self, addr):
+        ctx, sim = self._ctx, self.sim
+        _, length, *_ = sim.decode(sim.pc)
+        await self._advance(sim.cycles + length + 1)
+        ctx.set(self.o_bus_addr, addr)
+        ctx.set(self.o_ext_re, 1)
+        await ctx.tick()
+        ctx.set(self.o_ext_re, 0)
+        _, _, data = await ctx.tick().sample(self.i_ext_data)
+        self._cycles += 2
+        return data
+
+    async def _write(self, addr, data):
+        ctx, sim = self._ctx, self.sim
+        _, length, *_ = sim.decode(sim.pc)
+        await self._advance(sim.cycles + length + 2)
+        ctx.set(self.o_bus_addr, addr)
+        ctx.set(self.o_ext_data, data)
+        ctx.set(self.o_ext_we, 1)
+        await ctx.tick()
+        ctx.set(self.o_ext_we, 0)
+        self._cycles += 1
+
+    async def process(self, ctx):
+        """Execute instructions, and drive the outputs accordingly. Raises
+        :class:`boneless.arch.sim.SimulationError` on an illegal instruction."""
+        self._ctx = ctx
+        sim = self.sim
+        while True:
+            try:
+                sim.run(self.quantum)
+            except _Suspended as suspended:
+                sim.ext._resumed = (suspended.key, await suspended.awaitable)
+                continue
+            await self._advance(sim.cycles)
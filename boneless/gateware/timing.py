@@ -0,0 +1,95 @@
+from amaranth.sim import Simulator
+
+from ..arch import instr as instr, opcode as opcode
+from .decoder import InstructionDecoder
+
+
+__all__ = ["TimingModel"]
+
+
+class TimingModel:
+    """Cycle-accurate timing model of :class:`CoreFSM`.
+
+    The number of cycles spent on each instruction class is derived by simulating
+    :class:`InstructionDecoder` once for every class, and follows the states of :class:`CoreFSM`:
+
+    * instructions the decoder skips (EXTI prefixes) spend one LOAD-A cycle, during which
+      the next instruction is fetched;
+    * other instructions spend FETCH, LOAD-A, LOAD-B and EXECUTE cycles;
+    * multicycle instructions spend one more EXECUTE cycle;
+    * shifts spend one more EXECUTE cycle per bit of shift amount.
+
+    The table is available as ``cycles``, mapping instruction classes to the number of cycles
+    they spend with a zero shift amount. The classes whose timing depends on the shift amount
+    are in ``shifts``.
+    """
+    def __init__(self):
+        self.cycles = {}
+        self.shifts = set()
+
+        encodings = {}
+        for word, instr_cls in sorted(opcode.Instr.decodings.items()):
+            encodings.setdefault(instr_cls, word)
+
+        dut = InstructionDecoder()
+        async def testbench(ctx):
+            for instr_cls, word in encodings.items():
+                ctx.set(dut.i_insn, word)
+                if ctx.get(dut.o_skip):
+                    self.cycles[instr_cls] = 1
+                    continue
+                self.cycles[instr_cls] = 4 + ctx.get(dut.o_multi)
+                if ctx.get(dut.o_shift):
+                    self.shifts.add(instr_cls)
+        sim = Simulator(dut)
+        sim.add_testbench(testbench)
+        sim.run()
+
+    def instr_cycles(self, image, addr, shamt=None):
+        """Return the number of cycles spent on the instruction at ``addr`` in ``image``, and
+        its length.
+
+        An EXTI prefix is counted together with the instruction following it, unless that is
+        another prefix. The shift amount of a register shift must be provided as ``shamt``.
+        """
+        word   = image[addr]
+        length = 1
+        cycles = 0
+        instr_cls = opcode.Instr.decodings.get(word)
+        if instr_cls is None:
+            raise ValueError(f"Illegal instruction {word:04x} at {addr:04x}")
+        if instr_cls is opcode.EXTI and addr + 1 < len(image):
+            next_cls = opcode.Instr.decodings.get(image[addr + 1])
+            if next_cls is not None and next_cls is not opcode.EXTI:
+                cycles += self.cycles[instr_cls]
+                length += 1
+                ext_word, word, instr_cls = word, image[addr + 1], next_cls
+        cycles += self.cycles[instr_cls]
+        if instr_cls in self.shifts:
+            if issubclass(instr_cls, opcode.M_RRI):
+                if length == 2:
+                    shamt = ext_word << 3 | word & 0x7
+                else:
+                    shamt = instr.Imm3SR.lut_to_imm[word & 0x7]
+            elif shamt is None:
+                raise ValueError(f"Shift amount of {instr_cls.__name__} at {addr:04x} "
+                                 f"must be provided")
+            cycles += shamt & 0xf
+        return cycles, length
+
+    def path_cycles(self, image, path):
+        """Return the number of cycles spent executing ``image`` along ``path``.
+
+        Each element of ``path`` is the address of an executed instruction (with EXTI prefixes
+        counted as a part of the instruction that follows them), or, for register shifts,
+        an ``(addr, shamt)`` tuple.
+        """
+        total = 0
+        for step in path:
+            if isinstance(step, tuple):
+                addr, shamt = step
+            else:
+                addr, shamt = step, None
+            cycles, _ = self.instr_cycles(image, addr, shamt)
+            total += cycles
+        return total
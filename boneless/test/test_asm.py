@@ -1,9 +1,12 @@
 from contextlib import contextmanager
+import os
+import tempfile
 import unittest
 
 from ..arch.opcode import Instr
 from ..arch.opcode import *
-from ..arch.asm import TranslationError
+from ..arch.instr import Imm3AL
+from ..arch.asm import TranslationError, _isa_digest, _isa_digests
 
 
 class AssemblerTestCase(unittest.TestCase):
@@ -125,11 +128,74 @@ class AssemblerTestCase(unittest.TestCase):
              int(J(-1)),
              5678])
 
+    def test_labels(self):
+        labels = {}
+        Instr.assemble([
+             L("start"),
+             MOVI(R0, 0x1234),
+             L("loop"),
+             J("end"),
+             L("end"),
+            ], labels=labels)
+        self.assertEqual(labels, {"start": 0, "loop": 2, "end": 3})
+
+    def test_stats(self):
+        stats = {}
+        Instr.assemble([
+             J("foo"),
+             [0] * 126,
+             J("foo"),
+             L("foo"),
+            ], stats=stats)
+        # The first jump only fits once the second one is shrunk.
+        self.assertEqual(stats, {"passes": 2, "shrinks": 2})
+
+    def test_locs(self):
+        locs = {}
+        Instr.assemble("start: MOVI R0, 0x1234\n.word 5\n\nJ start\n", locs=locs)
+        self.assertEqual(locs, {0: (0, 1), 3: (3, 0)})
+
+    def test_cache(self):
+        text = "start: MOVI R0, 0x1234\n.word 5\n\nJ start\n"
+        with tempfile.TemporaryDirectory() as cache_dir:
+            results = []
+            for _ in range(2):
+                labels, locs, stats = {}, {}, {}
+                results.append((Instr.assemble(text, labels=labels, locs=locs, stats=stats,
+                                               cache_dir=cache_dir), labels, locs, stats))
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            self.assertEqual(results[0][:3], results[1][:3])
+            self.assertEqual(results[0][0], Instr.assemble(text))
+            # The second time, the output is not assembled, but read from the cache.
+            self.assertEqual(results[1][3], {"passes": 0, "shrinks": 0})
+            # Only text is cached.
+            Instr.assemble([J("start"), L("start")], cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_cache_lut(self):
+        # The cache is invalidated by a change to the lookup tables of immediates, which changes
+        # the encoding of instructions without changing their mnemonics or formats.
+        digest = _isa_digest(Instr)
+        lut_to_imm = Imm3AL.lut_to_imm
+        try:
+            Imm3AL.lut_to_imm = [*lut_to_imm[:3], 0x4321, *lut_to_imm[4:]]
+            del _isa_digests[Instr]
+            self.assertNotEqual(_isa_digest(Instr), digest)
+        finally:
+            Imm3AL.lut_to_imm = lut_to_imm
+            del _isa_digests[Instr]
+        self.assertEqual(_isa_digest(Instr), digest)
+
     def test_wrong_dup_label(self):
         self.assertTranslationError(
             [L("foo"), L("foo")],
             r"Label 'foo' at indexes \[1\] has the same name as the label at indexes \[0\]")
 
+    def test_wrong_callable_label(self):
+        self.assertTranslationError(
+            [lambda resolver: L("foo")],
+            r"Label 'foo' at indexes \[0\] is returned by a callable")
+
     def test_wrong_unrecognized(self):
         self.assertTranslationError(
             ["xxx"],
@@ -0,0 +1,115 @@
+import unittest
+
+try:
+    import numpy as np
+    from ..arch.batch import *
+except ImportError:
+    np = None
+
+from ..arch.opcode import Instr
+from ..arch.opcode import *
+from ..arch.sim import Simulator, ExternalMemory
+from .smoke import SmokeTestCase
+
+
+@unittest.skipUnless(np, "NumPy is not installed")
+class BatchSimulatorSmokeTestCase(SmokeTestCase, unittest.TestCase):
+    count = 3
+
+    def run_simulator(self, case):
+        for _ in case(self):
+            pass
+
+    def execute(self, code, regs=[], data=[], extr=[], flags="", limit=None):
+        code = Instr.assemble(code)
+        if limit is None:
+            limit = len(code)
+        self.sim = BatchSimulator(self.count, [*regs, *[0] * (8 - len(regs)), *code, *data],
+                                  pc=8, w=0, ext=BatchExternalMemory(self.count, extr))
+        for flag in flags:
+            getattr(self.sim, flag)[:] = True
+        self.sim.run(limit)
+        yield
+
+    def assertF(self, flags):
+        for flag in "zscv":
+            self.assertEqual(getattr(self.sim, flag).tolist(), [flag in flags] * self.count,
+                             msg=f"F.{flag}")
+        yield
+
+    def assertW(self, win):
+        self.assertEqual(self.sim.w.tolist(), [win] * self.count, msg=f"W")
+        yield
+
+    def assertPC(self, addr):
+        self.assertEqual(self.sim.pc.tolist(), [addr] * self.count, msg=f"PC")
+        yield
+
+    def assertMemory(self, addr, value):
+        self.assertEqual(self.sim.mem[:, addr].tolist(), [value] * self.count, msg=f"M[{addr}]")
+        yield
+
+    def assertExternal(self, addr, value):
+        self.assertEqual(self.sim.ext.data[:, addr].tolist(), [value] * self.count,
+                         msg=f"X[{addr}]")
+        yield
+
+
+@unittest.skipUnless(np, "NumPy is not installed")
+class BatchSimulatorTestCase(unittest.TestCase):
+    def test_reset(self):
+        sim = BatchSimulator(4)
+        self.assertEqual(sim.pc.tolist(), [0] * 4)
+        self.assertEqual(sim.w.tolist(), [0xfff8] * 4)
+        self.assertEqual(sim.regs.shape, (4, 8))
+
+    def test_divergent(self):
+        code = Instr.assemble([
+                LDXA(R0, 0),
+                MOVI(R1, 0),
+            L("loop"),
+                ADDI(R1, R1, 3),
+                ROLI(R2, R1, 7),
+                XOR (R3, R3, R2),
+                SUBI(R0, R0, 1),
+                BZ  ("done"),
+                ANDI(R4, R0, 1),
+                BNZ ("loop"),
+                JAL (R7, "sub"),
+                J   ("loop"),
+            L("sub"),
+                STX (R3, R0, 0x10),
+                JR  (R7, 0),
+            L("done"),
+                J   ("done"),
+        ])
+        counts = [1, 5, 0x100, 20, 7]
+        ext = BatchExternalMemory(len(counts))
+        ext.data[:, 0] = counts
+        batch = BatchSimulator(len(counts), code, w=0x100, ext=ext)
+        batch.run(until={len(code) - 1})
+        self.assertTrue(batch.halted.all())
+        for index, count in enumerate(counts):
+            sim = Simulator(code, w=0x100, ext=ExternalMemory([count]))
+            sim.run(until={len(code) - 1})
+            self.assertEqual(batch.instructions[index], sim.instructions)
+            self.assertEqual(batch.regs[index].tolist(), sim.regs)
+            self.assertEqual(batch.ext.data[index, :0x200].tolist(), sim.ext.data[:0x200])
+            self.assertEqual("".join(flag for flag in "zscv" if getattr(batch, flag)[index]),
+                             sim.flags)
+
+    def test_illegal(self):
+        code = Instr.assemble([
+            LDXA(R0, 0),
+            JR  (R0, 0),
+            J   (-1),
+            0xffff,
+        ])
+        ext = BatchExternalMemory(2)
+        ext.data[:, 0] = [2, 3]
+        sim = BatchSimulator(2, code, w=0x100, ext=ext)
+        self.assertEqual(sim.run(5), 5)
+        self.assertEqual(sim.illegal.tolist(), [False, True])
+        self.assertEqual(sim.halted.tolist(), [False, True])
+        self.assertEqual(sim.pc.tolist(), [2, 3])
+        self.assertEqual(sim.instructions.tolist(), [5, 2])
@@ -0,0 +1,89 @@
+import os
+import sys
+import tempfile
+import unittest
+import subprocess
+
+from ..arch.cache import *
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.environ   = os.environ.get("BONELESS_CACHE_DIR")
+        os.environ["BONELESS_CACHE_DIR"] = self.directory.name
+
+    def tearDown(self):
+        if self.environ is None:
+            del os.environ["BONELESS_CACHE_DIR"]
+        else:
+            os.environ["BONELESS_CACHE_DIR"] = self.environ
+        self.directory.cleanup()
+
+    def test_roundtrip(self):
+        self.assertEqual(cache_dir(), self.directory.name)
+        self.assertIsNone(read_cache("foo"))
+        write_cache("foo", b"bar")
+        self.assertEqual(read_cache("foo"), b"bar")
+        write_cache("foo", b"baz")
+        self.assertEqual(read_cache("foo"), b"baz")
+        self.assertEqual(len(os.listdir(self.directory.name)), 1)
+
+    def test_disabled(self):
+        os.environ["BONELESS_CACHE_DIR"] = ""
+        self.assertIsNone(cache_dir())
+        write_cache("foo", b"bar")
+        self.assertIsNone(read_cache("foo"))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_entries(self):
+        directory = self.directory.name
+        self.assertIsNone(read_entry(directory, "a"))
+        write_entry(directory, "a", [1, 0xffff], b"meta", max_size=100)
+        self.assertEqual(read_entry(directory, "a"), ([1, 0xffff], b"meta"))
+        write_entry(directory, "b", [2] * 10, b"", max_size=100)
+        # Entries are evicted in least recently used order.
+        os.utime(os.path.join(directory, "a.entry"), ns=(1, 1))
+        os.utime(os.path.join(directory, "b.entry"), ns=(2, 2))
+        self.assertEqual(read_entry(directory, "a"), ([1, 0xffff], b"meta"))
+        write_entry(directory, "c", [3] * 40, b"", max_size=100)
+        self.assertEqual(sorted(os.listdir(directory)), ["a.entry", "c.entry"])
+        # A damaged entry is ignored.
+        with open(os.path.join(directory, "c.entry"), "wb") as file:
+            file.write(b"\xff\xff\x00\x00")
+        self.assertIsNone(read_entry(directory, "c"))
+
+    def test_instr_code(self):
+        def run():
+            return subprocess.run(
+                [sys.executable, "-c",
+                 "from boneless.arch.opcode import Instr; "
+                 "print(repr(Instr.from_str('ADDI R1, R2, 3')), len(Instr.decodings))"],
+                cwd=os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+                capture_output=True, text=True, check=True).stdout
+        output = run()
+        self.assertEqual(output, "ADDI(R1, R2, 3) 47400\n")
+        names = os.listdir(self.directory.name)
+        self.assertEqual([name.split(".")[:-1] for name in names],
+                         [["instr-boneless", "arch", "opcode"]])
+        # The cached code is used, and the cache is not written again.
+        path  = os.path.join(self.directory.name, names[0])
+        mtime = os.stat(path).st_mtime_ns
+        self.assertEqual(run(), output)
+        self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+        # A damaged cache is ignored, and replaced.
+        with open(path, "wb") as file:
+            file.write(b"\x00")
+        self.assertEqual(run(), output)
+        self.assertNotEqual(os.path.getsize(path), 1)
+
+    def test_instr_code_not_enabled(self):
+        # The default cache directory is only read, unless a command line tool is run.
+        env = dict(os.environ, HOME=self.directory.name, XDG_CACHE_HOME=self.directory.name)
+        del env["BONELESS_CACHE_DIR"]
+        subprocess.run(
+            [sys.executable, "-c",
+             "from boneless.arch.opcode import Instr; Instr.assemble('MOVI R0, 1')"],
+            cwd=os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+            check=True, env=env)
+        self.assertEqual(os.listdir(self.directory.name), [])
@@ -0,0 +1,112 @@
+import unittest
+
+from ..arch.opcode import Instr
+from ..arch.opcode import *
+from ..gateware.cosim import *
+
+
+class CoSimulationTestCase(unittest.TestCase):
+    def test_agrees(self):
+        image = [0] * 8 + Instr.assemble([
+                LDXA(R0, 0),
+                MOVI(R6, 0x1234),
+            L("loop"),
+                ADD (R1, R1, R0),
+                SBCI(R2, R1, 0x55),
+                ROL (R3, R2, R0),
+                SRAI(R4, R3, 3),
+                CMP (R4, R2),
+                BLTS("skip"),
+                STX (R3, R0, 1),
+            L("skip"),
+                JAL (R7, "sub"),
+                SUBI(R0, R0, 1),
+                BNZ ("loop"),
+            L("done"),
+                J   ("done"),
+            L("sub"),
+                LDW (R5, -8),
+                STR (R5, R0, 0x50),
+                ADJW(8),
+                XCHW(R6, R6),
+                STW (R6),
+                JR  (R7, 0),
+        ])
+        sim = cosimulate(image, pc=8, w=0x40, flags="c", ext=[5], limit=100, depth=0x100)
+        self.assertEqual(sim.instructions, 100)
+
+    def test_illegal(self):
+        image = Instr.assemble([MOVI(R0, 1)]) + [0xffff]
+        sim = cosimulate(image, w=0x10, depth=0x20)
+        self.assertEqual(sim.instructions, 1)
+
+    def test_diverges(self):
+        # Memory of the gateware is smaller than the address space, so that the store aliases
+        # the register window.
+        image = Instr.assemble([
+            MOVI(R0, 0x1234),
+            ST  (R0, R1, 0x32),
+            ADD (R3, R2, R2),
+        ])
+        with self.assertRaisesRegex(DivergenceError,
+                r"^Divergence at instruction 2 \(address 0004\):\n"
+                r"  flags is '', expected 'z'\n"
+                r"  memory writes is \[0013<-2468\], expected \[0013<-0000\]\n"
+                r"(.+\n)*> 0004: 1342  ADD R3, R2, R2\n"):
+            cosimulate(image, w=0x10, depth=0x20, limit=3)
+
+    def test_agrees_jumps(self):
+        image = [0] * 8 + Instr.assemble([
+                MOVI(R0, 0),
+                LDX (R2, R0, 0x100),
+                STX (R2, R0, 0x180),
+                LDX (R3, R0, 1),
+                STX (R3, R0, 2),
+                MOVI(R1, 1),
+                JST (R1, "table"),
+            L("table"),
+                0, 2,
+                MOVR(R4, "vectors"),
+                JVT (R4, 1),
+            L("vectors"),
+                0, 3, 0,
+                MOVR(R5, "far_vectors"),
+                SUBI(R5, R5, 100),
+                JVT (R5, 100),
+            L("far_vectors"),
+                101,
+            L("back"),
+                MOVR(R6, "sub"),
+                JRAL(R7, R6),
+            L("done"),
+                J   ("done"),
+            L("sub"),
+                JST (R1, "far_table"),
+                *[0] * 20,
+            L("far_table"),
+                0, 2,
+            L("ret"),
+                JR  (R7, 0),
+        ])
+        self.assertEqual(Instr.from_int(image[9]), EXTI(0x100 >> 3))
+        # Without a limit, the simulation stops at the jump to itself.
+        sim = cosimulate(image, pc=8, w=0x40, ext=[5, 6] + [0] * 0xfe + [7], depth=0x200)
+        self.assertEqual(sim.instructions, 17)
+        self.assertEqual(sim.regs[2:4], [7, 6])
+
+    def test_exti_chain(self):
+        # The gateware executes an EXTI prefix that is not followed by an instruction it can be
+        # fused with together with the following instructions.
+        image = Instr.assemble([EXTI(1), EXTI(2), MOVI(R0, 5), EXTI(3)]) + [0xffff]
+        sim = cosimulate(image, w=0x10, depth=0x20)
+        self.assertEqual(sim.regs[0], 2 << 3 | 5)
+        self.assertEqual(sim.instructions, 3)
+
+    def test_halt(self):
+        image = Instr.assemble([
+                MOVI(R0, 1),
+            L("halt"),
+                J   ("halt"),
+        ])
+        sim = cosimulate(image, w=0x10, depth=0x20)
+        self.assertEqual(sim.instructions, 2)
@@ -0,0 +1,93 @@
+import unittest
+
+from ..arch.opcode import Instr
+from ..arch.sim import Simulator
+from ..arch.cov import *
+
+
+class CoverageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.source = (
+            "main:  MOVI R0, 3\n"
+            "loop:  SUBI R0, R0, 1\n"
+            "       BNZ loop\n"
+            "       CMPI R1, 0\n"
+            "       BNZ other\n"
+            "done:  J done\n"
+            "other: MOVI R2, 1\n"
+            "       J done\n"
+        )
+        self.labels = {}
+        self.locs   = {}
+        self.image  = Instr.assemble(self.source, labels=self.labels, locs=self.locs)
+
+    def run_coverage(self, r1=0, limit=100):
+        sim = Simulator(self.image)
+        sim.mem[sim.w + 1] = r1
+        coverage = Coverage(sim)
+        self.assertEqual(coverage.run(limit), limit)
+        return coverage
+
+    def test_bitmaps(self):
+        coverage = self.run_coverage()
+        self.assertEqual(coverage.executed[0], 0b111111)
+        self.assertEqual(coverage.executed[1], 0)
+        self.assertEqual(coverage.taken[0], 0b000100)
+        self.assertEqual(coverage.not_taken[0], 0b010100)
+
+    def test_interpreted(self):
+        # Stepping through the uncovered instructions doesn't translate any block.
+        coverage = self.run_coverage(limit=12)
+        self.assertEqual(coverage.executed[0], 0b111111)
+        self.assertEqual(coverage.sim._blocks, [None] * 0x10000)
+
+    def test_until(self):
+        sim = Simulator(self.image)
+        coverage = Coverage(sim)
+        self.assertEqual(coverage.run(until={self.labels["done"]}), 9)
+        self.assertEqual(sim.pc, self.labels["done"])
+        self.assertEqual(coverage.run(10), 10)
+
+    def test_merge(self):
+        first, second = self.run_coverage(), self.run_coverage(r1=1)
+        merged = first | second
+        self.assertEqual(merged.executed[0], 0b11111111)
+        self.assertEqual(merged.taken[0], 0b010100)
+        self.assertEqual(merged, Coverage.from_bytes(merged.to_bytes()))
+        first |= second
+        self.assertEqual(first, merged)
+        with self.assertRaisesRegex(ValueError, r"must be 24576 bytes long, not 1"):
+            Coverage.from_bytes(b"\0")
+
+    def test_merged_run(self):
+        sim = Simulator(self.image)
+        coverage = self.run_coverage() | self.run_coverage(r1=1)
+        coverage.sim = sim
+        self.assertEqual(coverage.run(100), 100)
+        self.assertEqual(coverage, self.run_coverage() | self.run_coverage(r1=1))
+
+    def test_select(self):
+        coverages = [self.run_coverage(limit=1), self.run_coverage(),
+                     self.run_coverage(limit=10), self.run_coverage(r1=1)]
+        self.assertEqual(select(coverages), [3, 1])
+        self.assertEqual(select([]), [])
+
+    def test_table(self):
+        self.assertEqual(self.run_coverage().table(self.image, self.locs, self.labels),
+            "label        instrs      %      branches      %\n"
+            "main            1/1 100.00           0/0      -\n"
+            "loop            4/4 100.00           3/4  75.00\n"
+            "done            1/1 100.00           0/0      -\n"
+            "other           0/2   0.00           0/0      -\n"
+            "total           6/8  75.00           3/4  75.00\n")
+
+    def test_annotate(self):
+        self.assertEqual(self.run_coverage().annotate(self.source, self.image, self.locs),
+            "+ main:  MOVI R0, 3\n"
+            "+ loop:  SUBI R0, R0, 1\n"
+            "+        BNZ loop\n"
+            "+        CMPI R1, 0\n"
+            "N        BNZ other\n"
+            "+ done:  J done\n"
+            "- other: MOVI R2, 1\n"
+            "-        J done\n")
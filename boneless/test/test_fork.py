@@ -0,0 +1,43 @@
+import os
+import unittest
+
+from ..arch.opcode import Instr
+from ..arch.opcode import *
+from ..arch.sim import Simulator
+from ..arch.fork import *
+
+
+def _run_tail(sim, value):
+    sim.mem[sim.w] = value
+    sim.run(until={3})
+    return sim.regs[0], sim.instructions
+
+
+def _fail(sim, value):
+    raise ValueError(f"failed with {value}")
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "os.fork is not available")
+class ForkServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sim = Simulator(Instr.assemble([
+                MOVI(R1, 1),
+            L("loop"),
+                SUBI(R0, R0, 1),
+                BNZ ("loop"),
+            L("done"),
+                J   ("done"),
+        ]), w=0x10)
+        self.sim.run(1)
+
+    def test_map(self):
+        server = ForkServer(self.sim, jobs=3)
+        self.assertEqual(list(server.map(_run_tail, range(1, 11))),
+                         [(0, 1 + 2 * value) for value in range(1, 11)])
+        self.assertEqual(self.sim.instructions, 1)
+
+    def test_error(self):
+        server = ForkServer(self.sim, jobs=2)
+        with self.assertRaisesRegex(ForkError,
+                r"(?s)^Child process \d+ raised an exception:\n.+ValueError: failed with 1"):
+            list(server.map(_fail, range(1, 5)))
@@ -0,0 +1,178 @@
+import socket
+import threading
+import unittest
+
+from ..arch.opcode import Instr
+from ..arch.opcode import *
+from ..arch.sim import Simulator
+from ..arch.gdb import GDBStub
+from ..arch.history import History
+
+
+class GDBStubTestCase(unittest.TestCase):
+    def setUp(self):
+        labels = {}
+        self.code = Instr.assemble([
+                MOVI(R0, 0),
+                MOVI(R1, 0x100),
+            L("loop"),
+                ADDI(R0, R0, 1),
+                ST  (R0, R1, 0),
+                ADDI(R1, R1, 1),
+                CMPI(R0, 10),
+                BNE ("loop"),
+            L("done"),
+                J   ("done"),
+        ], labels=labels)
+        self.labels = labels
+        self.sim  = Simulator(self.code, w=0x10)
+        self.stub = GDBStub(self.sim)
+
+    def test_regs(self):
+        self.sim.mem[0x12] = 0xabcd
+        self.sim.c = True
+        regs = self.stub.handle("g")
+        self.assertEqual(regs, "0000" * 2 + "cdab" + "0000" * 5 + "00000000" + "20000000" + "0400")
+        self.assertEqual(self.stub.handle("p2"), "cdab")
+        self.assertEqual(self.stub.handle("p9"), "20000000")
+        self.assertEqual(self.stub.handle("pb"), "E01")
+        self.assertEqual(self.stub.handle("P3=3412"), "OK")
+        self.assertEqual(self.sim.mem[0x13], 0x1234)
+        self.assertEqual(self.stub.handle("P8=08000000"), "OK")
+        self.assertEqual(self.sim.pc, 4)
+        self.assertEqual(self.stub.handle("G" + regs), "OK")
+        self.assertEqual(self.stub.handle("g"), regs)
+
+    def test_mem(self):
+        self.assertEqual(self.stub.handle("m0,4"), self.code[0].to_bytes(2, "little").hex() +
+                                                   self.code[1].to_bytes(2, "little").hex())
+        self.assertEqual(self.stub.handle("M201,3:aabbcc"), "OK")
+        self.assertEqual(self.sim.mem[0x100], 0xaa00)
+        self.assertEqual(self.sim.mem[0x101], 0xccbb)
+        self.assertEqual(self.stub.handle("m201,3"), "aabbcc")
+
+    def test_mem_invalidate(self):
+        self.stub.handle("s")
+        self.assertEqual(self.sim.regs[0], 0)
+        # Patch `MOVI R1, 0x100` into `MOVI R1, 0x42`.
+        self.stub.handle("M2,2:" + int(MOVI(R1, 0x42)).to_bytes(2, "little").hex())
+        self.sim.pc = 0
+        self.stub.handle("s")
+        self.stub.handle("s")
+        self.assertEqual(self.sim.regs[1], 0x42)
+
+    def test_step(self):
+        self.assertEqual(self.stub.handle("s"), "S05")
+        self.assertEqual(self.sim.pc, 1)
+        self.assertEqual(self.stub.handle("s"), "S05")
+        self.assertEqual(self.stub.handle("s"), "S05")
+        self.assertEqual(self.sim.regs[0], 1)
+        self.assertEqual(self.sim.instructions, 3)
+
+    def test_step_loop(self):
+        # Stepping through a loop many times never translates it.
+        for _ in range(40):
+            self.assertEqual(self.stub.handle("s"), "S05")
+        self.assertEqual(self.sim.instructions, 40)
+        self.assertEqual(self.sim._blocks, [None] * 0x10000)
+
+    def test_breakpoint(self):
+        done = self.labels["done"] * 2
+        self.assertEqual(self.stub.handle(f"Z0,{done:x},2"), "OK")
+        self.assertEqual(self.stub.handle("c"), "S05")
+        self.assertEqual(self.sim.pc, self.labels["done"])
+        self.assertEqual(self.sim.regs[0], 10)
+        self.assertEqual(self.stub.handle(f"z0,{done:x},2"), "OK")
+
+        loop = self.labels["loop"] * 2
+        self.sim.pc = 0
+        self.assertEqual(self.stub.handle(f"Z1,{loop:x},2"), "OK")
+        for iteration in range(1, 4):
+            self.assertEqual(self.stub.handle("c"), "S05")
+            self.assertEqual(self.sim.pc, self.labels["loop"])
+            self.assertEqual(self.sim.regs[0], iteration - 1)
+
+    def test_watchpoint(self):
+        self.assertEqual(self.stub.handle(f"Z2,{0x105 * 2:x},2"), "OK")
+        self.assertEqual(self.stub.handle("c"), f"T05watch:{0x105 * 2:x};")
+        self.assertEqual(self.sim.mem[0x105], 6)
+        self.assertEqual(self.sim.mem[0x106], 0)
+        self.assertEqual(self.sim.pc, self.labels["loop"] + 2)
+        self.assertEqual(self.sim.regs[1], 0x105)
+        self.assertEqual(self.stub.handle(f"z2,{0x105 * 2:x},2"), "OK")
+        self.assertEqual(self.stub.handle(f"Z0,{self.labels['done'] * 2:x},2"), "OK")
+        self.assertEqual(self.stub.handle("c"), "S05")
+        self.assertEqual(self.sim.mem[0x100:0x10a], list(range(1, 11)))
+
+        reference = Simulator(self.code, w=0x10)
+        reference.run(until={self.labels["done"]})
+        self.assertEqual(self.sim.instructions, reference.instructions)
+        self.assertEqual(self.sim.cycles, reference.cycles)
+
+    def test_illegal(self):
+        self.sim.mem[0] = 0xffff
+        self.sim.flush()
+        self.assertEqual(self.stub.handle("c"), "S04")
+
+    def test_interrupt(self):
+        self.stub.quantum = 1000
+        self.assertEqual(self.stub.handle("c", lambda: True), "S02")
+        self.assertEqual(self.sim.pc, self.labels["done"])
+
+    def test_reverse(self):
+        self.assertEqual(self.stub.handle("bs"), "")
+        stub = GDBStub(self.sim, history=History(self.sim))
+        self.assertIn("ReverseContinue+", stub.handle("qSupported"))
+        self.assertEqual(stub.handle("bs"), "T05replaylog:begin;")
+        self.assertEqual(stub.handle(f"Z0,{self.labels['done'] * 2:x},2"), "OK")
+        self.assertEqual(stub.handle("c"), "S05")
+        self.assertEqual(stub.handle("bs"), "S05")
+        self.assertEqual(self.sim.pc, self.labels["done"] - 1)
+        self.assertEqual(stub.handle(f"Z0,{self.labels['loop'] * 2:x},2"), "OK")
+        self.assertEqual(stub.handle("bc"), "S05")
+        self.assertEqual(self.sim.pc, self.labels["loop"])
+        self.assertEqual(self.sim.regs[0], 9)
+        self.assertEqual(self.sim.mem[0x109], 0)
+        self.assertEqual(stub.handle("c"), "S05")
+        self.assertEqual(self.sim.pc, self.labels["done"])
+        self.assertEqual(self.sim.mem[0x109], 10)
+
+    def test_target_xml(self):
+        reply = self.stub.handle("qXfer:features:read:target.xml:0,fff")
+        self.assertTrue(reply.startswith("l<?xml"))
+        self.assertIn('name="pc" bitsize="32"', reply)
+        self.assertEqual(self.stub.handle("qXfer:features:read:target.xml:0,5"), "m<?xml")
+
+
+class GDBConnectionTestCase(unittest.TestCase):
+    def exchange(self, conn, packet):
+        data = packet.encode()
+        conn.sendall(b"$" + data + b"#" + f"{sum(data) & 0xff:02x}".encode())
+        reply = b""
+        while not (b"#" in reply and len(reply) >= reply.index(b"#") + 3):
+            reply += conn.recv(4096)
+        return reply
+
+    def test_session(self):
+        sim  = Simulator(Instr.assemble([L("loop"), ADDI(R0, R0, 1), J("loop")]))
+        stub = GDBStub(sim, quantum=100)
+        server, client = socket.socketpair()
+        thread = threading.Thread(target=stub.serve, args=(server,))
+        thread.start()
+        try:
+            self.assertEqual(self.exchange(client, "qSupported:multiprocess+"),
+                             b"+$PacketSize=4000;qXfer:features:read+;QStartNoAckMode+#e5")
+            self.assertEqual(self.exchange(client, "m0,2"), b"+$0118#ca")
+            self.assertEqual(self.exchange(client, "QStartNoAckMode"), b"+$OK#9a")
+            client.sendall(b"$c#63")
+            client.sendall(b"\x03")
+            reply = b""
+            while not reply.endswith(b"#b5"):
+                reply += client.recv(4096)
+            self.assertEqual(reply, b"$S02#b5")
+            self.assertEqual(self.exchange(client, "D"), b"$OK#9a")
+        finally:
+            client.close()
+            thread.join()
+            server.close()
+        self.assertGreater(sim.instructions, 0)
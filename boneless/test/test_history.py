@@ -0,0 +1,119 @@
+import unittest
+
+from ..arch.opcode import Instr
+from ..arch.opcode import *
+from ..arch.sim import Device, ExternalBus, Simulator
+from ..arch.history import History
+
+
+class CounterDevice(Device):
+    read_wait = 2
+
+    def __init__(self):
+        self.value  = 0
+        self.reads  = 0
+        self.writes = []
+
+    def read(self, offset):
+        self.reads += 1
+        self.value = (self.value * 5 + 3) & 0xffff
+        return self.value
+
+    def write(self, offset, data):
+        self.writes.append(data)
+
+
+class HistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.labels = {}
+        self.code = Instr.assemble([
+                MOVI(R1, 0x200),
+            L("loop"),
+                LDXA(R0, 0x10),
+                ST  (R0, R1, 0),
+                ADDI(R1, R1, 1),
+                ANDI(R2, R0, 7),
+                BNZ ("skip"),
+                STXA(R1, 0x10),
+            L("skip"),
+                CMPI(R1, 0x300),
+                BNE ("loop"),
+            L("done"),
+                J   ("done"),
+        ], labels=self.labels)
+
+    def simulator(self):
+        sim = Simulator(self.code, w=0x10)
+        sim.ext = ExternalBus(sim)
+        device = sim.ext.add(CounterDevice(), 0x10, 1)
+        return sim, device
+
+    def state(self, sim):
+        return sim.pc, sim.w, sim.flags, sim.instructions, sim.cycles, sim.mem[:0x400]
+
+    def test_replay(self):
+        reference, _ = self.simulator()
+        states = [self.state(reference)]
+        for _ in range(1500):
+            reference.run(1)
+            states.append(self.state(reference))
+
+        sim, device = self.simulator()
+        history = History(sim)
+        history.interval = 100
+        self.assertEqual(history.run(1500), 1500)
+        self.assertEqual(self.state(sim), states[-1])
+        self.assertEqual(history.end, 1500)
+        reads, writes = device.reads, list(device.writes)
+
+        for position in (1499, 1234, 0, 1, 99, 100, 101, 777, 1500):
+            history.goto(position)
+            self.assertEqual(self.state(sim), states[position])
+        for count in (1, 2, 150):
+            position = sim.instructions - count
+            self.assertEqual(history.reverse_step(count), count)
+            self.assertEqual(self.state(sim), states[position])
+        self.assertEqual(device.reads, reads)
+        self.assertEqual(device.writes, writes)
+
+        # Execution continues past the end of the history with the device.
+        history.goto(1000)
+        history.run(1000)
+        reference.run(500)
+        self.assertEqual(self.state(sim), self.state(reference))
+        self.assertGreater(device.reads, reads)
+
+    def test_reverse_continue(self):
+        sim, _ = self.simulator()
+        history = History(sim)
+        history.interval = 100
+        history.run(until={self.labels["done"]})
+        skip = self.labels["skip"] - 1
+        self.assertTrue(history.reverse_continue({skip}))
+        self.assertEqual(sim.pc, skip)
+        position = sim.instructions
+        # There is no later point where the program counter was at `skip`.
+        history.run(until={skip, self.labels["done"]})
+        self.assertEqual(sim.pc, self.labels["done"])
+        history.goto(position)
+        self.assertTrue(history.reverse_continue({skip}))
+        self.assertLess(sim.instructions, position)
+        self.assertEqual(sim.pc, skip)
+        self.assertFalse(history.reverse_continue({0xffff}))
+        self.assertEqual(sim.instructions, history.start)
+
+    def test_memory(self):
+        sim, _ = self.simulator()
+        history = History(sim, memory=0)
+        history.interval = 100
+        history.run(1000)
+        self.assertEqual(history.start, 1000)
+        with self.assertRaises(ValueError):
+            history.goto(999)
+
+    def test_interval(self):
+        sim = Simulator(Instr.assemble([L("loop"), ADDI(R0, R0, 1), ADDI(R1, R1, 1), J("loop")]))
+        history = History(sim, latency=0.01)
+        history.run(100000)
+        self.assertGreaterEqual(history.interval, 1000)
+        self.assertNotEqual(history.interval, 10000)
@@ -113,6 +113,20 @@ class InstructionTestCase(unittest.TestCase):
         self.assertEqual(op.ANDI(op.R0, op.R0, 1),
                          op.Instr.from_str(" ANDI \t R0 , R0, 1 "))
 
+    def test_from_str_numbers(self):
+        self.assertEqual(op.ADDI(op.R1, op.R2, -16),
+                         op.Instr.from_str("addi r0x1, R+2, -0x10"))
+        self.assertEqual(op.ORI(op.R3, op.R3, 5),
+                         op.Instr.from_str("ORI R03, R0b11, 0o5"))
+
+    def test_from_str_cached(self):
+        instr_1 = op.Instr.from_str("MOVR R1, foo")
+        instr_2 = op.Instr.from_str("MOVR R1, foo")
+        self.assertEqual(instr_1, instr_2)
+        self.assertIsNot(instr_1, instr_2)
+        instr_1.imm = 1
+        self.assertEqual(instr_2, op.MOVR(op.R1, "foo"))
+
     def test_relocate(self):
         instr = op.MOVR(op.R1, "foo")
         self.assertEqual(op.Instr.from_str(str(instr)), instr)
@@ -0,0 +1,81 @@
+import unittest
+from amaranth import *
+from amaranth.lib import memory
+from amaranth.sim import Simulator
+
+from ..arch.opcode import Instr
+from ..arch.opcode import *
+from ..gateware.core import CoreFSM
+from ..gateware.model import CoreModel
+
+
+class Peripheral(Elaboratable):
+    # Counts cycles, and latches the last word written to it.
+    def __init__(self, core):
+        self.core  = core
+        self.count = Signal(16)
+        self.latch = Signal(16)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.core = core = self.core
+        m.d.sync += self.count.eq(self.count + 1)
+        with m.If(core.o_ext_re):
+            with m.If(core.o_bus_addr == 0):
+                m.d.sync += core.i_ext_data.eq(self.count)
+            with m.Else():
+                m.d.sync += core.i_ext_data.eq(self.latch)
+        with m.If(core.o_ext_we):
+            m.d.sync += self.latch.eq(core.o_ext_data + core.o_bus_addr)
+        return m
+
+
+class CoreModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.code = Instr.assemble([
+                MOVI(R1, 0),
+            L("loop"),
+                LDXA(R0, 0),
+                SLLI(R2, R0, 3),
+                STXA(R2, 0x1234),
+                LDXA(R3, 1),
+                ADD (R1, R1, R3),
+                CMPI(R0, 300),
+                BLTU("loop"),
+                STX (R1, R1, 7),
+            L("done"),
+                J   ("done"),
+        ])
+
+    def trace(self, core, cycles):
+        design = Peripheral(core)
+        events = []
+        async def testbench(ctx):
+            for cycle in range(cycles):
+                if ctx.get(core.o_ext_re):
+                    events.append((cycle, "r", ctx.get(core.o_bus_addr)))
+                if ctx.get(core.o_ext_we):
+                    events.append((cycle, "w", ctx.get(core.o_bus_addr),
+                                   ctx.get(core.o_ext_data)))
+                await ctx.tick()
+        sim = Simulator(design)
+        sim.add_clock(1e-6)
+        sim.add_testbench(testbench)
+        if isinstance(core, CoreModel):
+            sim.add_process(core.process)
+        sim.run()
+        return events
+
+    def test_equivalent(self):
+        mem_data = memory.MemoryData(shape=16, depth=256, init=self.code)
+        expected = self.trace(CoreFSM(mem_data=mem_data), 3000)
+        actual   = self.trace(CoreModel(mem_data=mem_data), 3000)
+        self.assertGreater(len(expected), 30)
+        self.assertIn("w", [event[1] for event in expected[-5:]])
+        self.assertEqual(actual, expected)
+        actual   = self.trace(CoreModel(mem_data=mem_data, period=1e-6), 3000)
+        self.assertEqual(actual, expected)
+
+    def test_signature(self):
+        self.assertEqual(CoreModel(reset_w=0x1230).signature,
+                         CoreFSM(reset_w=0x1230).signature)
@@ -0,0 +1,65 @@
+import unittest
+
+from ..arch.opcode import Instr
+from ..arch.opcode import *
+from ..arch.multicore import *
+
+
+class MultiCoreTestCase(unittest.TestCase):
+    def setUp(self):
+        # Core 0 passes a word to core 1 through a mailbox in the shared segment, and exits with
+        # the word doubled by core 1.
+        self.image = Instr.assemble([
+                CMPI(R0, 0),
+                BNZ ("worker"),
+                MOVI(R1, 21),
+                STXA(R1, 0x8000),
+                MOVI(R1, 1),
+                STXA(R1, 0x8001),
+            L("wait0"),
+                LDXA(R1, 0x8001),
+                CMPI(R1, 2),
+                BNZ ("wait0"),
+                LDXA(R0, 0x8002),
+                J   ("exit"),
+            L("worker"),
+                LDXA(R1, 0x8001),
+                CMPI(R1, 1),
+                BNZ ("worker"),
+                LDXA(R1, 0x8000),
+                ADD (R1, R1, R1),
+                STXA(R1, 0x8002),
+                MOVI(R1, 2),
+                STXA(R1, 0x8001),
+                MOVI(R0, 0),
+            L("exit"),
+                STXA(R0, 0xfff9),
+                MOVI(R7, 7),
+                STXA(R7, 0xfff8),
+        ])
+
+    def test_round_robin(self):
+        results, shared = run_multicore([self.image] * 2, size=4, quantum=10)
+        self.assertEqual([result["status"] for result in results], [42, 0])
+        self.assertEqual(shared, [21, 2, 42, 0])
+        self.assertEqual(run_multicore([self.image] * 2, size=4, quantum=10),
+                         (results, shared))
+
+    def test_free_running(self):
+        results, shared = run_multicore([self.image] * 2, size=4, shared=[0, 0, 0, 5],
+                                        mode="free-running", limit=10_000_000)
+        self.assertEqual([result["status"] for result in results], [42, 0])
+        self.assertEqual(shared, [21, 2, 42, 5])
+
+    def test_limit(self):
+        results, _ = run_multicore([self.image], limit=1000)
+        self.assertIsNone(results[0]["status"])
+        self.assertGreaterEqual(results[0]["cycles"], 1000)
+        results, _ = run_multicore([self.image], limit=1000, mode="free-running")
+        self.assertIsNone(results[0]["status"])
+
+    def test_illegal(self):
+        with self.assertRaisesRegex(ValueError, r"Shared segment 0xfff0\+0x10 is invalid"):
+            run_multicore([self.image], base=0xfff0, size=0x10)
+        with self.assertRaisesRegex(ValueError, r"Mode must be"):
+            run_multicore([self.image], mode="lockstep")
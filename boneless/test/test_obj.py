@@ -0,0 +1,95 @@
+import os
+import io
+import argparse
+import tempfile
+import unittest
+import contextlib
+
+from ..arch.opcode import Instr
+from ..arch.opcode import *
+from ..arch.asm import TranslationError
+from ..arch.obj import *
+from ..cli import as_options, as_main, ld_options, ld_main
+
+
+class ObjectTestCase(unittest.TestCase):
+    def setUp(self):
+        self.main = """
+            start:  MOVI R0, 1
+                    J    far
+            loop:   ADDI R0, R0, 1
+                    BNZ  loop
+                    J    start
+        """
+        self.far = """
+            far:    J    loop
+                    .word 5
+                    JAL  R7, start
+        """
+
+    def test_assemble(self):
+        obj = Object.assemble(self.main, instr_cls=Instr)
+        self.assertEqual(obj.symbols, {"start": 0, "loop": 3})
+        # `J far` refers to another object, so it has the longest encoding.
+        self.assertEqual(obj.words, [int(MOVI(R0, 1)), int(EXTI(0)), int(J(0)),
+                                     int(ADDI(R0, R0, 1)), int(BNZ(-2)), int(J(-6))])
+        self.assertEqual(obj.relocs, {1: (J("far"), 2), 4: (BNZ("loop"), 1), 5: (J("start"), 1)})
+
+    def test_json(self):
+        obj = Object.assemble(self.far, instr_cls=Instr)
+        obj_2 = Object.from_json(obj.to_json(), instr_cls=Instr)
+        self.assertEqual((obj_2.words, obj_2.symbols, obj_2.relocs),
+                         (obj.words, obj.symbols, obj.relocs))
+        with self.assertRaisesRegex(ValueError, r"Invalid object"):
+            Object.from_json('{"words": []}', instr_cls=Instr)
+
+    def test_link(self):
+        objects = [Object.assemble(self.main, instr_cls=Instr),
+                   Object.assemble(self.far, instr_cls=Instr)]
+        labels  = {}
+        # `J far` is relaxed to a single word once the objects are placed next to each other.
+        self.assertEqual(link(objects, labels=labels),
+                         Instr.assemble(self.main + self.far))
+        self.assertEqual(labels, {"start": 0, "loop": 2, "far": 5})
+
+    def test_wrong_callable(self):
+        with self.assertRaisesRegex(TranslationError,
+                r"Callable at indexes \[0\] cannot be emitted into a relocatable object"):
+            Object.assemble([lambda resolver: [resolver("foo")], L("foo")], instr_cls=Instr)
+
+    def test_wrong_duplicate(self):
+        objects = [Object.assemble(self.main, instr_cls=Instr)] * 2
+        with self.assertRaisesRegex(TranslationError,
+                r"Label 'start' in b\.o is also defined in a\.o"):
+            link(objects, names=["a.o", "b.o"])
+
+    def test_wrong_undefined(self):
+        objects = [Object.assemble(self.main, instr_cls=Instr)]
+        with self.assertRaisesRegex(TranslationError,
+                r"Undefined label 'far' referenced in object 0 at 0x0001"):
+            link(objects)
+
+    def test_cli(self):
+        with tempfile.TemporaryDirectory() as dir:
+            paths = []
+            for name, source in (("main", self.main), ("far", self.far)):
+                with open(os.path.join(dir, f"{name}.s"), "w") as file:
+                    file.write(source)
+                paths.append(os.path.join(dir, f"{name}.o"))
+                as_main(as_options(argparse.ArgumentParser()).parse_args(
+                    [os.path.join(dir, f"{name}.s"), "-c", "-o", paths[-1]]))
+            image_path = os.path.join(dir, "image.hex")
+            map_path   = os.path.join(dir, "image.map")
+            ld_main(ld_options(argparse.ArgumentParser()).parse_args(
+                [*paths, "-o", image_path, "-m", map_path]))
+            with open(image_path) as file:
+                self.assertEqual([int(word, 16) for word in file.read().split()],
+                                 Instr.assemble(self.main + self.far))
+            with open(map_path) as file:
+                self.assertEqual(file.read(), "0000 start\n0002 loop\n0005 far\n")
+
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                with self.assertRaises(SystemExit):
+                    ld_main(ld_options(argparse.ArgumentParser()).parse_args(paths[:1]))
+            self.assertIn("Undefined label 'far' referenced in", stderr.getvalue())
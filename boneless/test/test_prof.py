@@ -0,0 +1,99 @@
+import unittest
+
+from ..arch.opcode import Instr
+from ..arch.opcode import *
+from ..arch.sim import Simulator
+from ..arch.prof import *
+
+
+class ProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.labels = {}
+        self.code = Instr.assemble([
+            L("main"),
+                MOVI(R0, 3),
+            L("main_loop"),
+                JAL (R7, "outer"),
+                SUBI(R0, R0, 1),
+                BNZ ("main_loop"),
+            L("done"),
+                J   ("done"),
+            L("outer"),
+                ADJW(-8),
+                MOVI(R1, 10),
+            L("outer_loop"),
+                JAL (R7, "inner"),
+                SUBI(R1, R1, 1),
+                BNZ ("outer_loop"),
+                ADJW(8),
+                JR  (R7, 0),
+            L("inner"),
+                ADDI(R2, R2, 1),
+                JR  (R7, 0),
+        ], labels=self.labels)
+
+    def profile(self, interval):
+        sim = Simulator(self.code, w=0x100)
+        profiler = Profiler(sim, self.labels, interval=interval)
+        profiler.run(until={self.labels["done"]})
+        return sim, profiler
+
+    def test_exact(self):
+        sim, profiler = self.profile(None)
+        self.assertEqual(sum(profiler.counts.values()), sim.instructions)
+        self.assertEqual(sum(profiler.cycles.values()), sim.cycles)
+        self.assertEqual(profiler.counts[self.labels["inner"]], 30)
+        self.assertEqual(profiler.counts[self.labels["outer"]], 3)
+        # main: MOVI, and 3 iterations of JAL, SUBI, BNZ.
+        # outer: ADJW, MOVI, ADJW, JR with 10 iterations of JAL, SUBI, BNZ.
+        # inner: ADDI, JR.
+        self.assertEqual(profiler.collapsed(),
+            f"main {4 + 3 * (5 + 4 + 4)}\n"
+            f"main;outer {3 * (5 + 4 + 5 + 4 + 10 * (5 + 4 + 4))}\n"
+            f"main;outer;inner {30 * (4 + 4)}\n")
+        self.assertEqual(sum(int(line.split()[-1])
+                             for line in profiler.collapsed().splitlines()), sim.cycles)
+        # Instructions are stepped one by one, which never translates a block.
+        self.assertEqual(sim._blocks, [None] * 0x10000)
+
+    def test_sampling(self):
+        exact_sim, exact = self.profile(None)
+        sim, profiler = self.profile(7)
+        self.assertEqual(sim.instructions, exact_sim.instructions)
+        self.assertEqual(profiler.collapsed(), exact.collapsed())
+        self.assertEqual(sum(profiler.counts.values()), sim.instructions // 7)
+
+    def test_table(self):
+        sim, profiler = self.profile(None)
+        table = profiler.table().splitlines()
+        self.assertEqual(table[0].split(), ["label", "count", "cycles", "%"])
+        self.assertEqual(table[1].split()[:3], ["outer_loop", "96", str(30 * 13 + 3 * (5 + 4))])
+        self.assertEqual([row.split()[0] for row in table[1:]],
+                         ["outer_loop", "inner", "main_loop", "outer", "main"])
+
+    def test_recursion(self):
+        labels = {}
+        code = Instr.assemble([
+            L("main"),
+                MOVI(R0, 4),
+                JAL (R7, "rec"),
+            L("done"),
+                J   ("done"),
+            L("rec"),
+                LDW (R6, -8),
+                MOV (R0, R6),
+                LD  (R0, R0, 0),
+                SUBI(R0, R0, 1),
+                BZ  ("ret"),
+                JAL (R7, "rec"),
+            L("ret"),
+                ADJW(8),
+                JR  (R7, 0),
+        ], labels=labels)
+        sim = Simulator(code, w=0x100)
+        profiler = Profiler(sim, labels)
+        profiler.run(until={labels["done"]})
+        self.assertEqual([line.split()[0] for line in profiler.collapsed().splitlines()],
+                         ["main", "main;rec", "main;rec;rec", "main;rec;rec;rec",
+                          "main;rec;rec;rec;rec"])
+        self.assertEqual(profiler._path, ("main",))
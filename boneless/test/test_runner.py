@@ -0,0 +1,141 @@
+import io
+import os
+import json
+import argparse
+import tempfile
+import unittest
+import contextlib
+
+from ..arch.opcode import Instr
+from ..arch.opcode import *
+from ..arch.runner import *
+from ..arch.trace import read_trace
+from ..cli import run_options, run_main
+
+
+class RunnerTestCase(unittest.TestCase):
+    def setUp(self):
+        # Sums the words of the stimulus up to the first zero word, writes the sum to external
+        # memory, prints a message, and exits with the low byte of the sum as the status.
+        self.image = Instr.assemble([
+                MOVI(R0, 0),
+                MOVI(R1, 0),
+            L("loop"),
+                LDX (R2, R1, 0),
+                CMPI(R2, 0),
+                BZ  ("done"),
+                ADD (R0, R0, R2),
+                ADDI(R1, R1, 1),
+                J   ("loop"),
+            L("done"),
+                STXA(R0, 0x100),
+                MOVI(R7, 1),
+                STXA(R7, 0xfff9),
+                MOVI(R7, 0x200),
+                STXA(R7, 0xfffa),
+                MOVI(R7, 2),
+                STXA(R7, 0xfffb),
+                MOVI(R7, 1),
+                STXA(R7, 0xfff8),
+                ANDI(R0, R0, 0xff),
+                STXA(R0, 0xfff9),
+                MOVI(R7, 7),
+                STXA(R7, 0xfff8),
+        ])
+        self.image += [0] * (0x200 - len(self.image)) + [0x6b6f]
+
+    def test_run_job(self):
+        result = run_job(Job(self.image, [1, 2, 3, 0x100, 0]))
+        self.assertEqual(result["status"], 0x06)
+        self.assertEqual(result["output"], "ok")
+        self.assertEqual(result["regs"][0], 0x06)
+        self.assertNotIn("error", result)
+        self.assertEqual(result, run_job(Job(self.image, [1, 2, 3, 0x100, 0])))
+        self.assertNotEqual(result["external"],
+                            run_job(Job(self.image, [1, 2, 3, 0]))["external"])
+
+    def test_limit(self):
+        result = run_job(Job(self.image, [1] * 1000, limit=1000))
+        self.assertIsNone(result["status"])
+        self.assertGreaterEqual(result["cycles"], 1000)
+        self.assertLess(result["cycles"], 1005)
+
+    def test_error(self):
+        result = run_job(Job([0xffff]))
+        self.assertEqual(result["error"], "Illegal instruction ffff at 0000")
+
+    def test_run_jobs(self):
+        jobs = [Job(self.image, [value, value, 0]) for value in range(20)]
+        results = sorted(run_jobs(jobs, processes=3), key=lambda result: result["job"])
+        self.assertEqual([result["job"] for result in results], list(range(20)))
+        self.assertEqual([result["status"] for result in results],
+                         [(value * 2) & 0xff for value in range(20)])
+        self.assertEqual(results[5], dict(run_job(jobs[5]), job=5))
+
+    def test_cli(self):
+        with tempfile.TemporaryDirectory() as dir:
+            hex_path = os.path.join(dir, "image.hex")
+            bin_path = os.path.join(dir, "image.bin")
+            with open(hex_path, "w") as file:
+                file.write("".join(f"{word:04x}\n" for word in self.image))
+            with open(bin_path, "wb") as file:
+                file.write(b"".join(word.to_bytes(2, "little") for word in self.image))
+            self.assertEqual(load_image(hex_path), self.image)
+            self.assertEqual(load_image(bin_path), self.image)
+            matrix_path = os.path.join(dir, "matrix.jsonl")
+            with open(matrix_path, "w") as file:
+                file.write(json.dumps({"image": hex_path, "stimulus": [3, 0]}) + "\n")
+                file.write(json.dumps({"image": bin_path, "stimulus": [4, 0], "limit": 10}) + "\n")
+                file.write(json.dumps({"image": os.path.join(dir, "missing.hex")}) + "\n")
+            output_path = os.path.join(dir, "results.jsonl")
+            args = run_options(argparse.ArgumentParser()).parse_args(
+                ["-m", matrix_path, "-j", "2", "-o", output_path])
+            run_main(args)
+            args.output.close()
+            with open(output_path) as file:
+                results = sorted((json.loads(line) for line in file),
+                                 key=lambda result: result["job"])
+        self.assertEqual([result.get("status") for result in results], [3, None, None])
+        self.assertIn("No such file", results[2]["error"])
+
+    def run_cli(self, *args):
+        stdout = io.TextIOWrapper(io.BytesIO())
+        stderr = io.TextIOWrapper(io.BytesIO())
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            with self.assertRaises(SystemExit) as cm:
+                run_main(run_options(argparse.ArgumentParser()).parse_args(args))
+        stdout.flush()
+        stderr.flush()
+        return cm.exception.code, stdout.buffer.getvalue(), stderr.buffer.getvalue().decode()
+
+    def test_cli_image(self):
+        with tempfile.TemporaryDirectory() as dir:
+            image_path = os.path.join(dir, "image.hex")
+            ext_path   = os.path.join(dir, "ext.hex")
+            with open(image_path, "w") as file:
+                file.write("".join(f"{word:04x}\n" for word in self.image))
+            with open(ext_path, "w") as file:
+                file.write("0010\n0020\n0000\n")
+            code, stdout, stderr = self.run_cli(image_path, "-x", ext_path)
+            self.assertEqual(code, 0x30)
+            self.assertEqual(stdout, b"ok")
+            self.assertIn("Exited with status 48", stderr)
+            self.assertRegex(stderr, r"cycles: +\d+\ninstructions: +\d+\nCPI: +4\.\d{3}\n")
+
+            profile_path = os.path.join(dir, "profile.txt")
+            code, _, stderr = self.run_cli(image_path, "-l", "50", "-p", profile_path)
+            self.assertEqual(code, 0)
+            self.assertIn("Stopped: cycle limit reached", stderr)
+            with open(profile_path) as file:
+                self.assertRegex(file.read(), r"^0000 [5-9]\d\n$")
+
+            trace_path = os.path.join(dir, "trace.bin")
+            self.run_cli(image_path, "-x", ext_path, "-t", trace_path)
+            with open(trace_path, "rb") as file:
+                records = list(read_trace(file))
+            self.assertIn((0xfff8, 1), [record.ext_write for record in records])
+            self.assertEqual(records[-2].ext_write, (0xfff9, 0x30))
+
+            code, _, stderr = self.run_cli()
+            self.assertEqual(code, 1)
+            self.assertIn("Exactly one of IMAGE and --matrix", stderr)
@@ -0,0 +1,93 @@
+import io
+import os
+import tempfile
+import unittest
+
+from ..arch.opcode import Instr
+from ..arch.opcode import *
+from ..arch.semihost import *
+
+
+def packed(text):
+    data = text.encode() + b"\0" * (2 - len(text) % 2)
+    return [data[index] | data[index + 1] << 8 for index in range(0, len(data), 2)]
+
+
+def call(number, *args):
+    code = []
+    for index, arg in enumerate(args):
+        code += [MOVI(R7, arg), STXA(R7, 0xfff9 + index)]
+    code += [MOVI(R7, number), STXA(R7, 0xfff8)]
+    return code
+
+
+class SemihostTestCase(unittest.TestCase):
+    def assemble(self, code):
+        labels = {}
+        return Instr.assemble(code, labels=labels), labels
+
+    def test_write(self):
+        image, _ = self.assemble([
+            *call(Semihost.WRITE0, 1, 0x100),
+            *call(Semihost.WRITE, 2, 0x100, 3),
+            *call(Semihost.EXIT, 7),
+        ])
+        image += [0] * (0x100 - len(image)) + packed("hello, world\n")
+        stdout, stderr = io.BytesIO(), io.BytesIO()
+        status, sim = run_semihosted(image, stdout=stdout, stderr=stderr)
+        self.assertEqual(status, 7)
+        self.assertEqual(stdout.getvalue(), b"hello, world\n")
+        self.assertEqual(stderr.getvalue(), b"hel")
+        self.assertEqual(sim.instructions, 17)
+
+    def test_wrong_direction(self):
+        image, _ = self.assemble([
+            *call(Semihost.WRITE, 0, 0x100, 2),
+            LDXA(R0, 0xfffc),
+            *call(Semihost.READ, 1, 0x100, 2),
+            LDXA(R1, 0xfffc),
+            *call(Semihost.READ, 2, 0x100, 2),
+            LDXA(R2, 0xfffc),
+            *call(Semihost.EXIT, 0),
+        ])
+        image += [0] * (0x100 - len(image)) + packed("hi")
+        stdin  = io.BufferedReader(io.BytesIO(b"input"))
+        stdout = io.BufferedWriter(io.BytesIO())
+        stderr = io.BufferedWriter(io.BytesIO())
+        status, sim = run_semihosted(image, stdin=stdin, stdout=stdout, stderr=stderr)
+        self.assertEqual(status, 0)
+        self.assertEqual(sim.regs[:3], [0xffff, 0xffff, 0xffff])
+
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, "input.bin"), "wb") as file:
+                file.write(b"\x01\x02\x03\x04\x05")
+            image, labels = self.assemble([
+                *call(Semihost.OPEN, 0x100, 9, 0),
+                LDXA(R0, 0xfffc),
+                MOVI(R7, 0x200),
+                STXA(R0, 0xfff9),
+                STXA(R7, 0xfffa),
+                MOVI(R7, 100),
+                STXA(R7, 0xfffb),
+                MOVI(R7, Semihost.READ),
+                STXA(R7, 0xfff8),
+                LDXA(R1, 0xfffc),
+                *call(Semihost.OPEN, 0x110, 9, 0),
+                LDXA(R2, 0xfffc),
+                *call(Semihost.CLOCK),
+                LDXA(R3, 0xfffc),
+                *call(Semihost.EXIT, 0),
+            ])
+            image += [0] * (0x100 - len(image)) + packed("input.bin")
+            image += [0] * (0x110 - len(image)) + packed("../passwd")
+            status, sim = run_semihosted(image, root=root)
+        self.assertEqual(status, 0)
+        self.assertEqual(sim.mem[0x200:0x204], [0x0201, 0x0403, 0x0005, 0])
+        self.assertEqual(sim.regs[:4], [3, 5, 0xffff, sim.cycles - 20])
+
+    def test_limit(self):
+        image, _ = self.assemble([L("loop"), J("loop")])
+        status, sim = run_semihosted(image, limit=10)
+        self.assertIsNone(status)
+        self.assertEqual(sim.instructions, 10)
@@ -0,0 +1,591 @@
+import asyncio
+import unittest
+
+from ..arch.opcode import Instr
+from ..arch.opcode import *
+from ..arch.sim import *
+from .smoke import SmokeTestCase
+
+
+class SimulatorSmokeTestCase(SmokeTestCase, unittest.TestCase):
+    def run_simulator(self, case):
+        for _ in case(self):
+            pass
+
+    def execute(self, code, regs=[], data=[], extr=[], flags="", limit=None):
+        code = Instr.assemble(code)
+        if limit is None:
+            limit = len(code)
+        self.sim = Simulator([*regs, *[0] * (8 - len(regs)), *code, *data], pc=8, w=0,
+                             ext=ExternalMemory(extr))
+        for flag in flags:
+            setattr(self.sim, flag, True)
+        self.sim.run(limit)
+        yield
+
+    def assertF(self, flags):
+        for flag in "zscv":
+            self.assertEqual(getattr(self.sim, flag), flag in flags, msg=f"F.{flag}")
+        yield
+
+    def assertW(self, win):
+        self.assertEqual(self.sim.w, win, msg=f"W")
+        yield
+
+    def assertPC(self, addr):
+        self.assertEqual(self.sim.pc, addr, msg=f"PC")
+        yield
+
+    def assertMemory(self, addr, value):
+        self.assertEqual(self.sim.mem[addr], value, msg=f"M[{addr}]")
+        yield
+
+    def assertExternal(self, addr, value):
+        self.assertEqual(self.sim.ext.data[addr], value, msg=f"X[{addr}]")
+        yield
+
+
+class SimulatorTestCase(unittest.TestCase):
+    def test_reset(self):
+        sim = Simulator()
+        self.assertEqual(sim.pc, 0)
+        self.assertEqual(sim.w, 0xfff8)
+        self.assertEqual(sim.flags, "")
+
+    def test_regs(self):
+        sim = Simulator(w=0x10)
+        sim.load(Instr.assemble([MOVI(R1, 5), MOVI(R7, 7)]))
+        self.assertEqual(sim.run(2), 2)
+        self.assertEqual(sim.regs, [0, 5, 0, 0, 0, 0, 0, 7])
+        self.assertEqual(sim.instructions, 2)
+
+    def test_ext_imm(self):
+        sim = Simulator(Instr.assemble([MOVI(R0, 0x1234), ADDI(R0, R0, 0x1111)]), w=0x10)
+        self.assertEqual(sim.run(2), 2)
+        self.assertEqual(sim.pc, 4)
+        self.assertEqual(sim.regs[0], 0x2345)
+
+    def test_ext_imm_noncanonical(self):
+        sim = Simulator([int(EXTI(1)), int(EXTI(2)), int(MOVI(R0, 3))], w=0x10)
+        sim.run(1)
+        self.assertEqual(sim.pc, 1)
+        sim.run(1)
+        self.assertEqual(sim.pc, 3)
+        self.assertEqual(sim.regs[0], 0x13)
+
+    def test_shift_flags(self):
+        sim = Simulator(Instr.assemble([MOVI(R0, 0x8001), SRAI(R1, R0, 1), SLLI(R2, R0, 1)]),
+                        w=0x10)
+        sim.run(2)
+        self.assertEqual(sim.regs[1], 0xc000)
+        self.assertEqual(sim.flags, "s")
+        sim.run(1)
+        self.assertEqual(sim.regs[2], 0x0002)
+        self.assertEqual(sim.flags, "")
+
+    def test_until(self):
+        sim = Simulator(Instr.assemble([
+                MOVI(R0, 10),
+            L("loop"),
+                SUBI(R0, R0, 1),
+                BNZ ("loop"),
+            L("done"),
+                J   ("done"),
+        ]), w=0x10)
+        self.assertEqual(sim.run(until={3}), 21)
+        self.assertEqual(sim.pc, 3)
+        self.assertEqual(sim.run(5, until={3}), 1)
+
+    def test_illegal(self):
+        sim = Simulator([int(MOVI(R0, 1)), 0xffff], w=0x10)
+        with self.assertRaisesRegex(SimulationError,
+                r"Illegal instruction ffff at 0001"):
+            sim.run()
+        self.assertEqual(sim.pc, 1)
+        self.assertEqual(sim.instructions, 1)
+
+    def test_predecode_once(self):
+        sim = Simulator(Instr.assemble([
+                MOVI(R0, 100),
+            L("loop"),
+                SUBI(R0, R0, 1),
+                BNZ ("loop"),
+        ]), w=0x10, translate=False)
+        decoded = []
+        def decode(pc):
+            decoded.append(pc)
+            return Simulator.decode(sim, pc)
+        sim.decode = decode
+        sim.run(201)
+        self.assertEqual(decoded, [0, 1, 2])
+
+    def test_self_modifying(self):
+        sim = Simulator(Instr.assemble([
+            MOVI(R0, 1),
+            LDR (R1, R2, 3),
+            STR (R1, R2, -3),
+            J   (-4),
+            0,
+            MOVI(R0, 2),
+        ]), w=0x10)
+        sim.run(4)
+        self.assertEqual(sim.regs[0], 1)
+        sim.run(1)
+        self.assertEqual(sim.regs[0], 2)
+
+    def test_self_modifying_ext_imm(self):
+        sim = Simulator(Instr.assemble([
+            MOVI(R0, 0x1234),
+            MOVI(R1, int(EXTI(0x5678 >> 3))),
+            STR (R1, R2, -5),
+            J   (-6),
+        ]), w=0x10)
+        sim.run(3)
+        self.assertEqual(sim.regs[0], 0x1234)
+        sim.run(2)
+        self.assertEqual(sim.regs[0], 0x567c)
+
+    def test_window_over_code(self):
+        sim = Simulator([0] * 8 + Instr.assemble([
+            MOVI(R2, int(MOVI(R0, 7))),
+            NOP (0),
+        ]), pc=10, w=0x08)
+        sim.run(1)
+        sim.pc = 8
+        sim.run(2)
+        self.assertEqual(sim.mem[8], 7)
+
+    def test_translate_equivalent(self):
+        code = Instr.assemble([
+                MOVI(R0, 0x20),
+                MOVI(R6, 0x100),
+            L("loop"),
+                JAL (R7, "sub"),
+                SUBI(R0, R0, 1),
+                BNZ ("loop"),
+            L("done"),
+                J   ("done"),
+            L("sub"),
+                ADD (R1, R1, R0),
+                ADC (R2, R2, R1),
+                ROLI(R3, R2, 5),
+                SRA (R4, R3, R0),
+                STX (R4, R0, 0),
+                ST  (R3, R6, 0),
+                ADDI(R6, R6, 1),
+                CMP (R6, R1),
+                JR  (R7, 0),
+        ])
+        sims = [Simulator(code, w=0x10, translate=translate) for translate in (False, True)]
+        for sim in sims:
+            sim.run(until={3})
+        self.assertEqual(sims[0].instructions, sims[1].instructions)
+        self.assertEqual(sims[0].cycles, sims[1].cycles)
+        self.assertEqual(sims[0].mem, sims[1].mem)
+        self.assertEqual(sims[0].ext.data, sims[1].ext.data)
+        self.assertEqual(sims[0].flags, sims[1].flags)
+
+    def test_translate_self_modifying(self):
+        sim = Simulator(Instr.assemble([
+            MOVI(R1, 0x1234),
+            STR (R0, R2, 0),  # overwrite EXTI of MOVI(R1, 0x5678)
+            MOVI(R1, 0x5678),
+            J   (-6),
+        ]), w=0x10)
+        sim.translate_threshold = 0
+        sim.mem[0x10] = int(MOVI(R3, 1))
+        sim.run(4)
+        self.assertEqual(sim.regs[1], 0x0078)
+        self.assertEqual(sim.regs[3], 1)
+
+    def test_translate_hot(self):
+        sim = Simulator(Instr.assemble([
+                MOVI(R0, 100),
+            L("loop"),
+                SUBI(R0, R0, 1),
+                BNZ ("loop"),
+        ]), w=0x10)
+        # Stepping never translates a block, and neither does running code executed only once.
+        for _ in range(40):
+            sim.step()
+        sim.pc = 0
+        sim.run(3)
+        self.assertEqual(sim._blocks, [None] * 0x10000)
+        sim.run(2 * Simulator.translate_threshold)
+        self.assertIsNone(sim._blocks[0])
+        self.assertTrue(sim._blocks[1])
+
+    def test_translate_loop_limit(self):
+        code = Instr.assemble([
+                MOVI(R0, 0),
+            L("loop"),
+                ADDI(R0, R0, 1),
+                J   ("loop"),
+        ])
+        sim = Simulator(code, w=0x10)
+        self.assertEqual(sim.run(1001), 1001)
+        self.assertEqual(sim.cycles, 4004)
+        self.assertEqual(sim.regs[0], 500)
+        self.assertEqual(sim.pc, 1)
+        self.assertEqual(sim.run(until={2}), 1)
+        self.assertEqual(sim.run(until={2}), 2)
+        self.assertEqual(sim.regs[0], 502)
+
+    def test_translate_loop_shift(self):
+        for shift in (ROLI(R1, R1, 1), ROL(R1, R1, R2)):
+            code = Instr.assemble([
+                    MOVI(R0, 100),
+                    MOVI(R1, 1),
+                    MOVI(R2, 3),
+                L("loop"),
+                    shift,
+                    SUBI(R0, R0, 1),
+                    BNZ ("loop"),
+                L("end"),
+                    J   ("end"),
+            ])
+            for kwargs in ({"limit": 150}, {"until": {6}}):
+                with self.subTest(shift=shift, **kwargs):
+                    sims = [Simulator(code, w=0x10, translate=translate)
+                            for translate in (False, True)]
+                    counts = [sim.run(**kwargs) for sim in sims]
+                    self.assertEqual(counts[0], counts[1])
+                    self.assertEqual(sims[0].instructions, sims[1].instructions)
+                    self.assertEqual(sims[0].cycles, sims[1].cycles)
+                    self.assertEqual(sims[0].regs, sims[1].regs)
+                    self.assertEqual(sims[0].pc, sims[1].pc)
+
+    def test_fast_forward_equivalent(self):
+        loops = [
+            [SUBI(R1, R1, 1), BNZ(-2)],
+            [SUBI(R1, R1, 3), BGTU(-2)],
+            [ADDI(R1, R1, 0x1000), BNC(-2)],
+            [ADDI(R1, R1, 7), BGES(-2)],
+            [SUBI(R1, R1, 5), BLES(-2)],
+            [SUBI(R1, R1, 0x1234), BNV(-3)],
+            [SUBI(R1, R1, 1), SBCI(R2, R2, 0), BNZ(-3)],
+            [ADDI(R1, R1, 0x123), ADCI(R2, R2, 2), BNS(-4)],
+        ]
+        for loop in loops:
+            for r1, r2 in [(0x0000, 0x0000), (0x0010, 0x0003), (0x7ffe, 0x8001),
+                           (0x8003, 0xfffe), (0xfff0, 0x7fff)]:
+                with self.subTest(loop=loop, r1=r1, r2=r2):
+                    code = Instr.assemble([MOVI(R1, r1), MOVI(R2, r2), *loop, J(-1)])
+                    sims = [Simulator(code, w=0x100, translate=translate)
+                            for translate in (False, True)]
+                    for sim in sims:
+                        sim.run(50000)
+                    self.assertEqual(sims[0].pc, sims[1].pc)
+                    self.assertEqual(sims[0].cycles, sims[1].cycles)
+                    self.assertEqual(sims[0].regs, sims[1].regs)
+                    self.assertEqual(sims[0].flags, sims[1].flags)
+
+    def test_fast_forward_counting(self):
+        sim = Simulator(Instr.assemble([
+                MOVI(R1, 0x4000),
+                MOVI(R2, 0x0100),
+            L("loop"),
+                SUBI(R1, R1, 1),
+                SBCI(R2, R2, 0),
+                BNZ ("loop"),
+            L("done"),
+                J   ("done"),
+        ]), w=0x10)
+        self.assertEqual(sim.run(until={7}), 2 + 0xff4001 * 3)
+        self.assertEqual(sim.cycles, 2 * 5 + 0xff4001 * 12)
+        self.assertEqual(sim.regs[1:3], [0xffff, 0x0000])
+        self.assertEqual(sim.flags, "zc")
+        self.assertEqual(sim.run(1_000_000_000), 1_000_000_000)
+        self.assertEqual(sim.pc, 7)
+
+    def test_fast_forward_polling(self):
+        class Timer(ExternalMemory):
+            def __init__(self, sim):
+                super().__init__()
+                self.sim   = sim
+                self.reads = 0
+
+            def read(self, addr):
+                self.reads += 1
+                return int(self.sim.cycles >= 100_000)
+
+        class ScheduledTimer(Timer):
+            def next_event(self, cycles):
+                return 100_000 if cycles < 100_000 else None
+
+        code = Instr.assemble([
+            L("poll"),
+                LDXA(R0, 0),
+                CMPI(R0, 0),
+                BZ  ("poll"),
+            L("done"),
+                J   ("done"),
+        ])
+        sims = []
+        for timer_cls in (Timer, ScheduledTimer):
+            sim = Simulator(code, w=0x10)
+            sim.ext = timer_cls(sim)
+            sim.run(until={3})
+            sims.append(sim)
+        self.assertEqual(sims[0].cycles, 100_020)
+        self.assertEqual(sims[0].instructions, sims[1].instructions)
+        self.assertEqual(sims[0].cycles, sims[1].cycles)
+        self.assertEqual(sims[0].ext.reads, 8335)
+        # The loop is executed normally until it is translated.
+        self.assertLess(sims[1].ext.reads, Simulator.translate_threshold + 5)
+
+    def test_fast_forward_polling_event(self):
+        # The period of the timer is not a multiple of the period of the loop, so the value read
+        # may change after the read, but before the end of an iteration.
+        class Timer(Device):
+            read_wait = 1
+
+            def __init__(self, sim):
+                self.sim = sim
+
+            def read(self, offset):
+                return self.sim.cycles // 97
+
+            def next_event(self, cycles):
+                return (cycles // 97 + 1) * 97
+
+        labels = {}
+        code = Instr.assemble([
+                MOVI(R2, 0),
+            L("poll"),
+                LDXA(R1, 0),
+                CMP (R1, R0),
+                BEQ ("poll"),
+                ADDI(R0, R1, 0),
+                ADDI(R2, R2, 1),
+                CMPI(R2, 500),
+                BNE ("poll"),
+            L("done"),
+                J   ("done"),
+        ], labels=labels)
+        sims = []
+        for translate in (False, True):
+            sim = Simulator(code, w=0x10, translate=translate)
+            sim.ext = bus = ExternalBus(sim)
+            bus.add(Timer(sim), 0, 1)
+            sim.run(until={labels["done"]})
+            sims.append(sim)
+        self.assertEqual(sims[0].instructions, sims[1].instructions)
+        self.assertEqual(sims[0].cycles, sims[1].cycles)
+        self.assertEqual(sims[0].regs, sims[1].regs)
+        self.assertEqual(sims[1].pc, labels["done"])
+
+    def test_fast_forward_self_modifying(self):
+        # The counter is in the window, which overlaps the loop itself.
+        sim = Simulator(Instr.assemble([
+            SUBI(R0, R0, 1),
+            BNZ (-2),
+        ]), w=0x00)
+        sim.run(3)
+        self.assertEqual(sim.mem[0], int(SUBI(R0, R0, 1)) - 1)
+
+
+class ExternalBusTestCase(unittest.TestCase):
+    class Register(Device):
+        read_wait  = 2
+        write_wait = 1
+
+        def __init__(self):
+            self.value = 0
+            self.log   = []
+
+        def read(self, offset):
+            self.log.append(("r", offset))
+            return self.value + offset
+
+        def write(self, offset, data):
+            self.log.append(("w", offset, data))
+            self.value = data
+
+    def test_dispatch(self):
+        sim = Simulator(Instr.assemble([
+            MOVI(R0, 0x10),
+            STXA(R0, 0x41),
+            LDXA(R1, 0x43),
+            LDXA(R2, 0x02),
+        ]), w=0x100)
+        sim.ext = bus = ExternalBus(sim)
+        reg  = bus.add(self.Register(), 0x40, 4)
+        mem  = bus.add(ExternalMemory([1, 2, 3]), 0x00, 0x10)
+        sim.run(4)
+        self.assertEqual(reg.log, [("w", 1, 0x10), ("r", 3)])
+        self.assertEqual(sim.regs[1:3], [0x13, 3])
+        self.assertEqual(sim.cycles, 4 * 4 + 1 + 2)
+        self.assertEqual(bus.devices, [reg, mem])
+
+    def test_unmapped(self):
+        sim = Simulator(Instr.assemble([LDXA(R0, 0x10)]), w=0x100)
+        sim.ext = ExternalBus(sim)
+        with self.assertRaisesRegex(SimulationError,
+                r"^Read from unmapped external address 0010$"):
+            sim.run(1)
+        self.assertEqual(sim.pc, 0)
+
+    def test_overlap(self):
+        bus = ExternalBus()
+        bus.add(Device(), 0x10, 0x10)
+        with self.assertRaisesRegex(ValueError,
+                r"^Address range 0x0018\+0x10 overlaps a device at 0x0018$"):
+            bus.add(Device(), 0x18, 0x10)
+        with self.assertRaisesRegex(ValueError,
+                r"^Address range 0xfff0\+0x20 is invalid$"):
+            bus.add(Device(), 0xfff0, 0x20)
+
+    def test_next_event(self):
+        class Timer(Device):
+            def __init__(self, period):
+                self.period = period
+
+            def next_event(self, cycles):
+                return (cycles // self.period + 1) * self.period
+
+        bus = ExternalBus()
+        self.assertIsNone(bus.next_event(0))
+        bus.add(Device(), 0, 1)
+        self.assertIsNone(bus.next_event(0))
+        bus.add(Timer(100), 1, 1)
+        bus.add(Timer(30), 2, 1)
+        self.assertEqual(bus.next_event(50), 60)
+        self.assertEqual(bus.next_event(95), 100)
+
+
+class AsyncSimulatorTestCase(unittest.TestCase):
+    class Channel(Device):
+        def __init__(self, queue):
+            self.queue = queue
+
+        async def read(self, offset):
+            return await self.queue.get()
+
+        async def write(self, offset, data):
+            await self.queue.put(data)
+
+    def test_run_async(self):
+        async def main():
+            queue = asyncio.Queue(maxsize=1)
+            producer = Simulator(Instr.assemble([
+                    MOVI(R0, 10),
+                L("loop"),
+                    STXA(R0, 0),
+                    SUBI(R0, R0, 1),
+                    BNZ ("loop"),
+                L("done"),
+                    J   ("done"),
+            ]), w=0x100)
+            producer.ext = ExternalBus(producer)
+            producer.ext.add(self.Channel(queue), 0, 1)
+            consumer = Simulator(Instr.assemble([
+                L("loop"),
+                    LDXA(R0, 0),
+                    ADD (R1, R1, R0),
+                    CMPI(R0, 1),
+                    BNE ("loop"),
+                L("done"),
+                    J   ("done"),
+            ]), w=0x100)
+            consumer.ext = ExternalBus(consumer)
+            consumer.ext.add(self.Channel(queue), 0, 1)
+            return await asyncio.gather(
+                producer.run_async(until={4}, quantum=3),
+                consumer.run_async(until={4}, quantum=3),
+            ), producer, consumer
+
+        (produced, consumed), producer, consumer = asyncio.run(main())
+        self.assertEqual(produced, 1 + 10 * 3)
+        self.assertEqual(consumed, 10 * 4)
+        self.assertEqual(consumer.regs[1], 55)
+        self.assertEqual(consumer.cycles, 10 * 4 * 4)
+
+    def test_run_sync(self):
+        sim = Simulator(Instr.assemble([LDXA(R0, 0)]), w=0x100)
+        sim.ext = ExternalBus(sim)
+        sim.ext.add(self.Channel(None), 0, 1)
+        with self.assertRaisesRegex(SimulationError,
+                r"^External bus read at 0000 must be awaited; use Simulator.run_async$") as cm:
+            sim.run(1)
+        cm.exception.awaitable.close()
+        self.assertEqual(sim.pc, 0)
+
+    def test_limit(self):
+        sim = Simulator(Instr.assemble([ADDI(R0, R0, 1), J(-2)]), w=0x100)
+        count = asyncio.run(sim.run_async(1001, quantum=100))
+        self.assertEqual(count, 1001)
+        self.assertEqual(sim.regs[0], 501)
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.code = Instr.assemble([
+                MOVI(R0, 0x1234),
+                MOVI(R6, 0x300),
+            L("loop"),
+                ADDI(R0, R0, 1),
+                ST  (R0, R6, 0),
+                STXA(R0, 5),
+                ADDI(R6, R6, 0x100),
+                J   ("loop"),
+        ])
+
+    def assertSameState(self, sim, other):
+        self.assertEqual(sim.pc, other.pc)
+        self.assertEqual(sim.w, other.w)
+        self.assertEqual(sim.flags, other.flags)
+        self.assertEqual(sim.instructions, other.instructions)
+        self.assertEqual(sim.cycles, other.cycles)
+        self.assertEqual(sim.mem, other.mem)
+        self.assertEqual(sim.ext.data, other.ext.data)
+
+    def test_restore(self):
+        sim = Simulator(self.code, w=0x10)
+        sim.run(12)
+        blob = sim.snapshot()
+        reference = Simulator(self.code, w=0x10)
+        reference.run(12)
+        for _ in range(3):
+            sim.run(50)
+            sim.restore(blob)
+            self.assertEqual(sim._dirty, bytearray(0x100))
+            self.assertSameState(sim, reference)
+        sim.run(50)
+        reference.run(50)
+        self.assertSameState(sim, reference)
+
+    def test_restore_other(self):
+        sim = Simulator(self.code, w=0x10)
+        sim.run(12)
+        blob = sim.snapshot()
+        other = Simulator()
+        other.restore(blob)
+        self.assertSameState(sim, other)
+        sim.run(50)
+        other.run(50)
+        self.assertSameState(sim, other)
+
+    def test_restore_code(self):
+        sim = Simulator(Instr.assemble([
+            MOVI(R0, 1),
+            MOVI(R1, int(MOVI(R0, 2))),
+            STR (R1, R2, -3),
+            J   (-4),
+        ]), w=0x10)
+        blob = sim.snapshot()
+        sim.run(5)
+        self.assertEqual(sim.regs[0], 2)
+        sim.restore(blob)
+        sim.run(1)
+        self.assertEqual(sim.regs[0], 1)
+
+    def test_dirty(self):
+        sim = Simulator(self.code, w=0x10)
+        blob = sim.snapshot()
+        sim.run(12)
+        self.assertEqual([page for page in range(0x100) if sim._dirty[page]], [0, 3, 4])
+        # Restoring the snapshot undoes the changes to the dirty pages, which are clean again.
+        sim.restore(blob)
+        self.assertEqual([page for page in range(0x100) if sim._dirty[page]], [])
+        self.assertEqual(sim.mem, Simulator(self.code, w=0x10).mem)
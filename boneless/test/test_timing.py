@@ -0,0 +1,91 @@
+import unittest
+from amaranth.lib import memory
+from amaranth.sim import Simulator
+
+from ..arch.opcode import Instr
+from ..arch.opcode import *
+from ..arch import sim as arch_sim
+from ..gateware.core import CoreFSM
+from ..gateware.timing import TimingModel
+
+
+class TimingModelTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = TimingModel()
+
+    def test_instr_cycles(self):
+        image = Instr.assemble([
+            ADD (R0, R1, R2),
+            JAL (R7, 0),
+            SRLI(R0, R0, 8),
+            SRLI(R0, R0, 9),
+            SRL (R0, R0, R1),
+        ])
+        self.assertEqual(self.model.instr_cycles(image, 0), (4, 1))
+        self.assertEqual(self.model.instr_cycles(image, 1), (5, 1))
+        self.assertEqual(self.model.instr_cycles(image, 2), (12, 1))
+        self.assertEqual(self.model.instr_cycles(image, 3), (14, 2))
+        self.assertEqual(self.model.instr_cycles(image, 5, shamt=3), (7, 1))
+        with self.assertRaisesRegex(ValueError,
+                r"Shift amount of SRL at 0005 must be provided"):
+            self.model.instr_cycles(image, 5)
+
+    def test_simulator_agrees(self):
+        for instr_cls, cycles in self.model.cycles.items():
+            word = min(word for word, word_cls in Instr.decodings.items()
+                       if word_cls is instr_cls)
+            sim = arch_sim.Simulator([word, word], w=0x10)
+            sim.run(1)
+            with self.subTest(instr=instr_cls.__name__):
+                self.assertEqual(sim.cycles,
+                                 self.model.instr_cycles([word, word], 0, shamt=0)[0])
+
+    def test_gateware_agrees(self):
+        image = [0] * 8 + Instr.assemble([
+                MOVI(R0, 3),
+                MOVI(R1, 0x1234),
+                MOVI(R6, 0x30),
+            L("loop"),
+                SLLI(R2, R1, 5),
+                SRL (R3, R1, R0),
+                ROLI(R4, R1, 9),
+                JAL (R7, "sub"),
+                SUBI(R0, R0, 1),
+                BNZ ("loop"),
+            L("done"),
+                J   ("done"),
+            L("sub"),
+                ST  (R2, R6, 0),
+                ADJW(-8),
+                ADJW(8),
+                JR  (R7, 0),
+        ])
+        done = image.index(int(J(-1)))
+
+        sim = arch_sim.Simulator(image, pc=8, w=0)
+        path = []
+        while sim.pc != done:
+            insn = Instr.from_int(sim.mem[sim.pc])
+            if isinstance(insn, SRL):
+                path.append((sim.pc, sim.regs[int(insn.rb)]))
+            else:
+                path.append(sim.pc)
+            sim.step()
+        self.assertEqual(self.model.path_cycles(image, path), sim.cycles)
+
+        dut = CoreFSM(reset_pc=8, reset_w=0,
+                      mem_data=memory.MemoryData(shape=16, depth=64, init=image))
+        cycles = 0
+        async def testbench(ctx):
+            nonlocal cycles
+            executed = 0
+            while executed < sim.instructions:
+                executed += ctx.get(dut.o_done)
+                await ctx.tick()
+                cycles += 1
+        gateware = Simulator(dut)
+        gateware.add_clock(1e-6)
+        gateware.add_testbench(testbench)
+        gateware.run()
+        self.assertEqual(cycles, sim.cycles)
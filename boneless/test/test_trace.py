@@ -0,0 +1,124 @@
+import io
+import os
+import argparse
+import tempfile
+import unittest
+
+from ..arch.opcode import Instr
+from ..arch.opcode import *
+from ..arch.sim import Simulator
+from ..arch.trace import *
+from ..cli import trace_options, trace_main
+
+
+class TraceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.code = Instr.assemble([
+                MOVI(R0, 0x1234),
+            L("loop"),
+                ST  (R0, R1, 0x40),
+                STXA(R0, 3),
+                SUBI(R0, R0, 0x1000),
+                BNC ("done"),
+                J   ("loop"),
+            L("done"),
+                J   ("done"),
+        ])
+
+    def trace(self, limit, **kwargs):
+        sim  = Simulator(self.code, w=0x10)
+        file = io.BytesIO()
+        tracer = Tracer(sim, file, **kwargs)
+        tracer.run(limit)
+        tracer.flush()
+        file.seek(0)
+        return sim, list(read_trace(file))
+
+    def test_records(self):
+        sim, records = self.trace(8)
+        self.assertEqual(len(records), 8)
+        self.assertEqual(records[0], TraceRecord(
+            pc=0, insn=(0xc246, 0x8034), w=0x10, flags="", mem_write=(0x10, 0x1234),
+            ext_write=None, cycles=5))
+        self.assertEqual(records[1].mem_write, (0x40, 0x1234))
+        self.assertEqual(records[2].ext_write, (0x03, 0x1234))
+        self.assertEqual(records[3].mem_write, (0x10, 0x0234))
+        self.assertEqual(records[3].flags, "c")
+        self.assertEqual([record.pc for record in records], [0, 2, 4, 5, 7, 8, 2, 4])
+        self.assertEqual(sum(record.cycles for record in records), sim.cycles)
+        self.assertEqual(sim.instructions, 8)
+        self.assertEqual(sim.ext.data[3], 0x0234)
+
+    def test_equivalent(self):
+        sim, records = self.trace(1000, chunk=7)
+        reference = Simulator(self.code, w=0x10)
+        reference.run(1000)
+        self.assertEqual(len(records), 1000)
+        self.assertEqual(sim.mem, reference.mem)
+        self.assertEqual(sim.pc, reference.pc)
+        self.assertEqual(sim.cycles, reference.cycles)
+
+    def test_keeps_cache(self):
+        code = Instr.assemble([
+                MOVI(R1, int(MOVI(R3, 7))),
+            L("patch"),
+                MOVI(R3, 1),
+                ST  (R1, R2, 2),
+                J   ("patch"),
+        ])
+        sim = Simulator(code, w=0x10, translate=False)
+        sim.run(2)
+        self.assertEqual(sim.regs[3], 1)
+        Tracer(sim, io.BytesIO()).run(2)
+        # The instructions predecoded before tracing are kept, except for the one that was
+        # overwritten while tracing.
+        self.assertIsNotNone(sim._cache[0])
+        self.assertIsNone(sim._cache[2])
+        sim.run(1)
+        self.assertEqual(sim.regs[3], 7)
+        # Stores to instructions predecoded while tracing are still noticed.
+        sim.mem[sim.w + 1] = int(MOVI(R4, 9))
+        sim.mem[sim.w + 2] = 1
+        sim.run(4)
+        self.assertEqual(sim.regs[4], 9)
+
+    def test_text(self):
+        _, records = self.trace(3)
+        output = io.StringIO()
+        trace_to_text(records, output)
+        self.assertEqual(output.getvalue().splitlines(), [
+            "0000: c246 8034 MOVI R0, 0x1234      W=0010 F=-    M[0010]<-1234",
+            "0002: c008 5020 ST R0, R1, 0x40      W=0010 F=-    M[0040]<-1234",
+            "0004: 7803      STXA R0, 0x3         W=0010 F=-    X[0003]<-1234",
+        ])
+
+    def test_vcd(self):
+        _, records = self.trace(3)
+        output = io.StringIO()
+        trace_to_vcd(records, output)
+        lines = output.getvalue().splitlines()
+        self.assertIn("$var string 1 \" insn $end", lines)
+        self.assertIn("sMOVI_R0,_0x1234 \"", lines)
+        self.assertIn("#5", lines)
+        self.assertEqual(lines[-1], "#14")
+
+    def test_format_insn(self):
+        self.assertEqual(format_insn(int(ADDI(R1, R2, 1))), "ADDI R1, R2, 0x1")
+        self.assertEqual(format_insn(0xffff), "ffff")
+
+
+class TraceCLITestCase(unittest.TestCase):
+    def test_filter(self):
+        sim = Simulator(Instr.assemble([L("loop"), ADDI(R0, R0, 1), J("loop")]))
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "trace.bin")
+            with open(path, "wb") as file:
+                tracer = Tracer(sim, file)
+                tracer.run(10)
+                tracer.close()
+            args = trace_options(argparse.ArgumentParser()).parse_args(
+                [path, "-o", os.path.join(dir, "trace.txt"), "-p", "1", "-s", "2", "-n", "6"])
+            trace_main(args)
+            args.output.close()
+            with open(os.path.join(dir, "trace.txt")) as file:
+                self.assertEqual([line[:4] for line in file], ["0001"] * 3)